@@ -791,6 +791,69 @@ class DataView(OriginDataView):
             elif self._is_predefined_field(field_name):
                 raise ValueError("[{:s}] is alread a pre-defined field. Please use another name.".format(field_name))
 
+        parser = self._get_formula_parser(formula_func_name_style, register_funcs)
+        expr = parser.parse(formula)
+        inputs = self._prepare_formula_inputs(expr.variables(), is_quarterly, within_index)
+        if inputs is None:
+            return
+        var_df_dic, eval_kwargs, all_quarterly = inputs
+        df_eval = parser.evaluate(var_df_dic, **eval_kwargs)
+
+        if add_data:
+            if all_quarterly:
+                self.append_df_quarter(df_eval, field_name)
+            else:
+                self.append_df(df_eval, field_name, is_quarterly=False)
+
+        return self._formula_result(df_eval, all_quarterly)
+
+    def add_formula_template(self, formula, params, is_quarterly,
+                             formula_func_name_style='camel', data_api=None,
+                             register_funcs=None,
+                             within_index=True):
+        """
+        Parse a formula with named parameters once and prepare its data,
+        for evaluating it with many parameter values.
+
+        Parameters
+        ----------
+        formula : str or unicode
+            A formula contains operations, function calls and parameters, like 'Ts_Mean(close, LEN)'.
+        params : list of str
+            Names of the parameters in formula.
+        is_quarterly : bool
+        formula_func_name_style : {'upper', 'lower'}, optional
+        data_api : RemoteDataService, optional
+        register_funcs :Dict of functions you definite by yourself like {"name1":func1},
+                        optional
+        within_index : bool
+
+        Returns
+        -------
+        func : callable or None
+            func(param_values) returns the same result as add_formula with
+            parameter values {param: value} written into formula.
+            Sub-formulas independent of a parameter are cached across calls.
+
+        """
+        if data_api is not None:
+            self.data_api = data_api
+
+        parser = self._get_formula_parser(formula_func_name_style, register_funcs)
+        template = parser.parse_template(formula, params)
+        inputs = self._prepare_formula_inputs(template.variables(), is_quarterly, within_index)
+        if inputs is None:
+            return
+        var_df_dic, eval_kwargs, all_quarterly = inputs
+        template.bind(var_df_dic, **eval_kwargs)
+
+        def evaluate(param_values):
+            return self._formula_result(template.evaluate(param_values), all_quarterly)
+
+        return evaluate
+
+    @staticmethod
+    def _get_formula_parser(formula_func_name_style='camel', register_funcs=None):
         parser = Parser()
         parser.set_capital(formula_func_name_style)
 
@@ -801,11 +864,16 @@ class DataView(OriginDataView):
                                 func in parser.consts or func in parser.values:
                     raise ValueError("注册的自定义函数名%s与内置的函数名称重复,请更换register_funcs中定义的相关函数名称." % (func,))
                 parser.functions[func] = register_funcs[func]
+        return parser
 
-        expr = parser.parse(formula)
+    def _prepare_formula_inputs(self, var_list, is_quarterly, within_index):
+        """
+        Returns
+        -------
+        (var_df_dic, eval_kwargs, all_quarterly) or None if some variable can not be fetched.
 
+        """
         var_df_dic = dict()
-        var_list = expr.variables()
 
         # TODO: users do not need to prepare data before add_formula
         if not self.fields:
@@ -831,21 +899,15 @@ class DataView(OriginDataView):
             var_df_dic[var] = df_var
 
         # TODO: send ann_date into expr.evaluate. We assume that ann_date of all fields of a symbol is the same
-        df_ann = self._get_ann_df()
+        eval_kwargs = {"ann_dts": self._get_ann_df(), "trade_dts": self.dates}
         if within_index:
             df_index_member = self.get_ts('index_member', start_date=self.extended_start_date_d, end_date=self.end_date)
             if df_index_member.size == 0:
                 df_index_member = None
-            df_eval = parser.evaluate(var_df_dic, ann_dts=df_ann, trade_dts=self.dates, index_member=df_index_member)
-        else:
-            df_eval = parser.evaluate(var_df_dic, ann_dts=df_ann, trade_dts=self.dates)
-
-        if add_data:
-            if all_quarterly:
-                self.append_df_quarter(df_eval, field_name)
-            else:
-                self.append_df(df_eval, field_name, is_quarterly=False)
+            eval_kwargs["index_member"] = df_index_member
+        return var_df_dic, eval_kwargs, all_quarterly
 
+    def _formula_result(self, df_eval, all_quarterly):
         if all_quarterly:
             df_ann = self._get_ann_df()
             df_expanded = align(df_eval.reindex(df_ann.index), df_ann, self.dates)
@@ -1,7 +1,12 @@
 from jaqs.data.py_expression_eval import Parser as OriginParser
+from jaqs.data.py_expression_eval import TNUMBER, TOP1, TOP2, TVAR, TFUNCALL
+from collections import OrderedDict
+import numbers
+import pandas as pd
 
 from jaqs_fxdayu.patch_util import auto_register_patch
 from . import signal_function_mod as sfm
+from .window_sweep import WindowSweep
 
 
 @auto_register_patch(parent_level=1)
@@ -14,6 +19,26 @@ class Parser(OriginParser):
             'Ts_Argmin': self.ts_argmin,
         })
 
+    def parse_template(self, expr, params, cache_size=1):
+        """
+        Parse a string expression containing named symbolic parameters.
+
+        Parameters
+        ----------
+        expr : str
+            Format of expr should follow our document, parameters are written as variables, like 'Delay(close, LEN)'.
+        params : list of str
+            Names of the parameters in expr.
+        cache_size : int
+            Number of parameter values whose results are kept for each sub-formula, see FormulaTemplate.
+
+        Returns
+        -------
+        FormulaTemplate
+
+        """
+        return FormulaTemplate(self, expr, params, cache_size)
+
     # -----------------------------------------------------
     # functions
     # ta function
@@ -44,3 +69,234 @@ class Parser(OriginParser):
     def ts_argmin(self, *args,
                   **kwargs):
         return sfm.ts_argmin(*args, **kwargs)
+
+
+# 可以对多个窗口长度共用预计算结果的内置函数,对应WindowSweep的同名方法
+_SWEEP_FUNCS = ['ts_mean', 'ts_sum', 'std_dev', 'delay', 'delta', 'ts_max', 'ts_min']
+
+
+class _FormulaNode(object):
+    __slots__ = ['type_', 'index_', 'number_', 'children', 'deps', 'sweep']
+
+    def __init__(self, token, children, deps):
+        self.type_ = token.type_
+        self.index_ = token.index_
+        self.number_ = token.number_
+        self.children = children
+        self.deps = deps
+        self.sweep = None
+
+
+class FormulaTemplate(object):
+    """
+    A formula with named symbolic parameters, parsed once into an expression tree.
+
+    Parameter values are bound at evaluation time. After bind() the results of
+    sub-trees are cached by the values of the parameters they depend on, so a
+    sub-tree without parameters is evaluated only once for the whole parameter
+    grid, and e.g. 'Ts_Mean(close, LEN1)' in 'Ts_Mean(close, LEN1) - Delay(close, LEN2)'
+    only once for each value of LEN1. Results depending on all parameters are not cached.
+    Each sub-tree keeps the results of its last cache_size parameter values only,
+    so grids should vary the parameters of costly sub-trees slowest, as
+    itertools.product does with its first arguments.
+
+    Rolling built-ins (Ts_Mean, Ts_Sum, StdDev, Delay, Delta, Ts_Max, Ts_Min)
+    whose window argument only depends on parameters not used by their data
+    argument are computed with WindowSweep, sharing one precomputation of the
+    data among all window lengths.
+
+    Parameters
+    ----------
+    parser : Parser
+        Provides the operators and functions, and keeps ann_dts/trade_dts/index_member during evaluation.
+    expr : str
+    params : list of str
+    cache_size : int
+        Number of parameter values whose results are kept for each sub-tree.
+
+    """
+
+    def __init__(self, parser, expr, params, cache_size=1):
+        self.parser = parser
+        self.expression = expr
+        self.params = list(params)
+        self.cache_size = cache_size
+        parser.parse(expr)
+        self.tokens = parser.tokens
+        self.root = self._build_tree(self.tokens)
+        self._values = dict()
+        self._cache = dict()
+        self._sweeps = dict()
+
+    def _build_tree(self, tokens):
+        params = set(self.params)
+        nstack = []
+        for token in tokens:
+            if token.type_ == TNUMBER:
+                node = _FormulaNode(token, [], frozenset())
+            elif token.type_ == TVAR:
+                node = _FormulaNode(token, [], frozenset([token.index_]) & params)
+            elif token.type_ == TOP1:
+                child = nstack.pop()
+                node = _FormulaNode(token, [child], child.deps)
+            elif token.type_ in (TOP2, TFUNCALL):
+                n2 = nstack.pop()
+                n1 = nstack.pop()
+                node = _FormulaNode(token, [n1, n2], n1.deps | n2.deps)
+                if token.type_ == TFUNCALL:
+                    node.sweep = self._sweep_func(n1, n2)
+            else:
+                raise Exception('invalid Expression')
+            nstack.append(node)
+        if len(nstack) != 1:
+            raise Exception('invalid Expression (parity)')
+        return nstack[0]
+
+    def _sweep_func(self, func_node, args_node):
+        # 形如Ts_Mean(x, LEN),且窗口参数未出现在x中
+        if func_node.type_ != TVAR or args_node.type_ != TOP2 or args_node.index_ != ',':
+            return None
+        func = self.parser.functions.get(func_node.index_)
+        if getattr(func, '__self__', None) is not self.parser or \
+                getattr(func, '__name__', None) not in _SWEEP_FUNCS:
+            return None
+        data_node, window_node = args_node.children
+        if data_node.type_ == TOP2 and data_node.index_ == ',':
+            return None
+        if len(window_node.deps) == 0 or len(window_node.deps & data_node.deps) > 0:
+            return None
+        return func.__name__, data_node, window_node
+
+    def variables(self):
+        """Data variables used in the formula, excluding parameters and function names."""
+        variables = []
+        for token in self.tokens:
+            if token.type_ == TVAR and \
+                    token.index_ not in variables and \
+                    token.index_ not in self.params and \
+                    token.index_ not in self.parser.functions:
+                variables.append(token.index_)
+        return variables
+
+    def bind(self, values, ann_dts=None, trade_dts=None, index_member=None):
+        """
+        Set the data used by evaluate() and clear cached results.
+        Arguments are the same as Parser.evaluate.
+        """
+        self._values = values or {}
+        self.parser.ann_dts = ann_dts
+        self.parser.trade_dts = trade_dts
+        self.parser.index_member = index_member
+        self._cache = dict()
+        self._sweeps = dict()
+
+    def evaluate(self, param_values):
+        """
+        Evaluate the formula with bound data.
+
+        Parameters
+        ----------
+        param_values : dict
+            {param name: value}, value is used as if written in the formula.
+
+        Returns
+        -------
+        pd.DataFrame
+
+        """
+        missing = [param for param in self.params if param not in param_values]
+        if len(missing) > 0:
+            raise ValueError("Value of parameters {} are not provided.".format(missing))
+        return self._evaluate(self.root, param_values)
+
+    @staticmethod
+    def _copy(res):
+        if isinstance(res, (pd.DataFrame, pd.Series)):
+            return res.copy()
+        return res
+
+    def _evaluate(self, node, param_values):
+        # only function calls and operators are worth caching, except ',' which builds argument lists
+        cacheable = node.type_ == TFUNCALL or \
+            (node.type_ in (TOP1, TOP2) and node.index_ != ',')
+        if not cacheable or len(node.deps) == len(self.params):
+            return self._calc(node, param_values)
+        try:
+            key = (id(node), tuple(param_values[param] for param in sorted(node.deps)))
+            hash(key)
+        except TypeError:
+            return self._calc(node, param_values)
+        return self._copy(self._cached(self._cache, key, lambda: self._calc(node, param_values)))
+
+    def _cached(self, cache, key, calc):
+        # 每个节点只保留最近cache_size个参数取值的结果
+        node_cache = cache.setdefault(key[0], OrderedDict())
+        if key in node_cache:
+            node_cache.move_to_end(key)
+            return node_cache[key]
+        res = node_cache[key] = calc()
+        while len(node_cache) > self.cache_size:
+            node_cache.popitem(last=False)
+        return res
+
+    def _calc(self, node, param_values):
+        parser = self.parser
+        if node.type_ == TNUMBER:
+            return list(node.number_) if isinstance(node.number_, list) else node.number_
+        elif node.type_ == TVAR:
+            if node.index_ in param_values:
+                return param_values[node.index_]
+            elif node.index_ in self._values:
+                # 部分内置函数会修改输入的数据
+                return self._copy(self._values[node.index_])
+            elif node.index_ in parser.functions:
+                return parser.functions[node.index_]
+            else:
+                raise Exception('undefined variable: ' + node.index_)
+        elif node.type_ == TOP1:
+            return parser.ops1[node.index_](self._evaluate(node.children[0], param_values))
+        elif node.type_ == TOP2:
+            n1 = self._evaluate(node.children[0], param_values)
+            n2 = self._evaluate(node.children[1], param_values)
+            if node.index_ == ',':
+                # build a new argument list instead of appending to n1 in place
+                return list(n1) + [n2] if type(n1) is list else [n1, n2]
+            return parser.ops2[node.index_](n1, n2)
+        else:
+            if node.sweep is not None:
+                res = self._calc_sweep(node, param_values)
+                if res is not None:
+                    return res
+            f = self._evaluate(node.children[0], param_values)
+            n1 = self._evaluate(node.children[1], param_values)
+            if callable(f):
+                if type(n1) is list:
+                    return f(*n1)
+                return f(n1)
+            raise Exception(str(f) + ' is not a function')
+
+    def _calc_sweep(self, node, param_values):
+        method, data_node, window_node = node.sweep
+        window = self._evaluate(window_node, param_values)
+        if not isinstance(window, numbers.Integral) or isinstance(window, bool):
+            return None
+        if window < 0:
+            # 同Parser.delay/delta,负数窗口使用了未来数据
+            if not getattr(self.parser, 'allow_future_data', False):
+                raise RuntimeError("Can't use future data")
+            return None
+        if method not in ('delay', 'delta') and window < 1:
+            return None
+        try:
+            key = (id(node), tuple(param_values[param] for param in sorted(data_node.deps)))
+            hash(key)
+        except TypeError:
+            return None
+        def calc():
+            data = self._evaluate(data_node, param_values)
+            return WindowSweep(data) if isinstance(data, pd.DataFrame) else None
+
+        sweep = self._cached(self._sweeps, key, calc)
+        if sweep is None:
+            return None
+        return getattr(sweep, method)(int(window))
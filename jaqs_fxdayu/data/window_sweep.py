@@ -0,0 +1,135 @@
+# encoding=utf-8
+
+import numpy as np
+import pandas as pd
+
+
+class WindowSweep(object):
+    """
+    Rolling functions of one DataFrame for many window lengths.
+
+    Cumulative sums (of values, squared centered values and NaN counts) and
+    a sparse table of 2^k window max/min are built once, lazily, after which
+    every window length costs a few array operations. Results follow
+    jaqs Parser built-ins: a rolling result is NaN unless all n values in
+    the window are valid, StdDev uses ddof=1. As in pandas rolling, ±inf is
+    treated as missing.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Index is date, column is symbol.
+
+    """
+
+    def __init__(self, df):
+        self.index = df.index
+        self.columns = df.columns
+        self.values = np.asarray(df.values, dtype=float)
+        # 同pandas的rolling,滚动计算中±inf视为缺失值;Delay/Delta仍使用原始值
+        self._is_nan = ~np.isfinite(self.values)
+        self._rolling_values = np.where(self._is_nan, np.nan, self.values)
+        self._prefix = dict()
+        self._tables = dict()
+
+    def _to_frame(self, values):
+        return pd.DataFrame(values, index=self.index, columns=self.columns)
+
+    def _cumsum(self, name):
+        # 首行为0的累积和,窗口[i-n+1, i]的和为prefix[i+1] - prefix[i-n+1]
+        if name not in self._prefix:
+            values = self._rolling_values
+            is_nan = self._is_nan
+            if name == "nan":
+                data = is_nan.astype(float)
+            elif name == "sum":
+                data = np.where(is_nan, 0.0, values)
+            else:
+                # 减去列均值以减小平方和相减时的误差
+                centered = values - self._center()
+                centered[is_nan] = 0.0
+                data = centered if name == "centered" else centered * centered
+            # 用更高精度累加,减小长序列上前缀和相减的误差
+            dtype = float if name == "nan" else np.longdouble
+            prefix = np.zeros((len(values) + 1, values.shape[1]), dtype=dtype)
+            np.cumsum(data, axis=0, dtype=dtype, out=prefix[1:])
+            self._prefix[name] = prefix
+        return self._prefix[name]
+
+    def _center(self):
+        if "center" not in self._prefix:
+            valid = ~self._is_nan
+            count = valid.sum(axis=0)
+            total = np.where(valid, self._rolling_values, 0.0).sum(axis=0)
+            self._prefix["center"] = np.where(count > 0, total / np.maximum(count, 1), 0.0)
+        return self._prefix["center"]
+
+    def _window_sum(self, name, n):
+        prefix = self._cumsum(name)
+        res = np.full(self.values.shape, np.nan)
+        if n <= len(self.values):
+            res[n - 1:] = prefix[n:] - prefix[:-n]
+        return res
+
+    def _invalid(self, n):
+        # 窗口内存在缺失值或数据不足n个
+        nan_count = self._window_sum("nan", n)
+        return ~(nan_count < 0.5)
+
+    def _extreme(self, func, n):
+        key = func.__name__
+        tables = self._tables.setdefault(key, [self._rolling_values])
+        k = int(np.floor(np.log2(n)))
+        while len(tables) <= k:
+            width = 2 ** (len(tables) - 1)
+            last = tables[-1]
+            table = np.full(last.shape, np.nan)
+            func(last[width:], last[:-width], out=table[width:])
+            tables.append(table)
+        table = tables[k]
+        width = 2 ** k
+        res = np.full(self.values.shape, np.nan)
+        if n <= len(self.values):
+            # 两个长度为2^k的窗口覆盖长度为n的窗口
+            func(table[n - 1:], table[width - 1:len(table) - n + width], out=res[n - 1:])
+        res[self._invalid(n)] = np.nan
+        return res
+
+    def ts_sum(self, n):
+        res = self._window_sum("sum", n)
+        res[self._invalid(n)] = np.nan
+        return self._to_frame(res)
+
+    def ts_mean(self, n):
+        res = self._window_sum("sum", n) / n
+        res[self._invalid(n)] = np.nan
+        return self._to_frame(res)
+
+    def std_dev(self, n):
+        if n < 2:
+            return self._to_frame(np.full(self.values.shape, np.nan))
+        s1 = self._window_sum("centered", n)
+        s2 = self._window_sum("square", n)
+        var = (s2 - s1 * s1 / n) / (n - 1)
+        var[var < 0] = 0.0
+        res = np.sqrt(var)
+        res[self._invalid(n)] = np.nan
+        return self._to_frame(res)
+
+    def ts_max(self, n):
+        return self._to_frame(self._extreme(np.maximum, n))
+
+    def ts_min(self, n):
+        return self._to_frame(self._extreme(np.minimum, n))
+
+    def delay(self, n):
+        # 只支持n >= 0,负数窗口(未来数据)由Parser的内置函数处理
+        res = np.full(self.values.shape, np.nan)
+        if n == 0:
+            res[:] = self.values
+        elif 0 < n < len(res):
+            res[n:] = self.values[:-n]
+        return self._to_frame(res)
+
+    def delta(self, n):
+        return self._to_frame(self.values - self.delay(n).values)
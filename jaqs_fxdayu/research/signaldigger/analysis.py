@@ -1,5 +1,7 @@
 # encoding = utf-8
 
+import copy
+
 import numpy as np
 import pandas as pd
 import scipy.stats as scst
@@ -8,6 +10,127 @@ from jaqs.trade import common
 from . import performance as pfm
 
 
+def _rolling_extreme(values, window, func):
+    """
+    In-place rolling max/min along axis 0, equivalent to
+    ``df.rolling(window).max()`` (or ``min()``) with NaN propagation.
+
+    The window is built by doubling (1, 2, 4, ...) and closed with one
+    overlapping step, so only log2(window) passes over the buffer are needed.
+    Each pass needs one temporary row-shifted copy.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        2D float array, modified in place.
+    window : int
+    func : {np.maximum, np.minimum}
+
+    Returns
+    -------
+    values : np.ndarray
+    """
+    n = len(values)
+    if window <= 1:
+        return values
+    width = 1
+    while width * 2 <= window:
+        func(values[width:], values[:-width].copy(), out=values[width:])
+        width *= 2
+    rest = window - width
+    if rest > 0:
+        func(values[rest:], values[:-rest].copy(), out=values[rest:])
+    values[:min(window - 1, n)] = np.nan
+    return values
+
+
+def _bfill(values):
+    """In-place backward fill of NaN along axis 0, row by row."""
+    for i in range(len(values) - 2, -1, -1):
+        row = values[i]
+        nan_mask = np.isnan(row)
+        row[nan_mask] = values[i + 1][nan_mask]
+    return values
+
+
+def _to_space(values, price, period, compound):
+    """In-place (extreme - price.shift(period)) / base."""
+    values[period:] -= price[:-period]
+    values[:period] = np.nan
+    if compound:
+        values[period:] /= price[:-period]
+    else:
+        values /= price[0]
+    return values
+
+
+def compute_return_spaces(price,
+                          high=None,
+                          low=None,
+                          can_exit=None,
+                          period=5,
+                          compound=True):
+    """
+    Finds the N period upside_returns and downside_returns for each asset
+    provided, in one pass over preallocated buffers.
+
+    Results are identical to calling compute_upside_returns and
+    compute_downside_returns separately, but the rolling max/min, the
+    can_exit adjustment and the blending are done in place, so the
+    intermediate memory is about one extra copy of the input.
+
+    Parameters
+    ----------
+    price : pd.DataFrame
+        Pricing data to use in forward price calculation.
+        Assets as columns, dates as index.
+    high : pd.DataFrame or None
+        High pricing data, shape like price. If None, upside_ret is not computed.
+    low : pd.DataFrame or None
+        Low pricing data, shape like price. If None, downside_ret is not computed.
+    can_exit : pd.DataFrame of bool or None
+        shape like price
+    period : int
+        periods to compute returns on.
+    compound : bool
+
+    Returns
+    -------
+    upside_ret, downside_ret : pd.DataFrame or None
+        indexed by date
+    """
+    price_arr = np.asarray(price.values, dtype=float)
+    blocked = None
+    buf = None
+    if can_exit is not None:
+        blocked = ~np.asarray(can_exit.values, dtype=bool)
+        if not blocked.any():
+            blocked = None
+
+    res = []
+    for extreme, func in [(high, np.maximum), (low, np.minimum)]:
+        if extreme is None:
+            res.append(None)
+            continue
+        space = np.array(extreme.values, dtype=float)
+        _rolling_extreme(space, period, func)
+        _to_space(space, price_arr, period, compound)
+        if blocked is not None:
+            if buf is None:
+                buf = np.empty_like(space)
+            buf[:] = extreme.values
+            buf[blocked] = np.nan
+            _bfill(buf)
+            _rolling_extreme(buf, period, func)
+            _to_space(buf, price_arr, period, compound)
+            # 不可出场时取两者中更极端的值,任一为空则为0
+            func(space, buf, out=buf)
+            buf[np.isnan(buf)] = 0
+            np.copyto(space, buf, where=blocked)
+        res.append(pd.DataFrame(space, index=price.index, columns=price.columns))
+    return res[0], res[1]
+
+
 def compute_downside_returns(price,
                              low,
                              can_exit=None,
@@ -42,22 +165,7 @@ def compute_downside_returns(price,
     downside_returns : pd.DataFrame
         downside_returns in indexed by date
     """
-    if compound:
-        downside_ret = (low.rolling(period).min() - price.shift(period)) / price.shift(period)
-    else:
-        downside_ret = (low.rolling(period).min() - price.shift(period)) / price.iloc[0]
-    if can_exit is not None:
-        low_can_exit = low.copy()
-        low_can_exit[~can_exit] = np.NaN
-        low_can_exit = low_can_exit.fillna(method="bfill")
-        if compound:
-            downside_ret_can_exit = (low_can_exit.rolling(period).min() - price.shift(period)) / price.shift(period)
-        else:
-            downside_ret_can_exit = (low_can_exit.rolling(period).min() - price.shift(period)) / price.iloc[0]
-        downside_ret[~can_exit] = (downside_ret[downside_ret <= downside_ret_can_exit].fillna(0) + \
-                                   downside_ret_can_exit[downside_ret_can_exit < downside_ret].fillna(0))[~can_exit]
-
-    return downside_ret
+    return compute_return_spaces(price, low=low, can_exit=can_exit, period=period, compound=compound)[1]
 
 
 def compute_upside_returns(price,
@@ -94,22 +202,7 @@ def compute_upside_returns(price,
     upside_returns : pd.DataFrame
         upside_returns in indexed by date
     """
-    if compound:
-        upside_ret = (high.rolling(period).max() - price.shift(period)) / price.shift(period)
-    else:
-        upside_ret = (high.rolling(period).max() - price.shift(period)) / price.iloc[0]
-    if can_exit is not None:
-        high_can_exit = high.copy()
-        high_can_exit[~can_exit] = np.NaN
-        high_can_exit = high_can_exit.fillna(method="bfill")
-        if compound:
-            upside_ret_can_exit = (high_can_exit.rolling(period).max() - price.shift(period)) / price.shift(period)
-        else:
-            upside_ret_can_exit = (high_can_exit.rolling(period).max() - price.shift(period)) / price.iloc[0]
-        upside_ret[~can_exit] = (upside_ret[upside_ret >= upside_ret_can_exit].fillna(0) + \
-                                 upside_ret_can_exit[upside_ret_can_exit > upside_ret].fillna(0))[~can_exit]
-
-    return upside_ret
+    return compute_return_spaces(price, high=high, can_exit=can_exit, period=period, compound=compound)[0]
 
 
 def cal_rets_stats(rets, period):
@@ -267,23 +360,8 @@ def calc_tb_quantile_ret_space_mean_std(signal_data,
     quantile_space : pd.DataFrame of dict
 
     """
-    signal_data = signal_data.copy()
     n_quantiles = signal_data['quantile'].max()
-    grouper = ['quantile']
-    grouper.append('trade_date')
-
-    group_mean_std = signal_data.groupby(grouper)[space_type + "_ret"].agg(['mean', 'std', 'count'])
-    indexes = []
-    quantile_daily_mean_std_dic = dict()
-    for q in [1, n_quantiles]:  # loop for different quantiles
-        df_q = group_mean_std.loc[pd.IndexSlice[q, :], :]  # bug
-        df_q.index = df_q.index.droplevel(level='quantile')
-        indexes.append(pd.Series(df_q.index))
-        quantile_daily_mean_std_dic[q] = df_q
-    new_index = sorted(pd.concat(indexes).unique())
-    for q in [1, n_quantiles]:
-        quantile_daily_mean_std_dic[q] = quantile_daily_mean_std_dic[q].reindex(new_index).fillna(0)
-    return quantile_daily_mean_std_dic
+    return pfm.calc_quantile_mean_std_ts(signal_data, space_type + "_ret", quantiles=[1, n_quantiles])
 
 
 def cal_spaces_stats(space):
@@ -347,10 +425,10 @@ def get_spaces(signal_data, is_event):
         spaces["bottom_quantile_space"]["downside_space"] = signal_data[signal_data['quantile'] == 1][
             "downside_ret"].dropna()
 
-        tb_upside_mean_space = calc_tb_quantile_ret_space_mean_std(signal_data,
-                                                                   space_type="upside")
-        tb_downside_mean_space = calc_tb_quantile_ret_space_mean_std(signal_data,
-                                                                     space_type="downside")
+        tb_mean_space = pfm.calc_quantile_mean_std_ts(signal_data, ["upside_ret", "downside_ret"],
+                                                      quantiles=[1, n_quantiles])
+        tb_upside_mean_space = tb_mean_space["upside_ret"]
+        tb_downside_mean_space = tb_mean_space["downside_ret"]
         spaces['tmb_space']["upside_space"] = pfm.calc_return_diff_mean_std(tb_upside_mean_space[n_quantiles],
                                                                             tb_downside_mean_space[1])[
             'mean_diff'].dropna()
@@ -364,15 +442,493 @@ def get_spaces(signal_data, is_event):
     return spaces
 
 
-def analysis(signal_data, is_event, period):
-    if is_event:
-        return {
-            "ret": return_stats(signal_data, True, period),
-            "space": space_stats(signal_data, True)
-        }
-    else:
-        return {
-            "ic": ic_stats(signal_data),
-            "ret": return_stats(signal_data, False, period),
-            "space": space_stats(signal_data, False)
-        }
+class AnalysisEngine(object):
+    """
+    Computes the results of analysis() in one pass over signal_data.
+
+    The trade_date codes, per-date weights, quantile masks and signal
+    ranks are derived once and shared by the ic, ret and space statistics,
+    instead of re-grouping signal_data in every get_ics/get_rets/get_spaces
+    call. Results are the same as ic_stats, return_stats and space_stats.
+
+    window() gives the statistics of a date range from the same intermediate
+    results, as if signal_data had been sliced by trade_date. For every target
+    type, prefix sums over dates of the count and the first four powers of
+    its values are cached, so mean, std, t-stat, IR, skew and kurtosis of any
+    date range cost O(1); only the space percentiles read the values again.
+
+    Parameters
+    ----------
+    signal_data : pd.DataFrame - MultiIndex
+        Index is pd.MultiIndex ['trade_date', 'symbol'],
+        columns = ['signal', 'return', 'quantile'] and optionally ['upside_ret', 'downside_ret']
+    is_event : bool
+    period : int
+
+    """
+
+    def __init__(self, signal_data, is_event, period):
+        self.is_event = is_event
+        self.period = period
+        self.has_space = ("upside_ret" in signal_data.columns) and ("downside_ret" in signal_data.columns)
+
+        codes, dates = pd.factorize(signal_data.index.get_level_values('trade_date'), sort=True)
+        self.dates = np.asarray(dates)
+        self._codes = codes
+        self._n_dates = len(dates)
+        self._counts = np.bincount(codes, minlength=self._n_dates)
+        # full range, see window()
+        self._date_slice = slice(None)
+        self._rows = None
+
+        self._columns = dict()
+        for col in ["signal", "return", "upside_ret", "downside_ret"]:
+            if col in signal_data.columns:
+                self._columns[col] = np.asarray(signal_data[col].values, dtype=float)
+        if 'quantile' in signal_data.columns:
+            self._quantile = signal_data['quantile'].values
+            self.n_quantiles = signal_data['quantile'].max()
+        else:
+            self._quantile = None
+            self.n_quantiles = None
+
+        # per-date results and moments, kept for every window
+        self._cache = dict()
+        # per-row intermediate results (ranks, weights, quantile masks), see drop_row_cache()
+        self._row_cache = dict()
+
+    def window(self, start=None, end=None):
+        """
+        Restrict the statistics to trade dates in [start, end].
+
+        Parameters
+        ----------
+        start, end : int, optional
+            Both inclusive, like signal_data.loc[start:end]. Unbounded if None.
+
+        Returns
+        -------
+        AnalysisEngine
+            A view sharing the per-date and per-row results cached by this engine.
+            Statistics are the same as those of AnalysisEngine(signal_data.loc[start:end], ...).
+
+        """
+        lo = 0 if start is None else int(np.searchsorted(self.dates, start, side='left'))
+        hi = self._n_dates if end is None else int(np.searchsorted(self.dates, end, side='right'))
+        view = copy.copy(self)
+        view._date_slice = slice(lo, hi)
+        view._rows = None
+        if self._quantile is not None:
+            if "daily_max_quantile" not in self._cache:
+                self._cache["daily_max_quantile"] = pd.Series(self._quantile).groupby(self._codes).max().values
+            view.n_quantiles = self._cache["daily_max_quantile"][lo:hi].max() if hi > lo else None
+        return view
+
+    @property
+    def n_rows(self):
+        """Number of rows of signal_data within the window."""
+        return int(self._counts[self._date_slice].sum())
+
+    def _row_mask(self):
+        """Rows within the window, None for the full range."""
+        lo, hi, _ = self._date_slice.indices(self._n_dates)
+        if lo == 0 and hi == self._n_dates:
+            return None
+        if self._rows is None:
+            self._rows = (self._codes >= lo) & (self._codes < hi)
+        return self._rows
+
+    def drop_row_cache(self):
+        """
+        Free the per-row intermediate results. Statistics already computed for
+        a target type stay available for any window from the per-date cache.
+        """
+        self._row_cache.clear()
+
+    def _group_sum(self, values):
+        """Per-date sum of values, NaN treated as 0."""
+        return np.bincount(self._codes, weights=np.where(np.isnan(values), 0.0, values),
+                           minlength=self._n_dates)
+
+    def _group_rank(self, values):
+        """Per-date average ranks (as scipy.stats.rankdata) of values."""
+        order = np.lexsort((values, self._codes))
+        sorted_values = values[order]
+        sorted_codes = self._codes[order]
+        n = len(values)
+
+        run_start = np.ones(n, dtype=bool)
+        run_start[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_codes[1:] != sorted_codes[:-1])
+        run_id = np.cumsum(run_start) - 1
+        starts = np.flatnonzero(run_start)
+        ends = np.append(starts[1:], n)
+        group_start = np.cumsum(self._counts) - self._counts
+        run_rank = (starts + ends - 1) / 2.0 - group_start[sorted_codes[starts]] + 1
+
+        ranks = np.empty(n)
+        ranks[order] = run_rank[run_id]
+        return ranks
+
+    def _signal_rank(self):
+        if "signal_rank" not in self._row_cache:
+            self._row_cache["signal_rank"] = self._group_rank(self._columns["signal"])
+        return self._row_cache["signal_rank"]
+
+    def _weights(self, method):
+        """Per-date normalized signal weights, see pfm.calc_period_wise_weighted_signal_return."""
+        key = method + "_weights"
+        if key not in self._row_cache:
+            signal = self._columns["signal"]
+            if method == 'long_only':
+                w = (signal + np.abs(signal)) / 2.0
+            elif method == 'short_only':
+                w = (signal - np.abs(signal)) / 2.0
+            elif method == 'long_short':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean = self._group_sum(signal) / np.bincount(self._codes, weights=~np.isnan(signal),
+                                                                 minlength=self._n_dates)
+                w = signal - mean[self._codes]
+            else:
+                raise ValueError("method can only be long_only, short_only or long_short,"
+                                 "but [{}] is provided".format(method))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self._row_cache[key] = w / self._group_sum(np.abs(w))[self._codes]
+        return self._row_cache[key]
+
+    def _quantile_mask(self, q):
+        key = "quantile_%s" % q
+        if key not in self._row_cache:
+            self._row_cache[key] = self._quantile == q
+        return self._row_cache[key]
+
+    def _period_wise_weighted(self, keys):
+        """
+        Period wise returns and spaces of weighted portfolios, keys follow
+        get_rets / weighted_signal_ret_space ('long_ret', 'long_space_up', ...).
+        Missing keys are summed in one groupby and cached.
+        """
+        missing = [key for key in keys if key not in self._cache]
+        if len(missing) > 0:
+            ret = self._columns["return"]
+            up, down = self._columns.get("upside_ret"), self._columns.get("downside_ret")
+            w = self._weights
+            makers = {
+                "long_ret": lambda: ret * w('long_only'),
+                "short_ret": lambda: ret * w('short_only'),
+                "long_short_ret": lambda: ret * w('long_short'),
+                "long_space_up": lambda: up * w('long_only'),
+                "long_space_down": lambda: down * w('long_only'),
+                "short_space_up": lambda: down * w('short_only'),
+                "short_space_down": lambda: up * w('short_only'),
+                "long_short_space_up": lambda: up * w('long_only') + down * w('short_only'),
+                "long_short_space_down": lambda: down * w('long_only') + up * w('short_only'),
+            }
+            weighted = pd.DataFrame({key: makers[key]() for key in missing})
+            period_wise = weighted.groupby(self._codes).sum()
+            for key in missing:
+                self._cache[key] = period_wise[key].values
+        return [self._cache[key] for key in keys]
+
+    def _quantile_period_mean(self, column, q):
+        """Per-date mean of column within quantile q, and the number of rows of q on each date."""
+        mask = self._quantile_mask(q)
+        values = np.where(mask, self._columns[column], np.nan)
+        valid = ~np.isnan(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._group_sum(values) / np.bincount(self._codes, weights=valid, minlength=self._n_dates)
+        mean[np.isnan(mean)] = 0
+        rows = np.bincount(self._codes, weights=mask, minlength=self._n_dates)
+        return mean, rows
+
+    @staticmethod
+    def _dropna(values):
+        return values[~np.isnan(values)]
+
+    def _per_date(self, values):
+        """Non-NaN values of a per-date array within the window."""
+        return self._dropna(values[self._date_slice])
+
+    def _per_row(self, values, mask=None):
+        """Non-NaN values of a per-row array within the window, optionally selected by mask."""
+        rows = self._row_mask()
+        if rows is not None:
+            mask = rows if mask is None else (mask & rows)
+        return self._dropna(values if mask is None else values[mask])
+
+    @staticmethod
+    def _select(names, selected):
+        if selected is None:
+            return names
+        return [name for name in names if name in selected]
+
+    def _daily_ic(self, item):
+        key = item + "_ic"
+        if key not in self._cache:
+            signal_rank = self._signal_rank()
+            values = self._columns[item]
+            # 当天存在缺失值时spearmanr结果为nan
+            invalid = self._group_sum((np.isnan(self._columns["signal"]) | np.isnan(values)).astype(float)) > 0
+            center = (self._counts[self._codes] + 1) / 2.0
+            dx = signal_rank - center
+            dy = self._group_rank(values) - center
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ic = self._group_sum(dx * dy) / np.sqrt(self._group_sum(dx * dx) * self._group_sum(dy * dy))
+            ic[invalid] = np.nan
+            self._cache[key] = ic
+        return self._cache[key]
+
+    # A sample is (key, maker): maker() returns (values, mask, per_date), either
+    # per-date values or per-row values selected by mask. key identifies the
+    # sample in the cache and depends on n_quantiles where it is used.
+
+    def _ic_sample(self, item):
+        return item + "_ic", lambda: (self._daily_ic(item), None, True)
+
+    def _ret_sample(self, ret_type):
+        ret = self._columns["return"]
+        if self.is_event and ret_type in ["long_ret", "short_ret"]:
+            sign = 1 if ret_type == "long_ret" else -1
+            return ret_type, lambda: (ret * sign, self._columns["signal"] == sign, False)
+        if ret_type in ["long_ret", "short_ret", "long_short_ret"]:
+            return ret_type, lambda: (self._period_wise_weighted([ret_type])[0], None, True)
+        q = self.n_quantiles
+        if ret_type == "top_quantile_ret":
+            return "%s_%s" % (ret_type, q), lambda: (ret, self._quantile_mask(q), False)
+        if ret_type == "bottom_quantile_ret":
+            return ret_type, lambda: (ret, self._quantile_mask(1), False)
+        if ret_type == "tmb_ret":
+            # 与calc_quantile_return_mean_std一致,取所有分位数出现过的日期
+            def tmb():
+                top_mean = self._quantile_period_mean("return", q)[0]
+                bottom_mean = self._quantile_period_mean("return", 1)[0]
+                return top_mean - bottom_mean, None, True
+            return "%s_%s" % (ret_type, q), tmb
+        return ret_type, lambda: (ret, None, False)
+
+    def _space_samples(self, dir_type):
+        up, down = self._columns["upside_ret"], self._columns["downside_ret"]
+        if self.is_event and dir_type in ["long_space", "short_space"]:
+            signal = self._columns["signal"]
+            if dir_type == "long_space":
+                return (dir_type + "_up", lambda: (up, signal == 1, False)), \
+                    (dir_type + "_down", lambda: (down, signal == 1, False))
+            return (dir_type + "_up", lambda: (down * -1, signal == -1, False)), \
+                (dir_type + "_down", lambda: (up * -1, signal == -1, False))
+        if dir_type in ["long_space", "short_space", "long_short_space"]:
+            return (dir_type + "_up", lambda: (self._period_wise_weighted([dir_type + "_up"])[0], None, True)), \
+                (dir_type + "_down", lambda: (self._period_wise_weighted([dir_type + "_down"])[0], None, True))
+        q = self.n_quantiles
+        if dir_type in ["top_quantile_space", "bottom_quantile_space"]:
+            q = q if dir_type == "top_quantile_space" else 1
+            return ("%s_up_%s" % (dir_type, q), lambda: (up, self._quantile_mask(q), False)), \
+                ("%s_down_%s" % (dir_type, q), lambda: (down, self._quantile_mask(q), False))
+        if dir_type == "tmb_space":
+            # 与calc_tb_quantile_ret_space_mean_std一致,只取首尾分位数出现过的日期
+            def tmb(up_space):
+                top_up, top_rows = self._quantile_period_mean("upside_ret", q)
+                top_down = self._quantile_period_mean("downside_ret", q)[0]
+                bottom_up, bottom_rows = self._quantile_period_mean("upside_ret", 1)
+                bottom_down = self._quantile_period_mean("downside_ret", 1)[0]
+                values = top_up - bottom_down if up_space else top_down - bottom_up
+                return np.where((top_rows + bottom_rows) > 0, values, np.nan), None, True
+            return ("%s_up_%s" % (dir_type, q), lambda: tmb(True)), \
+                ("%s_down_%s" % (dir_type, q), lambda: tmb(False))
+        return (dir_type + "_up", lambda: (up, None, False)), (dir_type + "_down", lambda: (down, None, False))
+
+    def _sample_data(self, sample):
+        """(values, mask, per_date) of the sample, per-date values are cached."""
+        key = "sample_" + sample[0]
+        if key in self._cache:
+            return self._cache[key]
+        data = sample[1]()
+        if data[2]:
+            self._cache[key] = data
+        return data
+
+    def _values(self, sample):
+        """Non-NaN values of the sample within the window."""
+        values, mask, per_date = self._sample_data(sample)
+        if per_date:
+            return self._per_date(values)
+        return self._per_row(values, mask)
+
+    def _moments(self, sample):
+        """
+        Prefix sums over dates of the count and the 1st to 4th powers of the
+        sample values (shifted by their mean), cached by sample key.
+        """
+        key = "moments_" + sample[0]
+        if key not in self._cache:
+            values, mask, per_date = self._sample_data(sample)
+            codes = np.arange(self._n_dates) if per_date else self._codes
+            if mask is not None:
+                values, codes = values[mask], codes[mask]
+            valid = ~np.isnan(values)
+            values, codes = values[valid], codes[valid]
+            # 减去均值以减小由原点矩计算中心矩时的误差
+            shift = values.mean() if len(values) > 0 else 0.0
+            diff = values - shift
+            sums = np.zeros((5, self._n_dates + 1), dtype=np.longdouble)
+            power = np.ones(len(diff))
+            for k in range(5):
+                np.cumsum(np.bincount(codes, weights=power, minlength=self._n_dates),
+                          dtype=np.longdouble, out=sums[k, 1:])
+                power = power * diff
+            self._cache[key] = shift, sums
+        return self._cache[key]
+
+    def _summary(self, sample):
+        """Count, mean and biased central moments m2, m3, m4 of the sample within the window."""
+        shift, sums = self._moments(sample)
+        lo, hi, _ = self._date_slice.indices(self._n_dates)
+        total = sums[:, hi] - sums[:, lo]
+        n = int(round(float(total[0])))
+        if n == 0:
+            return 0, np.nan, np.nan, np.nan, np.nan
+        mu, e2, e3, e4 = total[1] / n, total[2] / n, total[3] / n, total[4] / n
+        m2 = e2 - mu * mu
+        if m2 <= 1e-12 * e2:
+            # 样本值全部相同
+            return n, float(shift + mu), 0.0, 0.0, 0.0
+        m3 = e3 - 3 * mu * e2 + 2 * mu ** 3
+        m4 = e4 - 4 * mu * e3 + 6 * mu * mu * e2 - 3 * mu ** 4
+        return n, float(shift + mu), float(m2), float(m3), float(m4)
+
+    @staticmethod
+    def _moment_stats(n, mean, m2, m3, m4):
+        """
+        Statistics as computed by numpy / scipy.stats from the sample: std with
+        ddof 0 and 1, one sample t-test against 0, biased skew and kurtosis (Fisher).
+        """
+        std = np.sqrt(m2)
+        std_ddof1 = np.sqrt(m2 * n / (n - 1)) if n > 1 else np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t_stat = mean / std_ddof1 * np.sqrt(n)
+            skew = m3 / m2 ** 1.5 if m2 > 0 else np.nan
+            kurtosis = m4 / m2 ** 2 - 3 if m2 > 0 else np.nan
+        p_value = 2 * scst.t.sf(np.abs(t_stat), n - 1) if n > 1 else np.nan
+        return {"n": n, "mean": mean, "std": std, "std_ddof1": std_ddof1,
+                "t_stat": t_stat, "p_value": p_value, "skew": skew, "kurtosis": kurtosis}
+
+    @property
+    def ic_types(self):
+        if self.is_event:
+            return []
+        items = ["return", "upside_ret", "downside_ret"] if self.has_space else ["return"]
+        return [item + "_ic" for item in items]
+
+    @property
+    def ret_types(self):
+        if self.is_event:
+            return ["long_ret", "short_ret", "long_short_ret", "all_sample_ret"]
+        return ["long_ret", "short_ret", "long_short_ret",
+                "top_quantile_ret", "bottom_quantile_ret", "tmb_ret", "all_sample_ret"]
+
+    @property
+    def space_types(self):
+        if not self.has_space:
+            return []
+        if self.is_event:
+            return ["long_space", "short_space", "long_short_space", "all_sample_space"]
+        return ["long_space", "short_space", "long_short_space",
+                "top_quantile_space", "bottom_quantile_space", "tmb_space", "all_sample_space"]
+
+    def get_ics(self, ic_types=None):
+        return [(ic_type, self._values(self._ic_sample(ic_type[:-len("_ic")])))
+                for ic_type in self._select(self.ic_types, ic_types)]
+
+    def get_rets(self, ret_types=None):
+        return [(ret_type, self._values(self._ret_sample(ret_type)))
+                for ret_type in self._select(self.ret_types, ret_types)]
+
+    def get_spaces(self, space_types=None):
+        return [(dir_type,) + tuple(self._values(sample) for sample in self._space_samples(dir_type))
+                for dir_type in self._select(self.space_types, space_types)]
+
+    def ic_stats(self, ic_types=None):
+        """Same as pfm.calc_ic_stats_table of each IC series, from cached moments."""
+        stats = []
+        for item in self._select(self.ic_types, ic_types):
+            s = self._moment_stats(*self._summary(self._ic_sample(item[:-len("_ic")])))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ir = s["mean"] / s["std_ddof1"]
+            stats.append(pd.DataFrame({item: [s["mean"], s["std_ddof1"], s["t_stat"], s["p_value"],
+                                              s["skew"], s["kurtosis"], ir]},
+                                      index=["IC Mean", "IC Std.", "t-stat(IC)", "p-value(IC)",
+                                             "IC Skew", "IC Kurtosis", "Ann. IR"]))
+        if len(stats) > 0:
+            stats = pd.concat(stats, axis=1)
+        return stats
+
+    def return_stats(self, ret_types=None):
+        """Same as cal_rets_stats of each return series, from cached moments."""
+        ratio = (1.0 * common.CALENDAR_CONST.TRADE_DAYS_PER_YEAR / self.period)
+        stats = []
+        for ret_type in self._select(self.ret_types, ret_types):
+            s = self._moment_stats(*self._summary(self._ret_sample(ret_type)))
+            if s["n"] > 0:
+                annual_ret, annual_vol = s["mean"] * ratio, s["std"] * np.sqrt(ratio)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    ir = annual_ret / annual_vol
+                stats.append(pd.DataFrame({ret_type: [s["t_stat"], np.round(s["p_value"], 5), s["skew"],
+                                                      s["kurtosis"], annual_ret, annual_vol, ir, s["n"]]},
+                                          index=['t-stat', "p-value", "skewness", "kurtosis",
+                                                 'Ann. Ret', 'Ann. Vol', 'Ann. IR', 'occurance']))
+        if len(stats) > 0:
+            stats = pd.concat(stats, axis=1)
+        return stats
+
+    def space_stats(self, space_types=None):
+        """Same as cal_spaces_stats of each space, mean/std/IR from cached moments."""
+        stats_result = []
+        for dir_type in self._select(self.space_types, space_types):
+            samples = self._space_samples(dir_type)
+            if self._summary(samples[0])[0] == 0:
+                continue
+            index, values = [], []
+            for space_type, sample in zip(["Up_sp", "Down_sp"], samples):
+                s = self._moment_stats(*self._summary(sample))
+                space = self._values(sample)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    ir = s["mean"] / s["std"]
+                percents = [5, 25, 50, 75, 95]
+                index += [space_type + " Mean", space_type + " Std", space_type + " IR"]
+                index += [space_type + " Pct" + str(percent) for percent in percents]
+                values += [s["mean"], s["std"], ir] + list(np.percentile(space, percents))
+                index.append(space_type + ' Occur')
+                values.append(s["n"])
+            stats_result.append(pd.DataFrame({dir_type: values}, index=index))
+        if len(stats_result) > 0:
+            stats_result = pd.concat(stats_result, axis=1)
+        return stats_result
+
+    def analysis(self, target_types=None):
+        """
+        Parameters
+        ----------
+        target_types : list of str, optional
+            Only compute the statistics of these target types, e.g. ['long_ret', 'return_ic'].
+            Statistic kinds ('ic', 'ret', 'space') without any requested type are left out.
+            All target types by default.
+
+        Returns
+        -------
+        res : dict
+            {'ic': pd.DataFrame, 'ret': pd.DataFrame, 'space': pd.DataFrame}, 'ic' only for non-event signals.
+
+        """
+        res = dict()
+        for kind, types, func in [("ic", self.ic_types, self.ic_stats),
+                                  ("ret", self.ret_types, self.return_stats),
+                                  ("space", self.space_types, self.space_stats)]:
+            if kind == "ic" and self.is_event:
+                continue
+            if target_types is None:
+                res[kind] = func()
+            elif len(self._select(types, target_types)) > 0:
+                res[kind] = func(target_types)
+        return res
+
+
+def analysis(signal_data, is_event, period, target_types=None):
+    return AnalysisEngine(signal_data, is_event, period).analysis(target_types)
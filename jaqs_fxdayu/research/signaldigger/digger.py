@@ -9,7 +9,7 @@ from jaqs.research.signaldigger.digger import get_dummy_grouper, calc_calendar_d
 from jaqs.trade import common
 
 from jaqs_fxdayu.patch_util import auto_register_patch
-from .analysis import compute_downside_returns, compute_upside_returns
+from .analysis import compute_return_spaces
 from . import performance as pfm
 from . import plotting
 import warnings
@@ -173,9 +173,6 @@ class SignalDigger(OriginSignalDigger):
                     warnings.warn("Warning: signal与high的index/columns不一致,请检查输入参数!")
                     high = high.reindex_like(signal)
                 high = jutil.fillinf(high)
-                upside_ret = compute_upside_returns(price, high, can_exit, self.period, compound=True)
-                upside_ret = jutil.fillinf(upside_ret)
-                upside_ret -= commission
             if low is not None:
                 try:
                     assert np.all(signal.index == low.index)
@@ -184,7 +181,13 @@ class SignalDigger(OriginSignalDigger):
                     warnings.warn("Warning: signal与low的index/columns不一致,请检查输入参数!")
                     low = low.reindex_like(signal)
                 low = jutil.fillinf(low)
-                downside_ret = compute_downside_returns(price, low, can_exit, self.period, compound=True)
+            if high is not None or low is not None:
+                upside_ret, downside_ret = compute_return_spaces(price, high, low, can_exit, self.period,
+                                                                 compound=True)
+            if upside_ret is not None:
+                upside_ret = jutil.fillinf(upside_ret)
+                upside_ret -= commission
+            if downside_ret is not None:
                 downside_ret = jutil.fillinf(downside_ret)
                 downside_ret -= commission
         else:
@@ -511,3 +514,141 @@ class SignalDigger(OriginSignalDigger):
 
         self.ic_report_data = {'daily_ic': ic,
                                'monthly_ic': monthly_ic}
+
+    def calc_horizon_profile(self, signal, price, benchmark_price=None, periods=range(1, 41),
+                             n_quantiles=5, mask=None, can_enter=None, can_exit=None,
+                             commission=0.0008, chunk_size=4000000):
+        """
+        Computes IC and top-minus-bottom quantile return statistics for many holding periods in one pass.
+        The result for each period is the same as calling process_signal_before_analysis(period=period)
+        and computing the statistics on signal_data, restricted to dates whose forward return is observable.
+        Signal ranks, masks and quantiles do not depend on the period and are computed only once.
+
+        Parameters
+        ----------
+        signal : pd.DataFrame
+        price : pd.DataFrame
+        benchmark_price : pd.DataFrame
+        periods : list of int
+        n_quantiles : int
+        mask : pd.DataFrame
+        can_enter : pd.DataFrame
+        can_exit : pd.DataFrame
+        commission : float
+        chunk_size : int
+            Maximum number of (date, symbol) cells of forward returns ranked at once.
+
+        Returns
+        -------
+        res : pd.DataFrame
+            Index is period, columns are the columns of calc_ic_stats_table
+            and 'TMB Mean', 'TMB Std.', 'TMB IR' of the period-wise top minus bottom return.
+
+        """
+        from .multi_factor import _segment_rank
+
+        if not (n_quantiles > 0 and isinstance(n_quantiles, int)):
+            raise ValueError("n_quantiles must be a positive integer. Input is: {}".format(n_quantiles))
+
+        def align(df, name):
+            try:
+                assert np.all(signal.index == df.index)
+                assert np.all(signal.columns == df.columns)
+            except:
+                warnings.warn("Warning: signal与{}的index/columns不一致,请检查输入参数!".format(name))
+                df = df.reindex_like(signal)
+            return jutil.fillinf(df)
+
+        def to_bool(df, name, default):
+            if df is None:
+                return np.full(signal.shape, default)
+            return align(df, name).astype(int).fillna(0).astype(bool).values
+
+        signal = jutil.fillinf(signal)
+        price = align(price, "price")
+        mask = to_bool(mask, "mask", False)
+        can_enter = to_bool(can_enter, "can_enter", True)
+        can_exit = to_bool(can_exit, "can_exit", True)
+
+        # 同price2ret(pct_change),缺失的价格以最近的有效价格代替;卖出日不能卖出时以之后第一个可卖出日的价格计算
+        price_values = price.fillna(method="ffill").values
+        price_can_exit = price.copy()
+        price_can_exit[~can_exit] = np.NaN
+        price_can_exit = price_can_exit.fillna(method="bfill").fillna(method="ffill").values
+        if benchmark_price is not None:
+            benchmark_values = benchmark_price.loc[signal.index].fillna(method="ffill").values.flatten()
+
+        signal_values = signal.shift(1).values
+        valid = ~(mask | np.isnan(signal_values) | ~can_enter)
+        n_dates, n_symbols = signal.shape
+        rows = np.repeat(np.arange(n_dates)[:, None], n_symbols, axis=1)
+        if n_quantiles == 1:
+            quantile = np.ones(valid.sum(), dtype=int)
+        else:
+            quantile = jutil.to_quantile(pd.DataFrame(np.where(valid, signal_values, np.nan)),
+                                         n_quantiles=n_quantiles).values[valid].astype(int)
+
+        # 信号的排序对所有持有期相同
+        count = np.bincount(rows[valid], minlength=n_dates)
+        dx = np.zeros(signal.shape)
+        dx[valid] = _segment_rank(signal_values, valid, rows) - (count[rows[valid]] + 1) / 2.0
+        sxx = np.bincount(rows[valid], weights=dx[valid] ** 2, minlength=n_dates)
+
+        def forward_ret(period):
+            ret = np.full(signal.shape, np.nan)
+            if period >= n_dates:
+                return ret
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ret[:-period] = price_values[period:] / price_values[:-period] - 1
+                ret_can_exit = price_can_exit[period:] / price_can_exit[:-period] - 1
+                ret[:-period][~can_exit[period:]] = ret_can_exit[~can_exit[period:]]
+                if benchmark_price is not None:
+                    ret[:-period] -= (benchmark_values[period:] / benchmark_values[:-period] - 1)[:, None]
+            ret[np.isinf(ret)] = np.nan
+            ret -= commission
+            ret[np.isnan(ret)] = 0.0
+            return ret
+
+        periods = list(periods)
+        n_chunk = max(1, chunk_size // max(1, signal.size))
+        ic = np.full((len(periods), n_dates), np.nan)
+        tmb = np.full((len(periods), n_dates), np.nan)
+        for start in range(0, len(periods), n_chunk):
+            chunk = periods[start:start + n_chunk]
+            # 各持有期的收益按行堆叠,每个持有期的每个日期为一个分段
+            ret = np.concatenate([forward_ret(period) for period in chunk])
+            stacked_valid = np.tile(valid, (len(chunk), 1))
+            stacked_rows = np.arange(len(chunk) * n_dates)[:, None].repeat(n_symbols, axis=1)
+            segment = stacked_rows[stacked_valid]
+            n_segments = len(chunk) * n_dates
+            dy = _segment_rank(ret, stacked_valid, stacked_rows) - (np.tile(count, len(chunk))[segment] + 1) / 2.0
+            sxy = np.bincount(segment, weights=np.tile(dx, (len(chunk), 1))[stacked_valid] * dy, minlength=n_segments)
+            syy = np.bincount(segment, weights=dy * dy, minlength=n_segments)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                chunk_ic = sxy / np.sqrt(np.tile(sxx, len(chunk)) * syy)
+            chunk_ic[(np.tile(count, len(chunk)) < 2) | (np.tile(sxx, len(chunk)) <= 0) | (syy <= 0)] = np.nan
+            ic[start:start + len(chunk)] = chunk_ic.reshape(len(chunk), n_dates)
+
+            # 分位数收益,有样本的日期缺少的分位数收益记为0
+            codes = segment * n_quantiles + np.tile(quantile, len(chunk)) - 1
+            sums = np.bincount(codes, weights=ret[stacked_valid], minlength=n_segments * n_quantiles)
+            counts = np.bincount(codes, minlength=n_segments * n_quantiles)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(counts > 0, sums / counts, 0.0).reshape(len(chunk), n_dates, n_quantiles)
+            chunk_tmb = mean[:, :, -1] - mean[:, :, 0]
+            chunk_tmb[:, count == 0] = np.nan
+            tmb[start:start + len(chunk)] = chunk_tmb
+
+        res = []
+        for i, period in enumerate(periods):
+            # 只统计收益已实现的日期
+            observable = np.arange(n_dates) < n_dates - period
+            ic_stats = pfm.calc_ic_stats_table(pd.DataFrame({'ic': ic[i][observable]}))
+            period_tmb = pd.Series(tmb[i][observable]).dropna()
+            ic_stats['TMB Mean'] = period_tmb.mean()
+            ic_stats['TMB Std.'] = period_tmb.std()
+            ic_stats['TMB IR'] = period_tmb.mean() / period_tmb.std()
+            res.append(ic_stats)
+        res = pd.concat(res)
+        res.index = pd.Index(periods, name='period')
+        return res
@@ -0,0 +1,180 @@
+# encoding=utf-8
+# 参数优化结果的磁盘日志,用于断点续算和多个进程分担同一个参数空间
+
+import binascii
+import errno
+import hashlib
+import os
+import pickle
+import socket
+import tempfile
+import time
+
+import pandas as pd
+
+
+def frame_digest(df):
+    '''
+    :param df: dataFrame or None
+    :return: str 数据内容(含index和columns)的哈希值
+    '''
+    if df is None:
+        return None
+    sha = hashlib.sha1()
+    sha.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    sha.update(repr(list(df.columns)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def _is_local_alive(owner):
+    '''
+    :param owner: str 锁文件中记录的持有者,"主机名 进程号"
+    :return: 持有者为本机进程时返回其是否仍在运行,无法判断(其他主机或非posix系统)时为None
+    '''
+    if os.name != "posix":
+        return None
+    try:
+        host, pid = owner.rsplit(" ", 1)
+        pid = int(pid)
+    except ValueError:
+        return None
+    if host != socket.gethostname():
+        return None
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class ResultJournal(object):
+    '''
+    以目录保存的结果日志.每个结果保存为一个以key命名的文件,先写入临时文件再重命名,
+    进程中断时不会留下不完整的结果.计算前用claim以独占方式创建.lock文件,
+    多个进程共享同一个目录时同一个key只会由一个进程计算.
+    :param folder: str 日志目录,不存在时创建
+    :param stale_timeout: float (3600) 无法判断持有者是否仍在运行(其他主机或非posix系统)时,
+                          锁文件超过该秒数未完成视为持有者已中断,可被其他进程接管;
+                          本机上的持有者进程已退出时立即接管,仍在运行时不接管
+    '''
+
+    def __init__(self, folder, stale_timeout=3600):
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        self.folder = folder
+        self.stale_timeout = stale_timeout
+        self.owner = "%s %d" % (socket.gethostname(), os.getpid())
+
+    @staticmethod
+    def key(*config):
+        '''由任意可repr的配置生成key,配置中的dict按键排序'''
+        def normalize(obj):
+            if isinstance(obj, dict):
+                return sorted((repr(k), normalize(v)) for k, v in obj.items())
+            if isinstance(obj, (list, tuple)):
+                return [normalize(v) for v in obj]
+            return repr(obj)
+
+        return hashlib.sha1(repr(normalize(config)).encode("utf-8")).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.folder, key + suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key, ".pkl"))
+
+    def load(self, key):
+        '''
+        :return: (found, result) 尚未保存时found为False
+        '''
+        try:
+            with open(self._path(key, ".pkl"), "rb") as f:
+                return True, pickle.load(f)
+        except (IOError, OSError):
+            return False, None
+
+    def save(self, key, result):
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key, ".pkl"))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def claim(self, key):
+        '''
+        独占地获取key的计算权.
+        :return: bool 已由其他进程计算中时为False
+        '''
+        path = self._path(key, ".lock")
+        # 先写好持有者再以硬链接的方式创建锁文件,其他进程不会读到空的锁文件
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.folder)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.owner)
+            for _ in range(2):
+                try:
+                    os.link(tmp_path, path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    if not self._take_over(path):
+                        return False
+                    continue
+                return True
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def _is_stale(self, path):
+        with open(path) as f:
+            alive = _is_local_alive(f.read().strip())
+        if alive is not None:
+            return not alive
+        return time.time() - os.path.getmtime(path) > self.stale_timeout
+
+    def _take_over(self, path):
+        '''
+        移走过期的锁文件.先原子地重命名再删除,多个进程同时接管同一个锁时只有一个能移走.
+        :return: bool 是否可以重新创建锁文件
+        '''
+        try:
+            stat = os.stat(path)
+            if not self._is_stale(path):
+                return False
+        except (IOError, OSError):
+            # 锁已被释放
+            return True
+        moved = "%s.%s.%s" % (path, self.owner.replace(" ", "_"), binascii.hexlify(os.urandom(4)).decode())
+        try:
+            os.rename(path, moved)
+        except OSError:
+            # 已被其他进程移走
+            return True
+        try:
+            moved_stat = os.stat(moved)
+            if (moved_stat.st_ino, moved_stat.st_mtime) != (stat.st_ino, stat.st_mtime):
+                # 移走的是其他进程刚接管后创建的锁,放回原处
+                try:
+                    os.link(moved, path)
+                except OSError:
+                    pass
+                return False
+        finally:
+            os.remove(moved)
+        return True
+
+    def release(self, key):
+        try:
+            os.remove(self._path(key, ".lock"))
+        except OSError:
+            pass
@@ -0,0 +1,221 @@
+# encoding=utf-8
+# 实盘信号的在线IC与收益监控
+
+from collections import deque, OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.stats as scst
+
+import jaqs.util as jutil
+from .multi_factor import _segment_rank_ic
+
+
+class _RunningMoments(object):
+    """
+    增量更新的均值与二至四阶中心矩,每次并入一批样本(Welford/Pebay的合并公式),不保存样本本身
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+
+    def push(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        nb = len(values)
+        if nb == 0:
+            return
+        mean_b = values.mean()
+        dev = values - mean_b
+        m2_b = (dev ** 2).sum()
+        m3_b = (dev ** 3).sum()
+        m4_b = (dev ** 4).sum()
+
+        na = self.count
+        n = float(na + nb)
+        delta = mean_b - self.mean
+        self.m4 += m4_b + delta ** 4 * na * nb * (na * na - na * nb + nb * nb) / n ** 3 + \
+            6 * delta ** 2 * (na * na * m2_b + nb * nb * self.m2) / n ** 2 + \
+            4 * delta * (na * m3_b - nb * self.m3) / n
+        self.m3 += m3_b + delta ** 3 * na * nb * (na - nb) / n ** 2 + \
+            3 * delta * (na * m2_b - nb * self.m2) / n
+        self.m2 += m2_b + delta ** 2 * na * nb / n
+        self.mean += delta * nb / n
+        self.count = na + nb
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return np.nan
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    @property
+    def skew(self):
+        # 与scipy.stats.skew(bias=True)一致
+        if self.count == 0 or self.m2 == 0:
+            return np.nan
+        return np.sqrt(self.count) * self.m3 / self.m2 ** 1.5
+
+    @property
+    def kurtosis(self):
+        # 与scipy.stats.kurtosis(fisher=True, bias=True)一致
+        if self.count == 0 or self.m2 == 0:
+            return np.nan
+        return self.count * self.m4 / self.m2 ** 2 - 3
+
+
+class SignalMonitor(object):
+    """
+    逐日更新的信号监控,用于每天只新增一个截面的实盘信号.
+    收益的计算方式同SignalDigger.process_signal_before_analysis(forward=True):
+    T日使用T-1日的信号,以T日价格买入、T+period日价格卖出,扣除手续费,有基准时计算超额收益.
+    每次update传入当天的信号和价格,period个交易日前买入的截面在当天可以结算,结算后增量更新IC、分位数收益
+    和多空收益的统计量,只保存尚未结算的period个截面.
+    与批量计算的差别:卖出日不能卖出(can_exit为False)的股票不计入统计(批量计算中以之后第一个可卖出日的价格结算,
+    在线计算时尚不可知).
+    :param period: int (5) 持有期
+    :param n_quantiles: int (5) 分位数个数
+    :param commission: float (0.0008) 手续费率
+    """
+
+    def __init__(self, period=5, n_quantiles=5, commission=0.0008):
+        if not (period > 0 and isinstance(period, int)):
+            raise ValueError("period必须为正整数. 输入为: {}".format(period))
+        if not (n_quantiles > 0 and isinstance(n_quantiles, int)):
+            raise ValueError("n_quantiles必须为正整数. 输入为: {}".format(n_quantiles))
+        self.period = period
+        self.n_quantiles = n_quantiles
+        self.commission = commission
+
+        self._last_signal = None
+        self._last_price = None
+        self._last_benchmark_price = None
+        self._pending = deque()
+        self._ic = _RunningMoments()
+        self._quantile_ret = [_RunningMoments() for _ in range(n_quantiles)]
+        self._quantile_daily = [_RunningMoments() for _ in range(n_quantiles)]
+        self._spread = _RunningMoments()
+        self.last_settled = None
+
+    def update(self, date, signal, price, mask=None, can_enter=None, can_exit=None, benchmark_price=None):
+        """
+        传入新一个交易日的数据
+        :param date: 交易日
+        :param signal: 当日信号(pd.Series),index为股票代码,决定当日的股票池
+        :param price: 当日价格(pd.Series),index为股票代码
+        :param mask: 当日需要剔除的股票(pd.Series of bool),为空则不剔除
+        :param can_enter: 当日是否可以买入(pd.Series of bool),为空则全部可以买入
+        :param can_exit: 当日是否可以卖出(pd.Series of bool),为空则全部可以卖出
+        :param benchmark_price: float 当日基准价格,为空则计算绝对收益
+        :return: (trade_date, ic) 当日结算的截面的买入日期及其IC,尚无可结算的截面时为None
+        """
+        symbols = signal.index
+        if self._pending and (self._pending[0]["benchmark_price"] is None) != (benchmark_price is None):
+            raise ValueError("benchmark_price需要每日都提供或都不提供.")
+        # 同price2ret(pct_change),缺失的价格以最近的有效价格代替
+        price = price.astype(float)
+        if self._last_price is not None:
+            price = price.fillna(self._last_price.reindex(price.index))
+        self._last_price = price
+        if benchmark_price is not None:
+            if np.isnan(benchmark_price) and self._last_benchmark_price is not None:
+                benchmark_price = self._last_benchmark_price
+            self._last_benchmark_price = benchmark_price
+
+        settled = None
+        if len(self._pending) == self.period:
+            settled = self._settle(self._pending.popleft(), price, can_exit, benchmark_price)
+
+        # T日使用T-1日的信号
+        if self._last_signal is None:
+            values = np.full(len(symbols), np.nan)
+        else:
+            values = self._last_signal.reindex(symbols).values.astype(float)
+        invalid = np.isnan(values)
+        if mask is not None:
+            invalid |= mask.reindex(symbols).fillna(False).values.astype(bool)
+        if can_enter is not None:
+            invalid |= ~can_enter.reindex(symbols).fillna(False).values.astype(bool)
+        valid = ~invalid
+        if self.n_quantiles == 1:
+            quantile = np.ones(valid.sum())
+        else:
+            quantile = jutil.to_quantile(pd.DataFrame(values[valid][None, :]),
+                                         n_quantiles=self.n_quantiles).values[0]
+        self._pending.append({"trade_date": date,
+                              "symbols": symbols[valid],
+                              "signal": values[valid],
+                              "quantile": quantile.astype(int),
+                              "price": price.reindex(symbols[valid]).values.astype(float),
+                              "benchmark_price": benchmark_price})
+        self._last_signal = jutil.fillinf(signal.astype(float))
+        return settled
+
+    def _settle(self, entry, price, can_exit, benchmark_price):
+        symbols = entry["symbols"]
+        ret = price.reindex(symbols).values.astype(float) / entry["price"] - 1
+        if benchmark_price is not None:
+            ret -= benchmark_price / entry["benchmark_price"] - 1
+        ret[np.isinf(ret)] = np.nan
+        ret -= self.commission
+        # 同批量计算,无法计算收益的记为0
+        ret[np.isnan(ret)] = 0.0
+        keep = np.ones(len(symbols), dtype=bool)
+        if can_exit is not None:
+            keep = can_exit.reindex(symbols).fillna(False).values.astype(bool)
+        signal, quantile, ret = entry["signal"][keep], entry["quantile"][keep], ret[keep]
+
+        ic = _segment_rank_ic(signal[None, :], ret[None, :], np.ones((1, len(ret)), dtype=bool),
+                              np.zeros((1, len(ret)), dtype=int), 1)[0][0] if len(ret) else np.nan
+        if not np.isnan(ic):
+            self._ic.push(ic)
+        daily = np.full(self.n_quantiles, np.nan)
+        for q in range(self.n_quantiles):
+            ret_q = ret[quantile == q + 1]
+            if len(ret_q):
+                self._quantile_ret[q].push(ret_q)
+                daily[q] = ret_q.mean()
+                self._quantile_daily[q].push(daily[q])
+        if self.n_quantiles > 1 and not np.isnan(daily[[0, -1]]).any():
+            self._spread.push(daily[-1] - daily[0])
+        self.last_settled = entry["trade_date"]
+        return entry["trade_date"], ic
+
+    def ic_stats(self):
+        """
+        :return: 已结算截面的IC统计(pd.DataFrame),格式同performance.calc_ic_stats_table
+        """
+        moments = self._ic
+        t_stat = moments.mean / moments.std * np.sqrt(moments.count) if moments.count > 1 else np.nan
+        p_value = 2 * scst.t.sf(np.abs(t_stat), moments.count - 1) if moments.count > 1 else np.nan
+        stats = OrderedDict([("IC Mean", moments.mean if moments.count else np.nan),
+                             ("IC Std.", moments.std),
+                             ("t-stat(IC)", t_stat),
+                             ("p-value(IC)", p_value),
+                             ("IC Skew", moments.skew),
+                             ("IC Kurtosis", moments.kurtosis),
+                             ("Ann. IR", moments.mean / moments.std if moments.count > 1 else np.nan)])
+        return pd.DataFrame(stats, index=["ic"])
+
+    def quantile_stats(self):
+        """
+        :return: 各分位数全部样本收益的统计(pd.DataFrame),index为分位数,columns为mean/std/count,
+                 格式同performance.calc_quantile_return_mean_std
+        """
+        return pd.DataFrame([[m.mean if m.count else np.nan, m.std, m.count] for m in self._quantile_ret],
+                            index=pd.Index(np.arange(1, self.n_quantiles + 1), name="quantile"),
+                            columns=["mean", "std", "count"])
+
+    def spread_stats(self):
+        """
+        :return: 各分位数的每日平均收益及最高减最低分位数的多空收益的统计(pd.DataFrame),
+                 index为分位数和"top_bottom",columns为mean/std/IR/count
+        """
+        moments = self._quantile_daily + [self._spread]
+        index = list(range(1, self.n_quantiles + 1)) + ["top_bottom"]
+        data = [[m.mean if m.count else np.nan, m.std,
+                 m.mean / m.std if m.count > 1 else np.nan, m.count] for m in moments]
+        return pd.DataFrame(data, index=index, columns=["mean", "std", "IR", "count"])
@@ -1,20 +1,49 @@
 # encoding=utf-8
 from functools import reduce
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from . import process
 import pandas as pd
 import numpy as np
-from sklearn.covariance import LedoitWolf
 import jaqs.util as jutil
-from . import performance as pfm
 from . import SignalCreator
-import statsmodels.api as sm
+
+
+def _orthogonal_basis(x, mask, method="schmidt"):
+    """
+    批量计算每期因子暴露的正交基
+    :param x: np.array (D,N,K) 因子值,无效样本已置0
+    :param mask: np.array of bool (D,N) 参与正交化的样本
+    :param method: "schmidt"按因子顺序做施密特正交化(QR分解);"symmetric"为对称(Lowdin)正交化,与原因子整体距离最小且不依赖因子顺序
+    :return: np.array (D,N,K) 每列为单位长度的正交化因子,无效样本及因子共线的日期为nan
+    """
+    gram = np.einsum('dnk,dnl->dkl', x, x)
+    n_factors = x.shape[-1]
+    res = np.full(x.shape, np.nan)
+    lam, vec = np.linalg.eigh(gram)
+    # 样本数不足或因子共线时无法正交化
+    ok = (mask.sum(axis=1) >= n_factors) & (lam[:, 0] > lam[:, -1] * n_factors * np.finfo(float).eps * 100)
+    if not ok.any():
+        return res
+    x, mask, gram, lam, vec = x[ok], mask[ok], gram[ok], lam[ok], vec[ok]
+    if method == "schmidt":
+        # X = QR, R = L'为X'X的Cholesky分解, Q' = L^-1 X'
+        lower = np.linalg.cholesky(gram)
+        q = np.linalg.solve(lower, x.transpose(0, 2, 1)).transpose(0, 2, 1)
+    else:
+        # Q = X (X'X)^-1/2
+        inv_sqrt = np.einsum('dkl,dl,dml->dkm', vec, 1.0 / np.sqrt(lam), vec)
+        q = np.einsum('dnk,dkl->dnl', x, inv_sqrt)
+    res[ok] = np.where(mask[:, :, None], q, np.nan)
+    return res
 
 
 # 因子间存在较强同质性时，使用施密特正交化方法对因子做正交化处理，用得到的正交化残差作为因子
 def orthogonalize(factors_dict=None,
                   standardize_type="z_score",
                   winsorization=False,
-                  index_member=None):
+                  index_member=None,
+                  method="schmidt"):
     """
     # 因子间存在较强同质性时，使用施密特正交化方法对因子做正交化处理，用得到的正交化残差作为因子
     :param index_member:
@@ -22,24 +51,17 @@ def orthogonalize(factors_dict=None,
                          {"factor_name_1":factor_1,"factor_name_2":factor_2}
                        　每个因子值格式为一个pd.DataFrame，索引(index)为date,column为asset
     :param standardize_type: 标准化方法，有"rank"（排序标准化）,"z_score"(z-score标准化)两种（"rank"/"z_score"）
+    :param method: 正交化方法,有"schmidt"(按factors_dict的顺序依次对前面的因子取残差),
+                   "symmetric"(对称正交化,各因子地位相同)两种
     :return: factors_dict（new) 正交化处理后所得的一系列新因子。
     """
 
-    from scipy import linalg
-    from functools import partial
-
-    def Schmidt(data):
-        return linalg.orth(data)
-
-    def get_vector(date, factor):
-        return factor.loc[date]
-
     if not factors_dict or len(list(factors_dict.keys())) < 2:
         raise ValueError("你需要给定至少２个因子")
+    if method not in ["schmidt", "symmetric"]:
+        raise ValueError("不支持的正交化方法%s!支持的方法有schmidt, symmetric." % (method,))
 
-    new_factors_dict = {}  # 用于记录正交化后的因子值
     for factor_name in factors_dict.keys():
-        new_factors_dict[factor_name] = []
         # 处理非法值
         factors_dict[factor_name] = jutil.fillinf(factors_dict[factor_name])
         factors_dict[factor_name] = process._mask_non_index_member(factors_dict[factor_name],
@@ -49,25 +71,26 @@ def orthogonalize(factors_dict=None,
 
     factor_name_list = list(factors_dict.keys())
     factor_value_list = list(factors_dict.values())
-    # 施密特正交
-    for date in factor_value_list[0].index:
-        data = list(map(partial(get_vector, date), factor_value_list))
-        data = pd.concat(data, axis=1, join="inner")
-        data = data.dropna()
-        if len(data) == 0:
-            continue
-        data = pd.DataFrame(Schmidt(data), index=data.index)
-        data.columns = factor_name_list
-        for factor_name in factor_name_list:
-            row = pd.DataFrame(data[factor_name]).T
-            row.index = [date, ]
-            new_factors_dict[factor_name].append(row)
+    index, columns = factor_value_list[0].index, factor_value_list[0].columns
+    values = [f.reindex(index=index, columns=columns).values.astype(float) for f in factor_value_list]
+    mask = ~np.isnan(values[0])
+    for v in values[1:]:
+        mask &= ~np.isnan(v)
+
+    # 按日期分批正交化,结果直接写入预先分配的数组
+    n_dates, n_symbols = mask.shape
+    n_factors = len(values)
+    res = np.empty((n_dates, n_symbols, n_factors))
+    step = max(1, 4000000 // max(n_symbols * n_factors, 1))
+    for start in range(0, n_dates, step):
+        rows = slice(start, start + step)
+        x = np.stack([np.where(mask[rows], v[rows], 0.0) for v in values], axis=-1)
+        res[rows] = _orthogonal_basis(x, mask[rows], method)
 
     # 因子标准化
-    for factor_name in factor_name_list:
-        factor_value = pd.concat(new_factors_dict[factor_name])
-        # 恢复在正交化过程中剔除的行和列
-        factor_value = factor_value.reindex(index=factor_value_list[0].index,columns=factor_value_list[0].columns)
+    new_factors_dict = {}
+    for i, factor_name in enumerate(factor_name_list):
+        factor_value = pd.DataFrame(res[:, :, i], index=index, columns=columns)
         if standardize_type == "z_score":
             new_factors_dict[factor_name] = process.standardize(factor_value, index_member)
         else:
@@ -76,6 +99,50 @@ def orthogonalize(factors_dict=None,
     return new_factors_dict
 
 
+def _solve_gram(gram, moment):
+    """
+    批量求解最小二乘的正规方程 gram * beta = moment
+    :param gram: np.array (D,K,K) 每期的X'WX
+    :param moment: np.array (D,K) 每期的X'Wy
+    :return: np.array (D,K) 与pinv一致的最小范数解,因子共线或样本数少于因子数时剔除零特征值方向
+    """
+    lam, vec = np.linalg.eigh(gram)
+    tol = lam[:, -1:] * gram.shape[-1] * np.finfo(float).eps * 100
+    with np.errstate(divide='ignore'):
+        inv_lam = np.where(lam > tol, 1.0 / lam, 0.0)
+    proj = np.einsum('dkl,dk->dl', vec, moment) * inv_lam
+    return np.einsum('dkl,dl->dk', vec, proj)
+
+
+def _cross_section_regression(y, factors, valid, weights=None, chunk_size=4000000):
+    """
+    逐期(行)截面回归 y = X * beta,不含截距项,所有日期按批次向量化求解
+    :param y: np.array (D,N) 收益宽表
+    :param factors: list of np.array (D,N) 各因子宽表
+    :param valid: np.array of bool (D,N) 参与回归的样本
+    :param weights: np.array (D,N) 加权最小二乘的权重,为None时为普通最小二乘
+    :param chunk_size: int 每批参与计算的元素数(日期数×股票数×因子数)上限,用于控制内存占用
+    :return: (beta, count) beta为(D,K)的回归系数,无有效样本的日期为nan;count为每期样本数
+    """
+    n_dates, n_symbols = y.shape
+    n_factors = len(factors)
+    beta = np.full((n_dates, n_factors), np.nan)
+    count = valid.sum(axis=1)
+    step = max(1, int(chunk_size // max(n_symbols * n_factors, 1)))
+    for start in range(0, n_dates, step):
+        rows = slice(start, start + step)
+        mask = valid[rows]
+        # 无效样本置0,不影响X'WX和X'Wy
+        x = np.stack([np.where(mask, f[rows], 0.0) for f in factors], axis=-1)
+        ret = np.where(mask, y[rows], 0.0)
+        xw = x if weights is None else x * np.where(mask, weights[rows], 0.0)[:, :, None]
+        gram = np.einsum('dnk,dnl->dkl', xw, x)
+        moment = np.einsum('dnk,dn->dk', xw, ret)
+        beta[rows] = _solve_gram(gram, moment)
+    beta[count == 0] = np.nan
+    return beta, count
+
+
 # 获取多个因子收益序列矩阵
 def get_factors_ret_df(factors_dict,
                        price,
@@ -91,6 +158,7 @@ def get_factors_ret_df(factors_dict,
                        commission=0.0008,
                        forward=True,
                        ret_type="return",
+                       weights=None,
                        **kwargs):
     """
     获取多个因子收益序列矩阵
@@ -100,6 +168,8 @@ def get_factors_ret_df(factors_dict,
     :param quantiles: 根据因子大小将股票池划分的分位数量(int)
     :param price : 包含了pool中所有股票的价格时间序列(pd.Dataframe)，索引（index)为datetime,columns为各股票代码，与pool对应。
     :param benchmark_price:基准收益，不为空计算相对收益，否则计算绝对收益
+    :param weights: 加权最小二乘的权重(pd.Dataframe),如流通市值的平方根,格式同因子;
+                    与因子值一样移动日期以避免未来函数,权重缺失或不为正的样本不参与回归.为None时使用普通最小二乘
     :return: ret_df 多个因子收益序列矩阵
              类型pd.Dataframe,索引（index）为datetime,columns为各因子名称，与factors_dict中的对应。
              如：
@@ -113,19 +183,12 @@ def get_factors_ret_df(factors_dict,
             2016-06-30	0.039431	0.012271	0.037432	-0.027272	0.010902	0.077293	-0.050667
     """
 
-    def stack_td_symbol(df):
-        df = pd.DataFrame(df.stack(dropna=False))  # do not dropna
-        df.index.names = ['trade_date', 'symbol']
-        df.sort_index(axis=0, level=['trade_date', 'symbol'], inplace=True)
-        return df
-
-    def get_regression_result(df):
-        ret = df.pop("return")
-        if "group" in df.columns:
-            df = df.drop("group", axis=1)
-        ols_model = sm.OLS(ret, df)
-        regression_results = ols_model.fit()
-        return regression_results.params
+    def align(df):
+        df = jutil.fillinf(df)
+        df = df.shift(1)  # avoid forward-looking bias
+        if not forward:
+            df = df.shift(period)
+        return df.reindex(index=ret.index, columns=ret.columns).values.astype(float)
 
     if ret_type is None:
         ret_type = "return"
@@ -148,7 +211,8 @@ def get_factors_ret_df(factors_dict,
         commission=commission
     )
 
-    res = None
+    ret = None
+    factors = []
 
     # 获取factor_value的时间（index）,将用来生成 factors_ic_df 的对应时间（index）
     times = sorted(
@@ -161,32 +225,102 @@ def get_factors_ret_df(factors_dict,
         sc._cal_ret()
         if ret_type not in sc.signal_ret.keys():
             raise ValueError("无法计算%s收益,请重新设置输入参数." % (ret_type,))
-        if res is None:
-            res = stack_td_symbol(sc.signal_ret[ret_type]).fillna(0)
-            res.columns = ["return"]
-        signal = jutil.fillinf(signal)
-        signal = signal.shift(1)  # avoid forward-looking bias
-        if not forward:
-            signal = signal.shift(period)
-        res[factor_name] = stack_td_symbol(signal)
-
-    grouper = ['trade_date']
-    if group is not None:
-        res["group"] = stack_td_symbol(group)
-        grouper.append('group')
-
-    res = res.dropna()
-    result = res.groupby(grouper).apply(get_regression_result)
-
+        if ret is None:
+            ret = sc.signal_ret[ret_type].sort_index(axis=0).sort_index(axis=1).fillna(0)
+        factors.append(align(signal))
+
+    # 以宽表形式逐期回归,因子值缺失的样本不参与回归
+    y = ret.values.astype(float)
+    valid = ~np.isnan(y)
+    for f in factors:
+        valid &= ~np.isnan(f)
+    if weights is not None:
+        weights = align(weights)
+        with np.errstate(invalid='ignore'):
+            valid &= weights > 0
+
+    factor_names = list(factors_dict.keys())
+    dates = ret.index.copy()
+    dates.name = 'trade_date'
     if group is None:
+        beta, count = _cross_section_regression(y, factors, valid, weights)
+        result = pd.DataFrame(beta[count > 0], index=dates[count > 0], columns=factor_names)
         result = result.dropna(how="all").reindex(times)
     else:
-        result = result.dropna(how="all")
-        result = result.reindex(pd.MultiIndex.from_product([times, result.index.levels[1]],
+        group = group.reindex(index=ret.index, columns=ret.columns).values
+        valid &= ~pd.isnull(group)
+        labels = pd.Index(group[valid]).unique().sort_values()
+        table = []
+        for label in labels:
+            beta, count = _cross_section_regression(y, factors, valid & (group == label), weights)
+            table.append(pd.DataFrame(beta[count > 0],
+                                      index=pd.MultiIndex.from_arrays([dates[count > 0],
+                                                                       [label] * int((count > 0).sum())],
+                                                                      names=["trade_date", "group"]),
+                                      columns=factor_names))
+        result = pd.concat(table).sort_index().dropna(how="all")
+        result = result.reindex(pd.MultiIndex.from_product([times, labels],
                                                            names=["trade_date", "group"]))
     return result
 
 
+def _segment_rank(values, valid, codes):
+    """
+    宽表每个分段(同一日期、同一行业)内有效样本的平均排序,与scipy.stats.rankdata一致
+    :param values: np.array (D,N)
+    :param valid: np.array of bool (D,N)
+    :param codes: np.array of int (D,N) 样本所在分段的编号,按日期递增,同一日期内为日期编号*行业数+行业编号
+    :return: np.array 有效样本(按values[valid]的顺序)的排序
+    """
+    n_dates, n_symbols = values.shape
+    rows = np.arange(n_dates)[:, None]
+    # 逐日排序(nan排在最后),有行业时再按行业稳定排序
+    order = np.argsort(np.where(valid, values, np.nan), axis=1)
+    if (np.where(valid, codes, codes[:, :1]) != codes[:, :1]).any():
+        row_codes = np.where(valid, codes, codes.max() + 1)[rows, order]
+        order = order[rows, np.argsort(row_codes, axis=1, kind="mergesort")]
+    flat = (order + rows * n_symbols).ravel()
+    flat = flat[valid.ravel()[flat]]
+
+    sorted_values = values.ravel()[flat]
+    sorted_codes = codes.ravel()[flat]
+    n = len(flat)
+    run_start = np.ones(n, dtype=bool)
+    run_start[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_codes[1:] != sorted_codes[:-1])
+    run_id = np.cumsum(run_start) - 1
+    starts = np.flatnonzero(run_start)
+    ends = np.append(starts[1:], n)
+    count = np.bincount(sorted_codes)
+    segment_start = (np.cumsum(count) - count)[sorted_codes[starts]]
+    ranks = np.empty(values.size)
+    ranks[flat] = ((starts + ends - 1) / 2.0 - segment_start + 1)[run_id]
+    return ranks.reshape(values.shape)[valid]
+
+
+def _segment_rank_ic(signal, ret, valid, codes, n_segments):
+    """
+    每个分段(日期或日期×行业)内signal与ret的spearman相关系数
+    :param signal: np.array (D,N) 因子值
+    :param ret: np.array (D,N) 收益
+    :param valid: np.array of bool (D,N) 有效样本
+    :param codes: np.array of int (D,N) 样本所在分段的编号,见_segment_rank
+    :param n_segments: int 分段数
+    :return: (ic, count) 样本数不足2个或排序无差异的分段ic为nan
+    """
+    segment = codes[valid]
+    count = np.bincount(segment, minlength=n_segments)
+    center = (count[segment] + 1) / 2.0
+    dx = _segment_rank(signal, valid, codes) - center
+    dy = _segment_rank(ret, valid, codes) - center
+    sxy = np.bincount(segment, weights=dx * dy, minlength=n_segments)
+    sxx = np.bincount(segment, weights=dx * dx, minlength=n_segments)
+    syy = np.bincount(segment, weights=dy * dy, minlength=n_segments)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ic = sxy / np.sqrt(sxx * syy)
+    ic[(count < 2) | (sxx <= 0) | (syy <= 0)] = np.nan
+    return ic, count
+
+
 # 获取因子的ic序列
 def get_factors_ic_df(factors_dict,
                       price,
@@ -202,6 +336,7 @@ def get_factors_ic_df(factors_dict,
                       commission=0.0008,
                       forward=True,
                       ret_type="return",
+                      n_jobs=1,
                       **kwargs):
     """
     获取多个因子ic值序列矩阵
@@ -211,6 +346,7 @@ def get_factors_ic_df(factors_dict,
     :param quantiles: 根据因子大小将股票池划分的分位数量(int)
     :param price : 包含了pool中所有股票的价格时间序列(pd.Dataframe)，索引（index)为datetime,columns为各股票代码，与pool对应。
     :param benchmark_price:基准收益，不为空计算相对收益，否则计算绝对收益
+    :param n_jobs: 同时计算ic的线程数(int),-1表示使用全部cpu.收益和mask只计算一次,各因子只做移位、mask和排序
     :return: ic_df 多个因子ｉc值序列矩阵
              类型pd.Dataframe,索引（index）为datetime,columns为各因子名称，与factors_dict中的对应。
              如：
@@ -229,7 +365,6 @@ def get_factors_ic_df(factors_dict,
     if not (ret_type in ["return", "upside_ret", "downside_ret"]):
         raise ValueError("不支持对%s收益的ic计算!支持的收益类型有return, upside_ret, downside_ret." % (ret_type,))
 
-    ic_table = []
     sc = SignalCreator(
         price,
         high=high,
@@ -251,20 +386,54 @@ def get_factors_ic_df(factors_dict,
         factor_value = factors_dict[factor_name]
         if (not isinstance(factor_value, pd.DataFrame)) or (factor_value.size == 0):
             raise ValueError("因子%s为空或不合法!请确保传入因子有值且数据类型为pandas.DataFrame." % (factor_name,))
-        signal_data = sc.get_signal_data(factor_value)
-        if ret_type in signal_data.columns:
-            origin_fields = ["signal", ret_type]
-            new_fields = ["signal", "return"]
-            if group is not None:
-                origin_fields.append("group")
-                new_fields.append("group")
-            signal_data = signal_data[origin_fields]
-            signal_data.columns = new_fields
-            ic = pd.DataFrame(pfm.calc_signal_ic(signal_data, group is not None))
-            ic.columns = [factor_name, ]
-            ic_table.append(ic)
+        sc._judge(factor_value)
+    sc._cal_ret()
+    if sc.signal_ret.get(ret_type) is None:
+        raise ValueError("signal_data中不包含%s收益,无法进行ic计算!" % (ret_type,))
+
+    # 与SignalCreator.get_signal_data相同的收益和mask,所有因子共用
+    ret = sc.signal_ret[ret_type].fillna(0).values.astype(float)
+    base_mask = sc.mask.values.astype(bool)
+    dates = sc.signal_ret[ret_type].index
+    n_dates = len(dates)
+    if group is None:
+        labels = [None]
+        codes = np.repeat(np.arange(n_dates)[:, None], base_mask.shape[1], axis=1)
+    else:
+        group_values = group.values
+        base_mask = base_mask | pd.isnull(group_values)
+        labels, group_codes = np.unique(group_values[~base_mask], return_inverse=True)
+        codes = np.zeros(base_mask.shape, dtype=int)
+        codes[~base_mask] = group_codes
+        codes += np.arange(n_dates)[:, None] * len(labels)
+
+    def factor_ic(factor_name):
+        signal = jutil.fillinf(factors_dict[factor_name])
+        signal = signal.shift(1)  # avoid forward-looking bias
+        if not forward:
+            signal = signal.shift(period)
+        signal = signal.values.astype(float)
+        valid = ~(base_mask | np.isnan(signal))
+        ic, count = _segment_rank_ic(signal, ret, valid, codes, n_dates * len(labels))
+        segments = np.flatnonzero(count > 0)
+        if group is None:
+            index = dates[segments]
         else:
-            raise ValueError("signal_data中不包含%s收益,无法进行ic计算!" % (ret_type,))
+            index = pd.MultiIndex.from_arrays([dates[segments // len(labels)], labels[segments % len(labels)]],
+                                              names=["trade_date", "group"])
+        return pd.Series(ic[segments], index=index, name=factor_name)
+
+    names = list(factors_dict.keys())
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+    if n_jobs > 1 and len(names) > 1:
+        pool = ThreadPool(min(n_jobs, len(names)))
+        try:
+            ic_table = pool.map(factor_ic, names)
+        finally:
+            pool.close()
+    else:
+        ic_table = [factor_ic(name) for name in names]
 
     if group is None:
         ic_df = pd.concat(ic_table, axis=1).dropna(how="all").reindex(times)
@@ -275,6 +444,160 @@ def get_factors_ic_df(factors_dict,
     return ic_df
 
 
+def _shrink_covariance(cross, fourth, n):
+    """
+    批量计算Ledoit-Wolf压缩估计的协方差矩阵,与sklearn.covariance.LedoitWolf一致
+    :param cross: np.array (D,K,K) 每期中心化后的X'X
+    :param fourth: np.array (D,K,K) 每期中心化后的 sum_t x_i^2 * x_j^2
+    :param n: int or np.array (D,) 每期样本数
+    :return: np.array (D,K,K)
+    """
+    n = np.asarray(n, dtype=float)
+    p = cross.shape[-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        emp_cov = cross / n[..., None, None]
+        trace = np.trace(emp_cov, axis1=1, axis2=2)
+        mu = trace / p
+        delta_ = (emp_cov ** 2).sum(axis=(1, 2))
+        beta = (fourth.sum(axis=(1, 2)) / n - delta_) / (p * n)
+        delta = (delta_ - 2 * mu * trace + p * mu ** 2) / p
+        beta = np.minimum(beta, delta)
+        shrinkage = np.where(delta > 0, beta / delta, 0.0)
+    if p == 1:
+        shrinkage[:] = 0.0
+    return (1 - shrinkage)[:, None, None] * emp_cov + (shrinkage * mu)[:, None, None] * np.eye(p)
+
+
+class _RollingWindow(object):
+    """
+    时间序列上长度为n的滚动窗口统计量.以前缀和保存一阶、二阶(交叉)以及Ledoit-Wolf压缩系数所需的四阶矩,
+    每个窗口的统计量由前缀和相减得到,所有日期的结果一次算出.
+    :param df: 时间序列矩阵(pd.Dataframe),索引为已排序的datetime
+    :param n: 窗口长度(int),不足n期的日期结果为nan
+    """
+
+    def __init__(self, df, n):
+        values = df.values.astype(float)
+        self.n = n
+        self.n_dates, self.n_features = values.shape
+        self._isnan = np.isnan(values)
+        # 先减去全样本均值,降低前缀和相减的精度损失
+        with np.errstate(invalid='ignore'):
+            self.center = np.nanmean(values, axis=0) if len(values) else np.zeros(self.n_features)
+        self.center = np.where(np.isnan(self.center), 0.0, self.center)
+        self._x = np.where(self._isnan, 0.0, values - self.center)
+
+    def _window_sum(self, a):
+        # 返回以第n-1,...,T-1期结尾的窗口之和
+        cum = np.cumsum(a, axis=0)
+        res = cum[self.n - 1:].copy()
+        res[1:] -= cum[:-self.n]
+        return res
+
+    def _expand(self, a):
+        # 补齐窗口不足n期的日期
+        res = np.full((self.n_dates,) + a.shape[1:], np.nan)
+        if self.n_dates >= self.n:
+            res[self.n - 1:] = a
+        return res
+
+    def _empty(self, *shape):
+        return np.full((0,) + shape, np.nan)
+
+    def mean(self):
+        """各列的窗口均值,忽略nan"""
+        if self.n_dates < self.n:
+            return self._expand(self._empty(self.n_features))
+        count = self._window_sum(~self._isnan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res = self._window_sum(self._x) / count + self.center
+        return self._expand(res)
+
+    def std(self):
+        """各列的窗口标准差(ddof=1),忽略nan"""
+        if self.n_dates < self.n:
+            return self._expand(self._empty(self.n_features))
+        count = self._window_sum(~self._isnan).astype(float)
+        s1 = self._window_sum(self._x)
+        s2 = self._window_sum(self._x ** 2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = np.maximum(s2 - s1 ** 2 / count, 0) / (count - 1)
+        var[count < 2] = np.nan
+        return self._expand(np.sqrt(var))
+
+    def cov(self, covariance_type="shrink"):
+        """
+        窗口均值向量和协方差矩阵,窗口内有nan时结果为nan
+        :param covariance_type: "shrink"/"simple" Ledoit-Wolf压缩估计(与sklearn.covariance.LedoitWolf一致)或样本协方差(ddof=1)
+        :return: (mean, cov) 形状分别为(T,K),(T,K,K)
+        """
+        p = self.n_features
+        if self.n_dates < self.n:
+            return self._expand(self._empty(p)), self._expand(self._empty(p, p))
+        n = self.n
+        x = self._x
+        s1 = self._window_sum(x)
+        p11 = self._window_sum(x[:, :, None] * x[:, None, :])
+        m = s1 / n
+        # 以窗口均值中心化后的X'X
+        cross = p11 - n * m[:, :, None] * m[:, None, :]
+        if covariance_type == "shrink":
+            x2 = x ** 2
+            p21 = self._window_sum(x2[:, :, None] * x[:, None, :])
+            p22 = self._window_sum(x2[:, :, None] * x2[:, None, :])
+            s2 = np.diagonal(p11, axis1=1, axis2=2)
+            mi, mj = m[:, :, None], m[:, None, :]
+            # sum_t (x_i - m_i)^2 (x_j - m_j)^2 按原点矩展开
+            fourth = p22 - 2 * p21 * mj - 2 * p21.transpose(0, 2, 1) * mi \
+                + mj ** 2 * s2[:, :, None] + mi ** 2 * s2[:, None, :] + 4 * mi * mj * p11 \
+                - 2 * mi * mj ** 2 * s1[:, :, None] - 2 * mi ** 2 * mj * s1[:, None, :] + n * mi ** 2 * mj ** 2
+            cov = _shrink_covariance(cross, fourth, n)
+        else:
+            cov = cross / (n - 1)
+        incomplete = self._window_sum(self._isnan.any(axis=1)) > 0
+        m = m + self.center
+        m[incomplete] = np.nan
+        cov[incomplete] = np.nan
+        return self._expand(m), self._expand(cov)
+
+
+def _rolling_weight(df, holding_period, rollback_period, func):
+    """
+    :param func: func(_RollingWindow) -> np.array (T,K) 每期的原始权重
+    :return: weight_df 归一化(绝对值之和为1)并移动holding_period期后的权重
+    """
+    ordered = df.sort_index()
+    weight = _normalize_weight(func(_RollingWindow(ordered, rollback_period)))
+    weight_df = pd.DataFrame(weight, index=ordered.index, columns=df.columns).reindex(df.index)
+    return weight_df.shift(holding_period)
+
+
+def _normalize_weight(weight):
+    # 每期权重的绝对值之和为1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return weight / np.sum(np.abs(weight), axis=1, keepdims=True)
+
+
+def _solve_weight(mean, cov):
+    """
+    批量求解 cov * w = mean,含nan的日期结果为nan;
+    协方差矩阵奇异的日期改用最小二乘(伪逆)求解
+    """
+    res = np.full(mean.shape, np.nan)
+    ok = ~(np.isnan(mean).any(axis=1) | np.isnan(cov).any(axis=(1, 2)))
+    if not ok.any():
+        return res
+    try:
+        res[ok] = np.linalg.solve(cov[ok], mean[ok][:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        for i in np.flatnonzero(ok):
+            try:
+                res[i] = np.linalg.solve(cov[i], mean[i])
+            except np.linalg.LinAlgError:
+                res[i] = np.linalg.lstsq(cov[i], mean[i], rcond=None)[0]
+    return res
+
+
 # 根据样本协方差矩阵估算结果求最大化IC_IR下的多因子组合权重
 def max_IR_weight(ic_df,
                   holding_period,
@@ -301,26 +624,8 @@ def max_IR_weight(ic_df,
     """
     # 最大化t-n ~ t天的ic_ir,用到了截止到t+period的数据（算收益）,
     # 算得的权重用于t+period的因子进行加权
-    n = rollback_period
-    weight_df = pd.DataFrame(index=ic_df.index, columns=ic_df.columns)
-    lw = LedoitWolf()
-    for dt in ic_df.index:
-        ic_dt = ic_df[ic_df.index <= dt].tail(n)
-        if len(ic_dt) < n:
-            continue
-        if covariance_type == "shrink":
-            try:
-                ic_cov_mat = lw.fit(ic_dt.as_matrix()).covariance_
-            except:
-                ic_cov_mat = np.mat(np.cov(ic_dt.T.as_matrix()).astype(float))
-        else:
-            ic_cov_mat = np.mat(np.cov(ic_dt.T.as_matrix()).astype(float))
-        inv_ic_cov_mat = np.linalg.inv(ic_cov_mat)
-        weight = inv_ic_cov_mat * np.mat(ic_dt.mean().values).reshape(len(inv_ic_cov_mat), 1)
-        weight = np.array(weight.reshape(len(weight), ))[0]
-        weight_df.ix[dt] = weight / np.sum(np.abs(weight))
-
-    return weight_df.shift(holding_period)
+    return _rolling_weight(ic_df, holding_period, rollback_period,
+                           lambda window: _solve_weight(*window.cov(covariance_type)))
 
 
 # 根据样本协方差矩阵估算结果求最大化单期IC下的多因子组合权重
@@ -349,26 +654,41 @@ def max_IC_weight(ic_df,
     :return: weight_df:使用Sample协方差矩阵估算方法得到的因子权重(pd.Dataframe),
              索引（index)为datetime,columns为待合成的因子名称。
     """
-    weight_df = pd.DataFrame(index=ic_df.index, columns=ic_df.columns)
-    lw = LedoitWolf()
     # 最大化第t天的ic,用到了截止到t+period的数据（算收益）,
     # 算得的权重用于t+period的因子进行加权
-    for dt in ic_df.index:
-        f_dt = pd.concat([factors_dict[factor_name].loc[dt] for factor_name in ic_df.columns], axis=1).dropna()
-        if len(f_dt) == 0:
-            continue
+    factors = [factors_dict[factor_name] for factor_name in ic_df.columns]
+    columns = reduce(lambda x, y: x.union(y), [f.columns for f in factors])
+    values = [f.reindex(index=ic_df.index, columns=columns).values.astype(float) for f in factors]
+    mask = ~np.isnan(values[0])
+    for v in values[1:]:
+        mask &= ~np.isnan(v)
+
+    # 按日期分批计算截面协方差矩阵
+    n_dates, n_symbols = mask.shape
+    n_factors = len(values)
+    cov = np.empty((n_dates, n_factors, n_factors))
+    step = max(1, 4000000 // max(n_symbols * n_factors, 1))
+    for start in range(0, n_dates, step):
+        rows = slice(start, start + step)
+        m = mask[rows]
+        count = m.sum(axis=1)
+        x = np.stack([np.where(m, v[rows], 0.0) for v in values], axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = x.sum(axis=1) / count[:, None]
+        x = np.where(m[:, :, None], x - mean[:, None, :], 0.0)
+        cross = np.matmul(x.transpose(0, 2, 1), x)
         if covariance_type == "shrink":
-            try:
-                f_cov_mat = lw.fit(f_dt.as_matrix()).covariance_
-            except:
-                f_cov_mat = np.mat(np.cov(f_dt.T.as_matrix()).astype(float))
+            x2 = x ** 2
+            fourth = np.matmul(x2.transpose(0, 2, 1), x2)
+            cov[rows] = _shrink_covariance(cross, fourth, count)
         else:
-            f_cov_mat = np.mat(np.cov(f_dt.T.as_matrix()).astype(float))
-        inv_f_cov_mat = np.linalg.inv(f_cov_mat)
-        weight = inv_f_cov_mat * np.mat(ic_df.loc[dt].values).reshape(len(inv_f_cov_mat), 1)
-        weight = np.array(weight.reshape(len(weight), ))[0]
-        weight_df.ix[dt] = weight / np.sum(np.abs(weight))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cov[rows] = cross / (count - 1)[:, None, None]
+        # 样本不足以估计协方差的日期
+        cov[rows][count < 2] = np.nan
 
+    weight = _normalize_weight(_solve_weight(ic_df.values.astype(float), cov))
+    weight_df = pd.DataFrame(weight, index=ic_df.index, columns=ic_df.columns)
     return weight_df.shift(holding_period)
 
 
@@ -396,17 +716,7 @@ def ic_weight(ic_df,
     """
     # t-n ~ t天的ic,用到了截止到t+period的数据（算收益）,
     # 算得的权重用于t+period的因子进行加权
-    n = rollback_period
-    weight_df = pd.DataFrame(index=ic_df.index, columns=ic_df.columns)
-    for dt in ic_df.index:
-        ic_dt = ic_df[ic_df.index <= dt].tail(n)
-        if len(ic_dt) < n:
-            continue
-        weight = ic_dt.mean(axis=0)
-        weight = np.array(weight.reshape(len(weight), ))
-        weight_df.ix[dt] = weight / np.sum(np.abs(weight))
-
-    return weight_df.shift(holding_period)
+    return _rolling_weight(ic_df, holding_period, rollback_period, lambda window: window.mean())
 
 
 # 以因子收益为多因子组合权重
@@ -433,17 +743,7 @@ def factors_ret_weight(factors_ret_df,
     """
     # t-n ~ t天的因子收益,用到了截止到t+period的数据（算收益）,
     # 算得的权重用于t+period的因子进行加权
-    n = rollback_period
-    weight_df = pd.DataFrame(index=factors_ret_df.index, columns=factors_ret_df.columns)
-    for dt in factors_ret_df.index:
-        ret_dt = factors_ret_df[factors_ret_df.index <= dt].tail(n)
-        if len(ret_dt) < n:
-            continue
-        weight = ret_dt.mean(axis=0)
-        weight = np.array(weight.reshape(len(weight), ))
-        weight_df.ix[dt] = weight / np.sum(np.abs(weight))
-
-    return weight_df.shift(holding_period)
+    return _rolling_weight(factors_ret_df, holding_period, rollback_period, lambda window: window.mean())
 
 
 # 以IC_IR为多因子组合权重
@@ -470,17 +770,52 @@ def ir_weight(ic_df,
     """
     # t-n ~ t天的ic_ir,用到了截止到t+period的数据（算收益）,
     # 算得的权重用于t+period的因子进行加权
-    n = rollback_period
-    weight_df = pd.DataFrame(index=ic_df.index, columns=ic_df.columns)
-    for dt in ic_df.index:
-        ic_dt = ic_df[ic_df.index <= dt].tail(n)
-        if len(ic_dt) < n:
-            continue
-        weight = ic_dt.mean(axis=0) / ic_dt.std(axis=0)
-        weight = np.array(weight.reshape(len(weight), ))
-        weight_df.ix[dt] = weight / np.sum(np.abs(weight))
+    return _rolling_weight(ic_df, holding_period, rollback_period, lambda window: window.mean() / window.std())
 
-    return weight_df.shift(holding_period)
+
+def _weighted_sum(factors, weight=None, index=None, columns=None):
+    """
+    按因子逐个累加到同一个数组中,每期权重按行广播,不为每个因子生成权重宽表
+    :param factors: 若干因子组成的字典(dict),形式为{"factor_name_1":factor_1,"factor_name_2":factor_2},
+                    或依次产生(factor_name, factor)的可迭代对象,factor可以为返回因子的函数,
+                    此时因子在累加前才读取、累加后即可释放,同一时间只有一个因子驻留内存
+    :param weight: 因子权重(pd.Dataframe),索引为datetime,columns为因子名称.为None时等权相加
+    :param index: 结果的索引.为None时,factors为字典则取各因子索引的并集,否则取第一个因子的索引
+    :param columns: 结果的columns.为None时,factors为字典则取各因子columns的并集,否则取第一个因子的columns
+    :return: pd.DataFrame 任一因子缺失的位置为nan
+    """
+    if isinstance(factors, dict):
+        frames = [f for f in factors.values() if isinstance(f, pd.DataFrame)]
+        if frames:
+            if index is None:
+                index = reduce(lambda x, y: x.union(y), [f.index for f in frames[1:]], frames[0].index)
+            if columns is None:
+                columns = reduce(lambda x, y: x.union(y), [f.columns for f in frames[1:]], frames[0].columns)
+        factors = factors.items()
+    res = buf = None
+    for factor_name, factor in factors:
+        if callable(factor):
+            factor = factor()
+        if res is None:
+            index = factor.index if index is None else index
+            columns = factor.columns if columns is None else columns
+            res = np.zeros((len(index), len(columns)))
+            buf = None if weight is None else np.empty_like(res)
+        if factor.index.equals(index) and factor.columns.equals(columns):
+            values = factor.values
+        else:
+            values = factor.reindex(index=index, columns=columns).values
+        if weight is None:
+            res += values
+        else:
+            w = weight[factor_name].reindex(index).values.astype(float)
+            np.multiply(values, w[:, None], out=buf)
+            res += buf
+        # 释放当前因子后再读取下一个
+        factor = values = None
+    if res is None:
+        raise ValueError("你需要给定至少1个因子")
+    return pd.DataFrame(res, index=index, columns=columns)
 
 
 def combine_factors(factors_dict=None,
@@ -601,26 +936,15 @@ def combine_factors(factors_dict=None,
                                      _props['period'],
                                      _props["covariance_type"])
 
-    def sum_weighted_factors(x, y):
-        return x + y
-
     if not factors_dict or len(list(factors_dict.keys())) < 2:
         raise ValueError("你需要给定至少2个因子")
     factors_dict = standarize_factors(factors_dict)
 
     if weighted_method in ["max_IR", "max_IC", "ic_weight", "ir_weight", "factors_ret_weight"]:
-        weight = _cal_weight(weighted_method)
-        weighted_factors = {}
-        factor_name_list = factors_dict.keys()
-        for factor_name in factor_name_list:
-            w = pd.DataFrame(data=weight[factor_name], index=factors_dict[factor_name].index)
-            w = pd.concat([w] * len(factors_dict[factor_name].columns), axis=1)
-            w.columns = factors_dict[factor_name].columns
-            weighted_factors[factor_name] = factors_dict[factor_name] * w
+        new_factor = _weighted_sum(factors_dict, _cal_weight(weighted_method))
     elif weighted_method == "equal_weight":
-        weighted_factors = factors_dict
+        new_factor = _weighted_sum(factors_dict)
     else:
         raise ValueError('weighted_method 只能为equal_weight, ic_weight, ir_weight, max_IR, max_IC, factors_ret_weight')
-    new_factor = reduce(sum_weighted_factors, weighted_factors.values())
     new_factor = standarize_factors(new_factor)["factor"]
     return new_factor
@@ -2,12 +2,26 @@
 # 参数优化器
 
 
-from itertools import product
-from .analysis import analysis
-from .signal_creator import SignalCreator
+import os
+import shutil
+import tempfile
+import time
 import warnings
+import weakref
+from collections import OrderedDict
+from itertools import product
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
 import pandas as pd
 
+from jaqs_fxdayu.data.py_expression_eval import Parser
+from .analysis import analysis, AnalysisEngine
+from .journal import ResultJournal, frame_digest
+from .search import SearchStrategy, strategies as search_strategies
+from .signal_creator import SignalCreator
+from .signal_store import SignalStore
+
 target_types = {
     'factor': {
         "ic": [
@@ -47,6 +61,8 @@ target_types = {
     }
 }
 
+storages = ["full", "perf", "float32", "disk"]
+
 targets = {
     "ic": ["IC Mean", "IC Std.", "t-stat(IC)", "p-value(IC)", "IC Skew", "IC Kurtosis", "Ann. IR"],
     "ret": ['t-stat', "p-value", "skewness", "kurtosis", "Ann. Ret", "Ann. Vol", "Ann. IR", "occurance"],
@@ -73,6 +89,166 @@ targets = {
 }
 
 
+def signal_perf(signal_data, is_event, period, in_sample_range=None, target_types=None):
+    '''
+    :param signal_data: SignalCreator.get_signal_data的结果
+    :param is_event: bool 是否是事件(0/1因子)
+    :param period: int 选股持有期
+    :param in_sample_range: like [20100312,20170405] 样本内范围起止时间
+    :param target_types: list (N) 只计算这些目标种类的绩效,为空时计算全部绩效
+    :return: analysis的结果,无可用信号时为None
+    '''
+    perf = None
+    if signal_data is not None:
+        if in_sample_range is not None:
+            signal_data = signal_data.loc[in_sample_range[0]:in_sample_range[1]]
+        if len(signal_data) > 0:
+            perf = analysis(signal_data, is_event, period, target_types=target_types)
+    return perf
+
+
+def _target_value(perf, order_index, target_type, target):
+    # 绩效中优化目标的取值,无法计算时为nan
+    try:
+        return float(perf[order_index].loc[target, target_type])
+    except (KeyError, AttributeError, TypeError):
+        return np.nan
+
+
+# 并行优化时子进程共享的数据,由_init_sweep_worker在子进程启动时加载
+_sweep_context = dict()
+
+
+def _dump_frame(df, folder, name):
+    # 数值型数据存为.npy,子进程以memmap方式读取,避免逐个任务序列化
+    if df is None or df.values.dtype == object:
+        return df
+    path = os.path.join(folder, name + ".npy")
+    np.save(path, df.values)
+    return path, df.index, df.columns
+
+
+def _load_frame(spec):
+    if spec is None or isinstance(spec, pd.DataFrame):
+        return spec
+    path, index, columns = spec
+    return pd.DataFrame(np.load(path, mmap_mode='c'), index=index, columns=columns)
+
+
+def _init_sweep_worker(context):
+    _sweep_context.clear()
+    _sweep_context.update(context)
+    parser = Parser()
+    parser.set_capital(context["formula_func_name_style"])
+    template = parser.parse_template(context["formula"], context["params"])
+    template.bind({var: _load_frame(spec) for var, spec in context["values"].items()},
+                  ann_dts=_load_frame(context["ann_dts"]),
+                  trade_dts=context["trade_dts"],
+                  index_member=_load_frame(context["index_member"]))
+    _sweep_context["template"] = template
+
+
+def _sweep_worker(task):
+    sig_name, para_dict = task
+    ctx = _sweep_context
+    df_eval = ctx["template"].evaluate(para_dict)
+    signal = df_eval.loc[ctx["start_date"]:ctx["end_date"]] if isinstance(df_eval, pd.DataFrame) else None
+    if (signal is None) or (signal.size == 0):
+        warnings.warn("待优化公式%s(参数%s)不能计算出有效结果,请检查数据和公式是否正确完备!" % (ctx["formula"], para_dict))
+        return sig_name, None
+    signal_data = ctx["signal_creator"].get_signal_data(signal)
+    return sig_name, signal_perf(signal_data, ctx["is_event"], ctx["period"],
+                                 ctx["in_sample_range"], ctx["target_types"])
+
+
+class _PerfRunner(object):
+    '''
+    逐批计算参数组合的信号绩效.第一个参数组合在主进程计算,同时准备好所需字段,并缓存signal_creator的收益计算结果.
+    n_jobs不为1时其余参数组合使用多进程计算,公式所需的数据只在进程启动时以memmap方式传递一次,子进程只返回绩效结果.
+    进程池在第一次需要时创建,可用于多批参数组合,close时关闭.
+    :param optimizer: Optimizer
+    :param n_jobs: int 进程数,-1表示使用全部cpu
+    :param n_tasks: int 参数组合总数
+    '''
+
+    def __init__(self, optimizer, in_sample_range, target_types, n_jobs, n_tasks):
+        if n_jobs < 0:
+            n_jobs = cpu_count()
+        self.optimizer = optimizer
+        self.in_sample_range = in_sample_range
+        self.target_types = target_types
+        self.n_processes = 1 if optimizer.is_quarterly else max(min(n_jobs, n_tasks - 1), 1)
+        self._started = False
+        self._pool = None
+        self._folder = None
+
+    def run(self, tasks):
+        '''
+        :param tasks: list of (sig_name, para_dict)
+        :return: iterator of (sig_name, perf),与tasks顺序一致
+        '''
+        opt = self.optimizer
+        tasks = list(tasks)
+        if not self._started and len(tasks) > 0:
+            self._started = True
+            sig_name, para_dict = tasks.pop(0)
+            yield sig_name, opt._param_perf(para_dict, self.in_sample_range, self.target_types)
+        if len(tasks) == 0:
+            return
+        if self.n_processes == 1:
+            for sig_name, para_dict in tasks:
+                yield sig_name, opt._param_perf(para_dict, self.in_sample_range, self.target_types)
+            return
+        if self._pool is None:
+            self._start_pool()
+        # 每个进程分到连续的参数组合,以复用子公式的计算结果
+        chunksize = -(-len(tasks) // self.n_processes)
+        for result in self._pool.imap(_sweep_worker, tasks, chunksize=chunksize):
+            yield result
+
+    def _start_pool(self):
+        opt = self.optimizer
+        dv = opt.dataview
+        parser = Parser()
+        parser.set_capital('camel')
+        var_list = parser.parse_template(opt.formula, list(opt.params.keys())).variables()
+        self._folder = folder = tempfile.mkdtemp()
+        df_index_member = dv.get_ts('index_member', start_date=dv.extended_start_date_d, end_date=dv.end_date)
+        if df_index_member.size == 0:
+            df_index_member = None
+        context = {
+            "values": {var: _dump_frame(dv.get_ts(var,
+                                                  start_date=dv.extended_start_date_d,
+                                                  end_date=dv.end_date), folder, "var%d" % i)
+                       for i, var in enumerate(var_list)},
+            "ann_dts": _dump_frame(dv._get_ann_df(), folder, "ann_dts"),
+            "index_member": _dump_frame(df_index_member, folder, "index_member"),
+            "trade_dts": dv.dates,
+            "start_date": dv.start_date,
+            "end_date": dv.end_date,
+            "formula": opt.formula,
+            "params": list(opt.params.keys()),
+            "formula_func_name_style": 'camel',
+            "signal_creator": opt.signal_creator,
+            "is_event": opt.is_event,
+            "period": opt.period,
+            "in_sample_range": self.in_sample_range,
+            "target_types": self.target_types,
+        }
+        self._pool = Pool(processes=self.n_processes,
+                          initializer=_init_sweep_worker,
+                          initargs=(context,))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._folder is not None:
+            shutil.rmtree(self._folder, ignore_errors=True)
+            self._folder = None
+
+
 class Optimizer(object):
     '''
     :param dataview: 包含了计算公式所需要的所有数据的jaqs.data.DataView对象
@@ -93,6 +269,17 @@ class Optimizer(object):
     :param commission:　float(0.0008) 手续费率
     :param is_event: bool(False) 是否是事件(0/1因子)
     :param is_quarterly: bool(False) 是否是季度因子
+    :param storage: str ("full") all_signals的保存方式:
+                    "full" 在内存中保存每个参数组合完整的signal_data;
+                    "perf" 只保存绩效,不保存all_signals;
+                    "float32" 以float32宽表的形式在内存中紧凑保存,信号值会损失精度;
+                    "disk" 以宽表的形式保存到磁盘,访问某个参数组合时再以memmap方式读取
+    :param storage_dir: str (N) storage为"disk"时保存数据的目录,为空时使用系统临时目录.数据在对象释放时删除
+    :param journal: str (N) 结果日志目录.不为空时get_all_signals_perf逐个参数组合计算绩效(不保存all_signals),
+                    每个结果按(公式,参数取值,in_sample_range,target_types,SignalCreator配置)写入日志,
+                    重新运行时跳过已完成的参数组合;多个进程使用同一个目录时自动分担参数空间
+    :param journal_timeout: float (3600) 日志中的参数组合被其他主机上的进程领取后超过该秒数仍未完成时,
+                            视为计算进程已中断,可重新计算;本机上的计算进程已退出时立即重新计算
     '''
 
     def __init__(self,
@@ -114,7 +301,13 @@ class Optimizer(object):
                  commission=0.0008,
                  is_event=False,
                  is_quarterly=False,
+                 storage="full",
+                 storage_dir=None,
+                 journal=None,
+                 journal_timeout=3600,
                  ):
+        if storage not in storages:
+            raise ValueError("storage可选的选项仅能从%s选取,输入为%s" % (str(storages), storage))
         self.dataview = dataview
         self.formula = formula
         self.params = params
@@ -131,6 +324,8 @@ class Optimizer(object):
             n_quantiles = 1
         self.is_event = is_event
         self.is_quarterly = is_quarterly
+        self.storage = storage
+        self.storage_dir = storage_dir
         self.signal_creator = SignalCreator(
             price=price,
             ret=ret,
@@ -145,9 +340,16 @@ class Optimizer(object):
             forward=forward,
             commission=commission
         )
+        self.journal = journal
+        self.journal_timeout = journal_timeout
+        self.journal_poll = 1.0
+        self._journal_creator = self._creator_config() if journal is not None else None
         self.all_signals = None
         self.all_signals_perf = None
+        self._engines = dict()
+        self._formula_template = None
         self.in_sample_range = None
+        self.perf_target_types = None
 
     # 判断参数命名的规范性
     def _judge_params(self):
@@ -205,62 +407,427 @@ class Optimizer(object):
                             target_type="long_ret",
                             target="Ann. IR",
                             ascending=False,
-                            in_sample_range=None):
+                            in_sample_range=None,
+                            top_k=None,
+                            n_jobs=1):
         '''
         :param target_type: 目标种类
         :param target: 优化目标
         :param ascending: bool(False)升序or降序排列
         :param in_sample_range: [date_start(int),date_end(int)] (N) 定义样本内优化范围.
+        :param top_k: int (N) 只返回排名前top_k的结果.不为空时排序阶段只计算target_type对应的绩效,
+                      仅对前top_k个结果计算完整绩效;为空时对所有参数组合计算完整绩效
+        :param n_jobs: int (1) 并行计算的进程数,-1表示使用全部cpu,见get_all_signals_perf
         :return:
         '''
 
         if self._judge_target(target_type, target):  # 判断target合法性
-            self.get_all_signals_perf(in_sample_range)
+            perf_target_types = None if top_k is None else [target_type]
+            self.get_all_signals_perf(in_sample_range, perf_target_types, n_jobs=n_jobs)
             if len(self.all_signals_perf) == 0:
                 return []
-            if target_type in (target_types["factor"]["ic"]):
-                order_index = "ic"
-            elif target_type in (target_types["factor"]["ret"]):
-                order_index = "ret"
+            order_index = self._order_index(target_type)
+            ordered_perf = sorted(self.all_signals_perf.values(),
+                                  key=lambda x: x[order_index].loc[target, target_type],
+                                  reverse=(ascending == False))
+            if top_k is None:
+                return ordered_perf
+            if self.perf_target_types is None:
+                return ordered_perf[:top_k]
+            top_names = [perf["signal_name"] for perf in ordered_perf[:top_k]]
+            if self.all_signals is not None:
+                top_perf = [(sig_name, self._stored_signal_perf(sig_name, in_sample_range))
+                            for sig_name in top_names]
             else:
-                order_index = "space"
-            ordered_perf = self.all_signals_perf.values()
-            return sorted(ordered_perf,
-                          key=lambda x: x[order_index].loc[target, target_type],
-                          reverse=(ascending == False))
+                param_grid = self._param_grid()
+                top_perf = self._params_perf([(sig_name, param_grid[sig_name]) for sig_name in top_names],
+                                             in_sample_range, None, n_jobs)
+            result = []
+            for sig_name, perf in top_perf:
+                perf["signal_name"] = sig_name
+                result.append(perf)
+            return result
         return []
 
+    @staticmethod
+    def _order_index(target_type):
+        if target_type in (target_types["factor"]["ic"]):
+            return "ic"
+        elif target_type in (target_types["factor"]["ret"]):
+            return "ret"
+        return "space"
+
+    def search_optimizer(self,
+                         target_type="long_ret",
+                         target="Ann. IR",
+                         ascending=False,
+                         in_sample_range=None,
+                         strategy="random",
+                         budget=50,
+                         top_k=None,
+                         seed=None,
+                         **kwargs):
+        '''
+        按搜索策略在固定的评估次数内寻找较优的参数组合,用于参数组合过多、无法穷举的情况.
+        搜索阶段只计算target_type对应的绩效,最后对返回的结果计算完整绩效.
+        :param target_type: 目标种类
+        :param target: 优化目标
+        :param ascending: bool(False)升序or降序排列
+        :param in_sample_range: [date_start(int),date_end(int)] (N) 定义样本内优化范围.
+        :param strategy: str or SearchStrategy ("random") 搜索策略,可选"random"(随机搜索),
+                         "halving"(逐次减半,先在较短的样本内日期上评估,再把较优的组合放到完整范围上评估),
+                         "bayes"(基于高斯过程的序贯模型搜索),也可以传入SearchStrategy的实例
+        :param budget: int (50) 计算信号绩效的次数上限
+        :param top_k: int (N) 只返回排名前top_k的结果
+        :param seed: int (N) 随机数种子
+        :param kwargs: 搜索策略的其他参数,如"halving"的eta,min_fraction,"bayes"的n_init
+        :return: 在完整样本内范围上评估过的参数组合的绩效,按优化目标排序
+        '''
+        if not self._judge_target(target_type, target):  # 判断target合法性
+            return []
+        if isinstance(strategy, SearchStrategy):
+            searcher = strategy
+        elif strategy in search_strategies:
+            searcher = search_strategies[strategy](budget=budget, seed=seed, **kwargs)
+        else:
+            raise ValueError("可选的搜索策略仅能从%s选取,或传入SearchStrategy的实例" % (str(sorted(search_strategies.keys())),))
+        order_index = self._order_index(target_type)
+        # storage为"perf"时不保存信号,每次评估重新计算
+        all_signals = self._new_signal_store()
+
+        def get_signal_data(para_dict):
+            sig_name = self.name + str(dict(para_dict))
+            if all_signals is not None and sig_name in all_signals:
+                return all_signals[sig_name]
+            signal_data = self._signal_data(dict(para_dict))
+            if all_signals is not None:
+                all_signals[sig_name] = signal_data
+            return signal_data
+
+        def evaluate(para_dict, fraction=1.0):
+            signal_data = get_signal_data(para_dict)
+            date_range = in_sample_range if fraction >= 1 else self._head_range(signal_data, in_sample_range, fraction)
+            perf = self.cal_perf(signal_data, date_range, target_types=[target_type])
+            score = _target_value(perf, order_index, target_type, target)
+            return -score if ascending else score
+
+        space = OrderedDict((key, self.params[key]) for key in self.params.keys())
+        evaluated = [(para_dict, score) for para_dict, score in searcher.search(space, evaluate)
+                     if not np.isnan(score)]
+        evaluated = sorted(evaluated, key=lambda x: x[1], reverse=True)
+        if top_k is not None:
+            evaluated = evaluated[:top_k]
+        result = []
+        for para_dict, _ in evaluated:
+            perf = self.cal_perf(get_signal_data(para_dict), in_sample_range)
+            perf["signal_name"] = self.name + str(dict(para_dict))
+            result.append(perf)
+        if len(result) == 0:
+            print("没有计算出可用的信号绩效，请确保至少有一个信号可用.(可尝试增加样本内数据的时间范围以确保有信号发生)")
+        return result
+
+    def walk_forward_optimizer(self,
+                               windows,
+                               target_type="long_ret",
+                               target="Ann. IR",
+                               ascending=False):
+        '''
+        滚动窗口优化:在每个窗口的样本内范围上选出最优的参数组合,并给出其在样本外范围上的绩效.
+        每个参数组合的信号只在全部日期上计算一次,各窗口的绩效由AnalysisEngine.window从逐日的IC、收益等结果中
+        按日期截取后计算,不对截取后的signal_data重新调用analysis.
+        :param windows: list of (in_sample_range, out_sample_range),
+                        如[([20150101,20151231],[20160101,20160331]),([20150401,20160331],[20160401,20160630])]
+        :param target_type: 目标种类
+        :param target: 优化目标
+        :param ascending: bool(False)升序or降序排列
+        :return: list of dict,每个窗口一个:{"in_sample_range","out_sample_range","signal_name",
+                 "in_sample_perf","out_sample_perf"},绩效格式同cal_perf.
+                 样本内没有可用信号时signal_name及绩效为None,样本外没有可用信号时out_sample_perf为None
+        '''
+        if not self._judge_target(target_type, target):  # 判断target合法性
+            return []
+        order_index = self._order_index(target_type)
+        # 每个窗口的(最优信号名称,得分),得分越大越好
+        best = [(None, np.nan)] * len(windows)
+        for sig_name, engine in self._iter_engines():
+            for i, (in_sample_range, _) in enumerate(windows):
+                view = engine.window(*in_sample_range)
+                if view.n_rows == 0:
+                    continue
+                score = _target_value(view.analysis([target_type]), order_index, target_type, target)
+                if np.isnan(score):
+                    continue
+                score = -score if ascending else score
+                if best[i][0] is None or score > best[i][1]:
+                    best[i] = (sig_name, score)
+            # 逐行的中间结果不再保留,storage为"full"时缓存的engine只保留逐日结果
+            engine.drop_row_cache()
+
+        # 只对各窗口选中的参数组合计算完整绩效
+        engines = dict(self._iter_engines(set(sig_name for sig_name, _ in best if sig_name is not None)))
+        result = []
+        for (in_sample_range, out_sample_range), (sig_name, _) in zip(windows, best):
+            item = {"in_sample_range": in_sample_range,
+                    "out_sample_range": out_sample_range,
+                    "signal_name": sig_name,
+                    "in_sample_perf": None,
+                    "out_sample_perf": None}
+            if sig_name is not None:
+                for key, date_range in [("in_sample_perf", in_sample_range), ("out_sample_perf", out_sample_range)]:
+                    view = engines[sig_name].window(*date_range)
+                    if view.n_rows > 0:
+                        item[key] = view.analysis()
+                        item[key]["signal_name"] = sig_name
+            result.append(item)
+        for engine in engines.values():
+            engine.drop_row_cache()
+        return result
+
+    def _iter_engines(self, sig_names=None):
+        # 逐个参数组合生成覆盖全部日期的AnalysisEngine.信号已保存或可以保存时使用all_signals,否则逐个计算
+        if self.all_signals is None and self.storage != "perf":
+            self.get_all_signals()
+        if self.all_signals is not None:
+            for sig_name in list(self.all_signals.keys()):
+                if sig_names is None or sig_name in sig_names:
+                    engine = self._signal_engine(sig_name)
+                    if engine is not None:
+                        yield sig_name, engine
+            return
+        for sig_name, para_dict in self._param_grid().items():
+            if sig_names is None or sig_name in sig_names:
+                signal_data = self._signal_data(para_dict)
+                if signal_data is not None and len(signal_data) > 0:
+                    yield sig_name, AnalysisEngine(signal_data, self.is_event, self.period)
+
+    def _signal_engine(self, sig_name):
+        '''
+        all_signals中信号的AnalysisEngine.storage为"full"时缓存,其逐日结果在不同的in_sample_range间复用,
+        计算过的目标种类在任意日期范围上的统计量由前缀和直接得到;其他storage下每次重新构建,以免占用内存.
+        '''
+        signal_data = self.all_signals[sig_name]
+        if self.storage == "full" and sig_name in self._engines and self._engines[sig_name][0] is signal_data:
+            return self._engines[sig_name][1]
+        engine = None
+        if signal_data is not None and len(signal_data) > 0:
+            engine = AnalysisEngine(signal_data, self.is_event, self.period)
+        if self.storage == "full":
+            self._engines[sig_name] = (signal_data, engine)
+        return engine
+
+    def _stored_signal_perf(self, sig_name, in_sample_range=None, target_types=None):
+        # 同cal_perf(self.all_signals[sig_name], in_sample_range, target_types=target_types)
+        engine = self._signal_engine(sig_name)
+        if engine is None:
+            return None
+        if in_sample_range is not None:
+            engine = engine.window(in_sample_range[0], in_sample_range[1])
+            if engine.n_rows == 0:
+                return None
+        perf = engine.analysis(target_types)
+        # 逐行的中间结果不再保留,之后只使用逐日结果
+        engine.drop_row_cache()
+        return perf
+
+    @staticmethod
+    def _head_range(signal_data, in_sample_range, fraction):
+        # 样本内范围中最前面fraction比例的日期
+        if signal_data is None:
+            return in_sample_range
+        dates = np.unique(signal_data.index.get_level_values("trade_date"))
+        if in_sample_range is not None:
+            dates = dates[(dates >= in_sample_range[0]) & (dates <= in_sample_range[1])]
+        if len(dates) == 0:
+            return in_sample_range
+        n = max(int(np.ceil(len(dates) * fraction)), 1)
+        return [dates[0], dates[n - 1]]
+
+    # 所有参数组合对应的信号名称和参数取值,按参数组合的枚举顺序排列
+    def _param_grid(self):
+        param_grid = OrderedDict()
+        keys = list(self.params.keys())
+        for value in product(*self.params.values()):
+            para_dict = dict(zip(keys, value))
+            param_grid[self.name + str(para_dict)] = para_dict
+        return param_grid
+
+    # 公式只解析一次,参数在计算时代入,与参数无关的子公式在所有参数组合间只计算一次
+    def _cal_formula(self, para_dict):
+        if self._formula_template is None:
+            self._formula_template = self.dataview.add_formula_template(self.formula,
+                                                                        list(self.params.keys()),
+                                                                        is_quarterly=self.is_quarterly)
+        signal = self._formula_template(para_dict) if self._formula_template is not None else None
+        if (not isinstance(signal,pd.DataFrame)) or (signal.size==0):
+            warnings.warn("待优化公式%s(参数%s)不能计算出有效结果,请检查数据和公式是否正确完备!" % (self.formula, para_dict))
+            return None
+        return signal
+
+    # 按storage新建保存信号的容器,storage为"perf"时不保存
+    def _new_signal_store(self):
+        if self.storage == "full":
+            return dict()
+        elif self.storage == "float32":
+            return SignalStore(dtype=np.float32)
+        elif self.storage == "disk":
+            if self.storage_dir is not None and not os.path.isdir(self.storage_dir):
+                os.makedirs(self.storage_dir)
+            folder = tempfile.mkdtemp(prefix="signals_", dir=self.storage_dir)
+            store = SignalStore(folder=folder)
+            weakref.finalize(store, shutil.rmtree, folder, True)
+            return store
+        return None
+
     def get_all_signals(self):
         if self.all_signals is None:
-            self.all_signals = dict()
-            keys = list(self.params.keys())
-            for value in product(*self.params.values()):
-                para_dict = dict(zip(keys, value))
-                formula = self.formula
-                for vars in para_dict.keys():
-                    formula = formula.replace(vars, str(para_dict[vars]))
-                signal = self.dataview.add_formula(self.name,
-                                                   formula,
-                                                   is_quarterly=self.is_quarterly)
-                if (not isinstance(signal,pd.DataFrame)) or (signal.size==0):
-                    warnings.warn("待优化公式%s不能计算出有效结果,请检查数据和公式是否正确完备!")
+            all_signals = self._new_signal_store()
+            if all_signals is None:
+                warnings.warn("storage为\"perf\"时不保存all_signals.")
+                return
+            for sig_name, para_dict in self._param_grid().items():
+                signal = self._cal_formula(para_dict)
+                if signal is None:
                     continue
-                self.all_signals[self.name + str(para_dict)] = self.cal_signal(signal)
+                all_signals[sig_name] = self.cal_signal(signal)
+            self.all_signals = all_signals
+
+    def _use_parallel(self, n_jobs):
+        if n_jobs is None or n_jobs == 1 or self.all_signals is not None or self.formula is None:
+            return False
+        if self.is_quarterly:
+            warnings.warn("季度因子暂不支持并行计算,将使用单进程计算.")
+            return False
+        return True
+
+    def _signal_data(self, para_dict):
+        signal = self._cal_formula(para_dict)
+        return None if signal is None else self.cal_signal(signal)
+
+    def _param_perf(self, para_dict, in_sample_range, target_types):
+        signal_data = self._signal_data(para_dict)
+        if signal_data is None:
+            return None
+        return self.cal_perf(signal_data, in_sample_range, target_types=target_types)
+
+    def _params_perf(self, tasks, in_sample_range, target_types, n_jobs=1):
+        '''
+        逐个计算各参数组合的信号绩效,不保存信号.n_jobs不为1时使用多进程,见_PerfRunner.
+        设置了journal时跳过日志中已完成的参数组合,计算结果逐个写入日志.
+        :param tasks: list of (sig_name, para_dict)
+        :return: list of (sig_name, perf),与tasks顺序一致
+        '''
+        if len(tasks) == 0:
+            return []
+        runner = _PerfRunner(self, in_sample_range, target_types, n_jobs, len(tasks))
+        try:
+            if self.journal is None:
+                return list(runner.run(tasks))
+            return self._journal_perf(tasks, runner, in_sample_range, target_types)
+        finally:
+            runner.close()
+
+    # SignalCreator的配置,在_cal_ret修改输入数据之前计算
+    def _creator_config(self):
+        creator = self.signal_creator
+        config = {"period": creator.period,
+                  "n_quantiles": creator.n_quantiles,
+                  "forward": creator.forward,
+                  "commission": creator.commission}
+        for name in ["price", "ret", "high", "low", "benchmark_price", "mask", "can_enter", "can_exit"]:
+            config[name] = frame_digest(getattr(creator, name))
+        return config
+
+    def _journal_perf(self, tasks, runner, in_sample_range, target_types):
+        '''
+        按日志计算各参数组合的绩效.已完成的直接读取;未完成的先独占地领取再计算,
+        已被其他进程领取的等其他进程完成后读取.
+        '''
+        journal = ResultJournal(self.journal, self.journal_timeout)
+        config = (self.formula, sorted(self.params.keys()), in_sample_range, target_types,
+                  self.is_event, self._journal_creator)
+        keys = {sig_name: journal.key(config, para_dict) for sig_name, para_dict in tasks}
+        # 每次领取的参数组合数,多进程时每个进程分到几个连续的参数组合
+        batch_size = 1 if runner.n_processes == 1 else runner.n_processes * 4
+        results = dict()
+
+        def flush(batch):
+            try:
+                for sig_name, perf in runner.run(batch):
+                    journal.save(keys[sig_name], perf)
+                    journal.release(keys[sig_name])
+                    results[sig_name] = perf
+            finally:
+                for sig_name, _ in batch:
+                    journal.release(keys[sig_name])
+
+        waiting = list(tasks)
+        while len(waiting) > 0:
+            pending, waiting, batch = waiting, [], []
+            for task in pending:
+                found, perf = journal.load(keys[task[0]])
+                if found:
+                    results[task[0]] = perf
+                elif journal.claim(keys[task[0]]):
+                    # 查询与领取之间其他进程可能已完成并释放
+                    found, perf = journal.load(keys[task[0]])
+                    if found:
+                        journal.release(keys[task[0]])
+                        results[task[0]] = perf
+                        continue
+                    batch.append(task)
+                    if len(batch) >= batch_size:
+                        flush(batch)
+                        batch = []
+                else:
+                    waiting.append(task)
+            flush(batch)
+            if len(waiting) == len(pending):
+                # 剩余的参数组合都在其他进程中计算
+                time.sleep(self.journal_poll)
+        return [(sig_name, results[sig_name]) for sig_name, _ in tasks]
+
+    def _covers_target_types(self, target_types=None):
+        # 已计算的绩效是否包含所需的target_types
+        if self.perf_target_types is None:
+            return True
+        if target_types is None:
+            return False
+        return set(target_types) <= set(self.perf_target_types)
 
-    def get_all_signals_perf(self, in_sample_range=None):
-        self.get_all_signals()
+    def get_all_signals_perf(self, in_sample_range=None, target_types=None, n_jobs=1):
+        '''
+        :param in_sample_range: [date_start(int),date_end(int)] (N) 定义样本内优化范围.
+        :param target_types: list (N) 只计算这些目标种类的绩效,如["long_ret","return_ic"];为空时计算全部绩效
+        :param n_jobs: int (1) 并行计算的进程数,-1表示使用全部cpu.
+                       大于1时各参数组合的公式、信号和绩效在子进程中计算,只返回绩效,不保存all_signals;
+                       仅支持日频因子
+        '''
+        # storage为"perf"、使用journal或并行计算时不保存all_signals,逐个参数组合计算绩效
+        by_params = self._use_parallel(n_jobs) or \
+            ((self.storage == "perf" or self.journal is not None) and
+             self.all_signals is None and self.formula is not None)
+        if not by_params:
+            self.get_all_signals()
         if self.all_signals_perf is None or \
                 (self.in_sample_range != in_sample_range) or \
-                (len(set(self.all_signals_perf.keys()) - set(self.all_signals.keys())) != 0):
+                (not by_params and len(set(self.all_signals_perf.keys()) - set(self.all_signals.keys())) != 0) or \
+                (not self._covers_target_types(target_types)):
+            if by_params:
+                all_perf = self._params_perf(list(self._param_grid().items()),
+                                             in_sample_range, target_types, n_jobs)
+            else:
+                all_perf = [(sig_name,
+                             self._stored_signal_perf(sig_name, in_sample_range, target_types))
+                            for sig_name in self.all_signals.keys()]
             self.all_signals_perf = dict()
-            for sig_name in self.all_signals.keys():
-                perf = self.cal_perf(self.all_signals[sig_name], in_sample_range)
+            for sig_name, perf in all_perf:
                 if perf is not None:
                     self.all_signals_perf[sig_name] = perf
                     self.all_signals_perf[sig_name]["signal_name"] = sig_name
             if len(self.all_signals_perf) == 0:
                 print("没有计算出可用的信号绩效，请确保至少有一个信号可用.(可尝试增加样本内数据的时间范围以确保有信号发生)")
             self.in_sample_range = in_sample_range
+            self.perf_target_types = target_types
 
     def cal_signal(self, signal):
         return self.signal_creator.get_signal_data(signal)
@@ -269,19 +836,15 @@ class Optimizer(object):
     def cal_perf(self,
                  signal_data,
                  in_sample_range=None,
-                 constraints=None):
+                 constraints=None,
+                 target_types=None):
         '''
         :param signal_data:
         :param in_sample_range: like [20100312,20170405] 样本内范围起止时间
         :param constraints: like [{"target_type":"long_ret",
                                    "target":"Ann. IR",
                                    "condition":}]
+        :param target_types: list (N) 只计算这些目标种类的绩效,如["long_ret","return_ic"];为空时计算全部绩效
         :return:
         '''
-        perf = None
-        if signal_data is not None:
-            if in_sample_range is not None:
-                signal_data = signal_data.loc[in_sample_range[0]:in_sample_range[1]]
-            if len(signal_data) > 0:
-                perf = analysis(signal_data, self.is_event, self.period)
-        return perf
+        return signal_perf(signal_data, self.is_event, self.period, in_sample_range, target_types)
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from jaqs_fxdayu.patch_util import auto_register_patch
 
@@ -86,6 +87,49 @@ def mean_information_coefficient(ic, by_time=None, by_group=False):
     return ic
 
 
+def calc_quantile_mean_std_ts(signal_data, columns="return", quantiles=None):
+    """
+    Computes period wise mean/std/count of the given columns for all
+    signal quantiles with a single groupby-unstack.
+
+    Parameters
+    ----------
+    signal_data : pd.DataFrame - MultiIndex
+        Index is pd.MultiIndex ['trade_date', 'symbol'], columns = ['signal', 'return', 'quantile']
+    columns : str or list of str
+        Columns of signal_data to compute statistics on.
+    quantiles : list of int, optional
+        Only use rows of these quantiles. All quantiles by default.
+
+    Returns
+    -------
+    res : dict
+        {quantile: pd.DataFrame} if columns is a str, else {column: {quantile: pd.DataFrame}}.
+        Every DataFrame has columns ['mean', 'std', 'count'] and shares the same
+        trade_date index (union over the quantiles), missing values are filled with 0.
+
+    """
+    single = isinstance(columns, str)
+    columns = [columns] if single else list(columns)
+    if quantiles is not None:
+        quantiles = sorted(set(quantiles))
+        signal_data = signal_data.loc[signal_data['quantile'].isin(quantiles)]
+
+    stats_names = ['mean', 'std', 'count']
+    group_mean_std = signal_data.groupby(['trade_date', 'quantile'])[columns].agg(stats_names)
+    group_mean_std = group_mean_std.unstack(level='quantile')
+    if quantiles is not None:
+        group_mean_std = group_mean_std.reindex(columns=pd.MultiIndex.from_product([columns, stats_names, quantiles]))
+    group_mean_std = group_mean_std.fillna(0)
+
+    res = dict()
+    for column in columns:
+        df_column = group_mean_std[column]
+        qs = df_column.columns.get_level_values(-1).unique()
+        res[column] = {q: df_column.xs(q, axis=1, level=-1) for q in qs}
+    return res[columns[0]] if single else res
+
+
 @auto_register_patch()
 def calc_quantile_return_mean_std(signal_data, time_series=False):
     """
@@ -101,31 +145,9 @@ def calc_quantile_return_mean_std(signal_data, time_series=False):
     res : pd.DataFrame of dict
 
     """
-    signal_data = signal_data.copy()
-    grouper = ['quantile']
     if time_series:
-        grouper.append('trade_date')
-
-    group_mean_std = signal_data.groupby(grouper)['return'].agg(['mean', 'std', 'count'])
-    # TODO: why?
-    '''
-    std_error_ret = group_mean_std.loc[:, 'std'].copy() / np.sqrt(group_mean_std.loc[:, 'count'].copy())
-    '''
-    indexes = []
-    if time_series:
-        quantile_daily_mean_std_dic = dict()
-        quantiles = np.unique(group_mean_std.index.get_level_values(level='quantile'))
-        for q in quantiles:  # loop for different quantiles
-            df_q = group_mean_std.loc[pd.IndexSlice[q, :], :]  # bug
-            df_q.index = df_q.index.droplevel(level='quantile')
-            indexes.append(pd.Series(df_q.index))
-            quantile_daily_mean_std_dic[q] = df_q
-        new_index = sorted(pd.concat(indexes).unique())
-        for q in quantiles:
-            quantile_daily_mean_std_dic[q] = quantile_daily_mean_std_dic[q].reindex(new_index).fillna(0)
-        return quantile_daily_mean_std_dic
-    else:
-        return group_mean_std
+        return calc_quantile_mean_std_ts(signal_data, "return")
+    return signal_data.groupby('quantile')['return'].agg(['mean', 'std', 'count'])
 
 
 @auto_register_patch()
@@ -177,6 +199,9 @@ def period_wise_ret_to_cum(ret, period, compound=True):
     (started at subsequent periods 1,2,3,...,N) each one rebalancing every N
     periods.
 
+    The N portfolios are the columns of ret reshaped to (n / N, N), so all of
+    them (and all columns of a DataFrame) are cumulated in one vectorized call.
+
     Parameters
     ----------
     ret: pd.Series or pd.DataFrame
@@ -188,36 +213,45 @@ def period_wise_ret_to_cum(ret, period, compound=True):
 
     Returns
     -------
-    pd.Series
+    pd.Series or pd.DataFrame
         Cumulative returns series starting from zero.
 
     """
-    if isinstance(ret, pd.DataFrame):
-        # deal with each column recursively
-        return ret.apply(period_wise_ret_to_cum, axis=0, args=(period,))
-    elif isinstance(ret, pd.Series):
-        if period == 1:
-            return ret.add(1).cumprod().sub(1.0)
-
-        # invest in each portfolio separately
-
-        periods_index = np.arange(len(ret.index)) // period
-        period_portfolios = ret.groupby(by=periods_index, axis=0).apply(lambda ser: pd.DataFrame(np.diag(ser))).fillna(0)
-        period_portfolios.index = ret.index
-
+    if not isinstance(ret, (pd.Series, pd.DataFrame)):
+        raise NotImplementedError("ret must be Series or DataFrame.")
+    if period == 1:
+        return ret.add(1).cumprod().sub(1.0)
+
+    values = np.asarray(ret.values, dtype=float)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    n = len(values)
+    n_blocks = -(-n // period)
+
+    # invest in each portfolio separately: portfolio j only holds the returns of t = j (mod N)
+    blocks = np.zeros((n_blocks * period, values.shape[1]))
+    blocks[:n] = values
+    blocks[np.isnan(blocks)] = 0.0
+    blocks = blocks.reshape(n_blocks, period, -1)
+
+    # cumulate returns separately
+    if compound:
+        cum_returns = np.cumprod(blocks + 1.0, axis=0) - 1.0
+    else:
+        cum_returns = np.cumsum(blocks, axis=0)
 
-        # cumulate returns separately
-        if compound:
-            cum_returns = period_portfolios.add(1).cumprod().sub(1.0)
-        else:
-            cum_returns = period_portfolios.cumsum()
+    # at t = b * N + k, portfolios j <= k are updated in block b, portfolios j > k still hold block b - 1
+    head = np.cumsum(cum_returns, axis=1)
+    tail = np.zeros_like(cum_returns)
+    tail[:, :-1] = np.cumsum(cum_returns[:, :0:-1], axis=1)[:, ::-1]
+    head[1:] += tail[:-1]
 
-        # since capital of all portfolios are the same, return in all equals average return
-        res = cum_returns.mean(axis=1)
+    # since capital of all portfolios are the same, return in all equals average return
+    res = head.reshape(n_blocks * period, -1)[:n] / min(n, period)
 
-        return res
-    else:
-        raise NotImplementedError("ret must be Series or DataFrame.")
+    if isinstance(ret, pd.DataFrame):
+        return pd.DataFrame(res, index=ret.index, columns=ret.columns)
+    return pd.Series(res[:, 0], index=ret.index)
 
 
 _calc_signal_ic = calc_signal_ic
@@ -1,11 +1,109 @@
 # encoding=utf-8
 # 数据处理
 
+import threading
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 import jaqs.util as jutil
 import pandas as pd
 import numpy as np
 
 
+def _sorted_quantile(sorted_values, count, q):
+    """
+    已逐行排序(nan在最后)的数组每行的分位数,线性插值,与pd.Series.quantile一致
+    :param sorted_values: np.array (D,N)
+    :param count: np.array (D,) 每行非nan的个数
+    :param q: float 0-1
+    :return: np.array (D,) 全为nan的行为nan
+    """
+    pos = (count - 1) * q
+    lower = np.floor(pos).astype(int)
+    upper = np.minimum(lower + 1, np.maximum(count - 1, 0))
+    rows = np.arange(len(sorted_values))
+    a = sorted_values[rows, np.maximum(lower, 0)]
+    b = sorted_values[rows, upper]
+    t = pos - lower
+    diff = b - a
+    # 与numpy的线性插值写法相同,保证结果一致
+    res = np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+    res[count == 0] = np.nan
+    return res
+
+
+def _sorted_median(sorted_values, count):
+    # 偶数个时取中间两个数的均值,与pd.Series.median一致
+    rows = np.arange(len(sorted_values))
+    a = sorted_values[rows, np.maximum(count - 1, 0) // 2]
+    b = sorted_values[rows, count // 2 - (count == 0)]
+    res = (a + b) / 2
+    res[count == 0] = np.nan
+    return res
+
+
+def _clip_rows(values, lower, upper, out=None):
+    # 阈值只在整行为nan时为nan,此时结果仍为nan
+    with np.errstate(invalid='ignore'):
+        return np.clip(values, lower[:, None], upper[:, None], out=out)
+
+
+def _winsorize_values(values, alpha, out=None):
+    sorted_values = np.sort(values, axis=1)
+    count = (~np.isnan(values)).sum(axis=1)
+    return _clip_rows(values,
+                      _sorted_quantile(sorted_values, count, alpha / 2),
+                      _sorted_quantile(sorted_values, count, 1 - alpha / 2),
+                      out)
+
+
+def _mad_values(values, out=None):
+    count = (~np.isnan(values)).sum(axis=1)
+    median = _sorted_median(np.sort(values, axis=1), count)
+    deviation = np.abs(values - median[:, None])
+    deviation.sort(axis=1)
+    tmp = _sorted_median(deviation, count)
+    return _clip_rows(values, median - 5 * tmp, median + 5 * tmp, out)
+
+
+def _standardize_values(values, out=None):
+    # 逐行z-score,样本标准差自由度为n-1,与standardize一致
+    count = (~np.isnan(values)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=1) / count
+        out = np.subtract(values, mean[:, None], out=out)
+        std = np.sqrt(np.nansum(out ** 2, axis=1) / (count - 1))
+        std[count < 2] = np.nan
+        return np.divide(out, std[:, None], out=out)
+
+
+def _apply_by_rows(factor_df, func, n_jobs=1, block_size=256):
+    """
+    对因子值逐行(横截面)计算func,n_jobs不为1时按行分块在线程池中计算
+    :param func: func(np.array (D,N)) -> np.array (D,N)
+    :param n_jobs: int 线程数,-1表示使用全部cpu
+    :param block_size: int 每块的行数
+    """
+    values = factor_df.values.astype(float)
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+    if n_jobs <= 1 or len(values) <= block_size:
+        res = func(values)
+    else:
+        res = np.empty_like(values)
+
+        def run(start):
+            res[start:start + block_size] = func(values[start:start + block_size])
+
+        pool = ThreadPool(n_jobs)
+        try:
+            pool.map(run, range(0, len(values), block_size))
+        finally:
+            pool.close()
+    return pd.DataFrame(res, index=factor_df.index, columns=factor_df.columns)
+
+
 def _mask_df(df, mask):
     mask = mask.astype(bool)
     df[mask] = np.nan
@@ -42,11 +140,12 @@ def standardize(factor_df, index_member=None):
 
 
 # 横截面去极值 - 对Dataframe数据
-def winsorize(factor_df, alpha=0.05, index_member=None):
+def winsorize(factor_df, alpha=0.05, index_member=None, n_jobs=1):
     """
     对因子值做去极值操作
     :param index_member:
     :param alpha: 极值范围
+    :param n_jobs: 线程数(int),股票数很多时可按日期分块并行计算,-1表示使用全部cpu
     :param factor_df: 因子值 (pandas.Dataframe类型),index为datetime, colunms为股票代码。
                       形如:
                                   　AAPL	　　　     BA	　　　CMG	　　   DAL	      LULU	　　
@@ -59,22 +158,17 @@ def winsorize(factor_df, alpha=0.05, index_member=None):
     :return:去极值后的因子值(pandas.Dataframe类型),index为datetime, colunms为股票代码。
     """
 
-    def winsorize_series(se):
-        q = se.quantile([alpha / 2, 1 - alpha / 2])
-        se[se < q.iloc[0]] = q.iloc[0]
-        se[se > q.iloc[1]] = q.iloc[1]
-        return se
-
     factor_df = jutil.fillinf(factor_df)
     factor_df = _mask_non_index_member(factor_df, index_member)
-    return factor_df.apply(lambda x: winsorize_series(x), axis=1)
+    return _apply_by_rows(factor_df, lambda values: _winsorize_values(values, alpha), n_jobs)
 
 
 # 横截面去极值 - 对Dataframe数据
-def mad(factor_df, index_member=None):
+def mad(factor_df, index_member=None, n_jobs=1):
     """
     对因子值做去极值操作
     :param index_member:
+    :param n_jobs: 线程数(int),股票数很多时可按日期分块并行计算,-1表示使用全部cpu
     :param factor_df: 因子值 (pandas.Dataframe类型),index为datetime, colunms为股票代码。
                       形如:
                                   　AAPL	　　　     BA	　　　CMG	　　   DAL	      LULU	　　
@@ -87,16 +181,9 @@ def mad(factor_df, index_member=None):
     :return:去极值后的因子值(pandas.Dataframe类型),index为datetime, colunms为股票代码。
     """
 
-    def _mad(series):
-        if series.dropna().size==0:
-            return series
-        median = series.median()
-        tmp = (series - median).abs().median()
-        return series.clip(median - 5 * tmp, median + 5 * tmp)
-
     factor_df = jutil.fillinf(factor_df)
     factor_df = _mask_non_index_member(factor_df, index_member)
-    return factor_df.apply(lambda x: _mad(x), axis=1)
+    return _apply_by_rows(factor_df, _mad_values, n_jobs)
 
 
 # 横截面排序并归一化
@@ -140,6 +227,75 @@ def get_disturbed_factor(factor_df):
     return factor_df + np.random.random(factor_df.shape) / 1000000000
 
 
+def _demean_regress(y, x, valid, codes, n_groups):
+    """
+    逐日对行业哑变量和连续暴露x做截面回归,返回残差.
+    由Frisch-Waugh-Lovell定理,先在每个日期×行业内去均值(等价于对行业哑变量回归),
+    再用去均值后的y对去均值后的x回归,残差与直接对[x,行业哑变量]回归相同.
+    :param y: np.array (D,N) 因子值
+    :param x: np.array (D,N) 连续暴露(如标准化后的对数市值),为None时只做行业中性化
+    :param valid: np.array of bool (D,N) 参与回归的样本
+    :param codes: np.array of int (D,N) 行业编号
+    :param n_groups: int 行业数
+    :return: (residual, beta) residual为有效样本(按y[valid]的顺序)的残差,beta为(D,)的x系数
+    """
+    n_dates = y.shape[0]
+    rows = np.nonzero(valid)[0]
+    segment = rows * n_groups + codes[valid]
+    count = np.bincount(segment, minlength=n_dates * n_groups)
+
+    def demean(values):
+        total = np.bincount(segment, weights=values, minlength=n_dates * n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return values - (total / count)[segment]
+
+    residual = demean(y[valid])
+    beta = np.zeros(n_dates)
+    if x is not None:
+        xd = demean(x[valid])
+        sxx = np.bincount(rows, weights=xd * xd, minlength=n_dates)
+        sxy = np.bincount(rows, weights=xd * residual, minlength=n_dates)
+        # 行业内x无差异时x与行业哑变量共线,系数取0(与lstsq的最小范数解一致)
+        scale = np.bincount(rows, weights=x[valid] ** 2, minlength=n_dates)
+        ok = sxx > scale * np.finfo(float).eps
+        beta[ok] = sxy[ok] / sxx[ok]
+        residual = residual - beta[rows] * xd
+    return residual, beta
+
+
+def _industry_codes(group, index, columns):
+    """
+    :return: (codes, n_groups) 与因子对齐的行业编号(np.array of int),缺失或为"nan"的行业编号为-1
+    """
+    industry = group.reindex(index=index, columns=columns).values.ravel()
+    codes, labels = pd.factorize(industry)
+    invalid_labels = np.array([str(label) == "nan" for label in labels] + [True])
+    codes = np.where(invalid_labels[codes], -1, codes).reshape(len(index), len(columns))
+    return codes, len(labels)
+
+
+def _size_exposure(float_mv, index_member, index, columns):
+    # 获取对数流动市值，并去极值、标准化。市值类因子不需进行这一步
+    if float_mv is None:
+        return None
+    float_mv = standardize(mad(np.log(float_mv), index_member=index_member), index_member)
+    return float_mv.reindex(index=index, columns=columns).values.astype(float)
+
+
+def _neutralize_values(y, codes, n_groups, x=None, out=None):
+    # 行业或市值缺失的样本结果为nan
+    valid = ~np.isnan(y) & (codes >= 0)
+    if x is not None:
+        valid &= ~np.isnan(x)
+    residual = _demean_regress(y, x, valid, codes, n_groups)[0] if valid.any() else None
+    if out is None:
+        out = np.empty(y.shape)
+    out[~valid] = np.nan
+    if residual is not None:
+        out[valid] = residual
+    return out
+
+
 # 行业、市值中性化 - 对Dataframe数据
 def neutralize(factor_df,
                group,
@@ -161,44 +317,144 @@ def neutralize(factor_df,
     :param float_mv: 流通市值因子(pandas.Dataframe类型),index为datetime, colunms为股票代码．为空则不进行市值中性化
     :return: 中性化后的因子值(pandas.Dataframe类型),index为datetime, colunms为股票代码。
     """
-    def drop_nan(s):
-        return s[s != "nan"]
-
-    def _ols_by_numpy(x, y):
-        m = np.linalg.lstsq(x, y)[0]
-        resid = y - (x@m)
-        return resid
-
-    def _generate_cross_sectional_residual(data):
-        for _, X in data.groupby(level=0):
-            signal = X.pop("signal")
-            X = pd.concat([X, pd.get_dummies(X.pop("industry"))], axis=1)
-            signal = pd.Series(_ols_by_numpy(X.values, signal), index=signal.index, name=signal.name)
-            yield signal
-
-    data = []
-
-    # 用于恢复原先的索引和列
-    origin_factor_columns = factor_df.columns
-    origin_factor_index = factor_df.index
-
     factor_df = jutil.fillinf(factor_df)  # 调整非法值
     factor_df = _mask_non_index_member(factor_df, index_member)  # 剔除非指数成份股
-    factor_df = factor_df.dropna(how="all").stack().rename("signal")  # 删除全为空的截面
-    data.append(factor_df)
+    index, columns = factor_df.index, factor_df.columns
+    y = factor_df.values.astype(float)
+    codes, n_groups = _industry_codes(group, index, columns)
+    x = _size_exposure(float_mv, index_member, index, columns)
+    return pd.DataFrame(_neutralize_values(y, codes, n_groups, x), index=index, columns=columns)
 
-    # 获取对数流动市值，并去极值、标准化。市值类因子不需进行这一步
-    if float_mv is not None:
-        float_mv = standardize(mad(np.log(float_mv), index_member=index_member), index_member).stack().rename("style")
-        data.append(float_mv)
 
-    # 行业
-    industry_standard = drop_nan(group.stack()).rename("industry")
-    data.append(industry_standard)
+class Pipeline(object):
+    """
+    因子预处理流水线.按顺序声明处理步骤,index_member/group/float_mv只对齐和预处理一次,
+    每个因子只复制一次为float数组,非法值处理、剔除非成分股和各步骤都在该数组上原地计算.
+    结果与依次调用winsorize/mad/neutralize/standardize/rank_standardize(传入相同的index_member)一致.
+    :param steps: list 处理步骤,元素为步骤名或(步骤名, 参数dict),如["mad", "neutralize", ("winsorize", {"alpha": 0.1}), "standardize"]
+                  步骤名可为"winsorize"(参数alpha), "mad", "neutralize", "standardize", "rank_standardize"
+    :param index_member: 是否是指数成分(pd.Dataframe),为空则不剔除
+    :param group: 行业分类(pd.Dataframe),neutralize步骤需要
+    :param float_mv: 流通市值(pd.Dataframe),为空则neutralize不做市值中性化
+    :param n_jobs: 同时处理多个因子的线程数(int),-1表示使用全部cpu
+    """
 
-    data = pd.concat(data,axis=1).dropna()
-    residuals = pd.concat(_generate_cross_sectional_residual(data)).unstack()
+    step_names = ["winsorize", "mad", "neutralize", "standardize", "rank_standardize"]
+
+    def __init__(self, steps, index_member=None, group=None, float_mv=None, n_jobs=1):
+        self.steps = []
+        for step in steps:
+            name, kwargs = (step, {}) if isinstance(step, str) else step
+            if name not in self.step_names:
+                raise ValueError("不支持的处理步骤%s!支持的步骤有%s." % (name, ", ".join(self.step_names)))
+            if name == "neutralize" and group is None:
+                raise ValueError("neutralize步骤需要提供group")
+            self.steps.append((name, dict(kwargs)))
+        self.index_member = index_member
+        self.group = group
+        self.float_mv = float_mv
+        self.n_jobs = n_jobs
+        self._aligned = None
+        self._lock = threading.Lock()
+
+    def _align(self, index, columns):
+        # 对齐后的数据只保存一份,因子的index/columns相同时直接复用
+        with self._lock:
+            if self._aligned is not None and self._aligned["index"].equals(index) and \
+                    self._aligned["columns"].equals(columns):
+                return self._aligned
+            aligned = {"index": index, "columns": columns, "member": None, "codes": None, "x": None}
+            if self.index_member is not None:
+                member = self.index_member.reindex(index=index, columns=columns).fillna(0)
+                aligned["member"] = member.values.astype(bool)
+            if any(name == "neutralize" for name, _ in self.steps):
+                aligned["codes"], aligned["n_groups"] = _industry_codes(self.group, index, columns)
+                aligned["x"] = _size_exposure(self.float_mv, self.index_member, index, columns)
+            self._aligned = aligned
+            return aligned
+
+    def transform(self, factor_df):
+        """
+        :param factor_df: 因子值(pd.Dataframe),index为datetime, columns为股票代码
+        :return: 处理后的因子值(pd.Dataframe)
+        """
+        aligned = self._align(factor_df.index, factor_df.columns)
+        values = np.array(factor_df.values, dtype=float)
+        values[np.isinf(values)] = np.nan
+        if aligned["member"] is not None:
+            values[~aligned["member"]] = np.nan
+        for name, kwargs in self.steps:
+            if name == "winsorize":
+                _winsorize_values(values, kwargs.get("alpha", 0.05), out=values)
+            elif name == "mad":
+                _mad_values(values, out=values)
+            elif name == "neutralize":
+                _neutralize_values(values, aligned["codes"], aligned["n_groups"], aligned["x"], out=values)
+            elif name == "standardize":
+                _standardize_values(values, out=values)
+            else:
+                rank = jutil.rank_with_mask(pd.DataFrame(values), axis=1, normalize=True)
+                values[:] = rank.values
+        return pd.DataFrame(values, index=factor_df.index, columns=factor_df.columns)
+
+    def transform_dict(self, factors_dict):
+        """
+        :param factors_dict: 若干因子组成的字典(dict),形式为{"factor_name_1":factor_1,"factor_name_2":factor_2}
+        :return: dict 处理后的因子,n_jobs不为1时多个因子在线程池中同时处理
+        """
+        names = list(factors_dict.keys())
+        n_jobs = cpu_count() if self.n_jobs < 0 else self.n_jobs
+        if n_jobs > 1 and len(names) > 1:
+            pool = ThreadPool(min(n_jobs, len(names)))
+            try:
+                values = pool.map(lambda name: self.transform(factors_dict[name]), names)
+            finally:
+                pool.close()
+        else:
+            values = [self.transform(factors_dict[name]) for name in names]
+        return dict(zip(names, values))
+
+
+class CrossSectionProcessor(object):
+    """
+    逐日处理新的截面数据,用于每天只新增一个截面的生产环境.
+    处理步骤同Pipeline,每个步骤只依赖当天的截面,结果与对完整历史调用相应的批量函数后该日的结果一致.
+    :param steps: list 处理步骤,见Pipeline
+    :param keep_history: bool (False) 是否保存已处理的截面,可通过history取得
+    """
 
-    # 恢复在中性化过程中剔除的行和列
-    residuals.reindex(index=origin_factor_index,columns=origin_factor_columns)
-    return residuals.reindex(index=origin_factor_index,columns=origin_factor_columns)
+    def __init__(self, steps, keep_history=False):
+        # 检查步骤是否合法
+        Pipeline(steps, group=pd.DataFrame())
+        self.steps = steps
+        self.keep_history = keep_history
+        self._history = OrderedDict()
+
+    def update(self, date, factor, index_member=None, group=None, float_mv=None):
+        """
+        处理一个新的截面
+        :param date: 截面日期
+        :param factor: 当日因子值(pd.Series),index为股票代码
+        :param index_member: 当日是否是指数成分(pd.Series),为空则不剔除
+        :param group: 当日行业分类(pd.Series),包含neutralize步骤时需要
+        :param float_mv: 当日流通市值(pd.Series),为空则neutralize不做市值中性化
+        :return: 处理后的因子值(pd.Series),index为股票代码
+        """
+        def to_row(series):
+            if series is None:
+                return None
+            return pd.DataFrame(series.reindex(factor.index).values[None, :], index=[date], columns=factor.index)
+
+        pipeline = Pipeline(self.steps, to_row(index_member), to_row(group), to_row(float_mv))
+        res = pipeline.transform(to_row(factor)).iloc[0]
+        res.name = date
+        if self.keep_history:
+            self._history[date] = res
+        return res
+
+    @property
+    def history(self):
+        """已处理的截面(pd.Dataframe),index为日期,columns为股票代码"""
+        if not self._history:
+            return None
+        return pd.DataFrame(list(self._history.values()), index=list(self._history.keys()))
@@ -0,0 +1,188 @@
+# encoding=utf-8
+# 参数优化的搜索策略
+
+import math
+import numbers
+from collections import OrderedDict
+
+import numpy as np
+from scipy.stats import norm
+
+
+class SearchStrategy(object):
+    '''
+    搜索策略基类.子类实现_search,在固定的评估次数budget内选择要评估的参数组合.
+    :param budget: int (50) 最多评估(计算信号绩效)的次数
+    :param seed: int (N) 随机数种子
+    '''
+
+    def __init__(self, budget=50, seed=None):
+        # 接受numpy整数,如np.int64(len(space) // 2)
+        if not (isinstance(budget, numbers.Integral) and not isinstance(budget, bool) and budget > 0):
+            raise ValueError("budget需为正整数,输入为%s" % (budget,))
+        self.budget = int(budget)
+        self.seed = seed
+        self.n_evaluations = 0
+        self._space = None
+        self._evaluate = None
+
+    def search(self, space, evaluate):
+        '''
+        :param space: OrderedDict 参数空间,如{"LEN1":[1,2,3],"LEN2":[5,10]}
+        :param evaluate: func(para_dict, fraction=1.0) -> float
+                         计算参数组合para_dict在样本内前fraction比例日期上的得分,越大越好,无法计算时为nan
+        :return: list of (para_dict, score) 在完整样本内范围上评估过的参数组合及得分
+        '''
+        self._space = OrderedDict((k, list(v)) for k, v in space.items())
+        self._evaluate = evaluate
+        self.n_evaluations = 0
+        return self._search(np.random.RandomState(self.seed))
+
+    def _search(self, rng):
+        raise NotImplementedError()
+
+    @property
+    def space_size(self):
+        size = 1
+        for values in self._space.values():
+            size *= len(values)
+        return size
+
+    def _to_params(self, position):
+        # position为每个参数取值的下标
+        return OrderedDict((k, v[i]) for (k, v), i in zip(self._space.items(), position))
+
+    def _sample_positions(self, rng, n, exclude=()):
+        '''不重复地随机抽取n个参数组合,参数空间不足时返回全部剩余组合'''
+        sizes = [len(v) for v in self._space.values()]
+        exclude = set(exclude)
+        n = min(n, self.space_size - len(exclude))
+        if self.space_size <= 4 * (n + len(exclude)):
+            # 参数空间较小时直接从全部组合中抽取
+            positions = [p for p in np.ndindex(*sizes) if p not in exclude]
+            return [positions[i] for i in rng.permutation(len(positions))[:n]]
+        positions = []
+        seen = set(exclude)
+        while len(positions) < n:
+            p = tuple(int(rng.randint(size)) for size in sizes)
+            if p not in seen:
+                seen.add(p)
+                positions.append(p)
+        return positions
+
+    def _score(self, position, fraction=1.0):
+        self.n_evaluations += 1
+        score = self._evaluate(self._to_params(position), fraction)
+        return np.nan if score is None else float(score)
+
+
+class RandomSearch(SearchStrategy):
+    '''在参数空间中随机抽取budget个参数组合进行评估'''
+
+    def _search(self, rng):
+        return [(self._to_params(p), self._score(p)) for p in self._sample_positions(rng, self.budget)]
+
+
+class SuccessiveHalving(SearchStrategy):
+    '''
+    逐次减半:先在样本内范围最前面的一小段日期上评估较多的随机参数组合,
+    每一轮保留得分最高的1/eta进入下一轮,并把评估的日期范围扩大eta倍,最后一轮使用完整的样本内范围.
+    budget小于轮数时跳过日期范围最短的几轮,每一轮至少评估一个组合.
+    :param budget: int (50) 所有轮次评估次数之和的上限
+    :param eta: int (3) 每轮保留的比例为1/eta
+    :param min_fraction: float (1/9) 第一轮使用的日期比例
+    :param seed: int (N)
+    '''
+
+    def __init__(self, budget=50, eta=3, min_fraction=1. / 9, seed=None):
+        super(SuccessiveHalving, self).__init__(budget, seed)
+        if eta < 2:
+            raise ValueError("eta需不小于2,输入为%s" % (eta,))
+        if not (0 < min_fraction <= 1):
+            raise ValueError("min_fraction需在(0,1]之间,输入为%s" % (min_fraction,))
+        self.eta = eta
+        self.min_fraction = min_fraction
+
+    def _search(self, rng):
+        n_rungs = int(round(math.log(1. / self.min_fraction, self.eta))) + 1
+        fractions = [min(1.0, self.min_fraction * self.eta ** i) for i in range(n_rungs)]
+        fractions[-1] = 1.0
+        n_rungs = min(n_rungs, self.budget)
+        fractions = fractions[-n_rungs:]
+        # 第一轮组合数n0满足 n0 * (1 + 1/eta + 1/eta^2 + ...) <= budget
+        n0 = int(self.budget / sum(self.eta ** -i for i in range(n_rungs)))
+        positions = self._sample_positions(rng, max(n0, 1))
+        scored = []
+        for i, fraction in enumerate(fractions):
+            if i > 0:
+                n_keep = max(1, len(positions) // self.eta)
+                ranked = sorted(scored, key=lambda x: -np.inf if np.isnan(x[1]) else x[1], reverse=True)
+                positions = [p for p, _ in ranked[:n_keep]]
+            # 为之后的每一轮保留至少一次评估
+            n_left = self.budget - self.n_evaluations - (n_rungs - 1 - i)
+            positions = positions[:n_left]
+            scored = [(p, self._score(p, fraction)) for p in positions]
+        return [(self._to_params(p), score) for p, score in scored]
+
+
+class BayesianSearch(SearchStrategy):
+    '''
+    基于高斯过程的序贯模型搜索:先随机评估n_init个参数组合,
+    之后每次用已有结果拟合高斯过程,选择期望提升(expected improvement)最大的组合进行评估.
+    参数按其取值在候选列表中的位置编码到[0,1].
+    :param budget: int (50)
+    :param n_init: int (N) 初始随机评估的次数,默认为max(5, 2 * 参数个数)
+    :param n_candidates: int (2000) 每次从中选择下一组合的候选数量,参数空间更小时使用全部未评估的组合
+    :param xi: float (0.01) 期望提升的探索系数
+    :param seed: int (N)
+    '''
+
+    def __init__(self, budget=50, n_init=None, n_candidates=2000, xi=0.01, seed=None):
+        super(BayesianSearch, self).__init__(budget, seed)
+        self.n_init = n_init
+        self.n_candidates = n_candidates
+        self.xi = xi
+
+    def _encode(self, positions):
+        scale = np.array([max(len(v) - 1, 1) for v in self._space.values()], dtype=float)
+        return np.asarray(positions, dtype=float).reshape(len(positions), -1) / scale
+
+    def _search(self, rng):
+        from sklearn.gaussian_process import GaussianProcessRegressor
+        from sklearn.gaussian_process.kernels import Matern, WhiteKernel, ConstantKernel
+
+        n_init = self.n_init if self.n_init is not None else max(5, 2 * len(self._space))
+        positions = self._sample_positions(rng, min(n_init, self.budget))
+        scores = [self._score(p) for p in positions]
+
+        kernel = ConstantKernel(1.0) * Matern(length_scale=np.ones(len(self._space)), nu=2.5) + WhiteKernel(1e-3)
+        while self.n_evaluations < self.budget and len(positions) < self.space_size:
+            candidates = self._sample_positions(rng, self.n_candidates, exclude=positions)
+            y = np.array(scores)
+            valid = ~np.isnan(y)
+            if valid.sum() < 2:
+                # 有效结果太少时继续随机搜索
+                best = candidates[0]
+            else:
+                # 无法计算的组合视为最差的结果
+                y[~valid] = y[valid].min()
+                gp = GaussianProcessRegressor(kernel=kernel, normalize_y=True,
+                                              random_state=rng.randint(2 ** 31 - 1))
+                gp.fit(self._encode(positions), y)
+                mu, sigma = gp.predict(self._encode(candidates), return_std=True)
+                improvement = mu - y.max() - self.xi * np.abs(y.max())
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    z = improvement / sigma
+                    ei = improvement * norm.cdf(z) + sigma * norm.pdf(z)
+                ei[sigma <= 0] = 0.0
+                best = candidates[int(np.argmax(ei))]
+            positions.append(best)
+            scores.append(self._score(best))
+        return [(self._to_params(p), score) for p, score in zip(positions, scores)]
+
+
+strategies = {
+    "random": RandomSearch,
+    "halving": SuccessiveHalving,
+    "bayes": BayesianSearch,
+}
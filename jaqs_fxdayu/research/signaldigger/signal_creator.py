@@ -1,6 +1,6 @@
 # encoding=utf-8
 
-from .analysis import compute_downside_returns, compute_upside_returns
+from .analysis import compute_return_spaces
 from . import performance as pfm
 import pandas as pd
 import numpy as np
@@ -130,14 +130,16 @@ class SignalCreator(object):
                 # 计算潜在上涨空间和潜在下跌空间
                 if self.high is not None:
                     self.high = jutil.fillinf(self.high)
-                    upside_ret = compute_upside_returns(self.price, self.high, self.can_exit, self.period,
-                                                        compound=True)
-                    upside_ret = jutil.fillinf(upside_ret)
-                    upside_ret -= self.commission
                 if self.low is not None:
                     self.low = jutil.fillinf(self.low)
-                    downside_ret = compute_downside_returns(self.price, self.low, self.can_exit, self.period,
-                                                            compound=True)
+                if self.high is not None or self.low is not None:
+                    upside_ret, downside_ret = compute_return_spaces(self.price, self.high, self.low,
+                                                                     self.can_exit, self.period,
+                                                                     compound=True)
+                if upside_ret is not None:
+                    upside_ret = jutil.fillinf(upside_ret)
+                    upside_ret -= self.commission
+                if downside_ret is not None:
                     downside_ret = jutil.fillinf(downside_ret)
                     downside_ret -= self.commission
             else:
@@ -0,0 +1,109 @@
+# encoding=utf-8
+# 多个参数组合的signal_data的紧凑存储
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+class SignalStore(object):
+    '''
+    以宽表(全部日期×全部股票)的形式保存多个参数组合的signal_data,按名称访问时还原为SignalCreator.get_signal_data的格式.
+    各参数组合相同的列(return/upside_ret/downside_ret/group等)只保存一份,每个参数组合只保存signal和quantile两个数组,
+    quantile为0表示该日期/股票不在signal_data中.
+    :param dtype: signal的保存精度(np.float64),np.float32可将每个参数组合占用的内存减半,但信号值会损失精度
+    :param folder: str (N) 不为空时每个参数组合的数组保存为该目录下的.npy文件,访问时以memmap方式读取
+    '''
+
+    def __init__(self, dtype=np.float64, folder=None):
+        self.dtype = dtype
+        self.folder = folder
+        self._items = OrderedDict()
+        self._dates = None
+        self._symbols = None
+        self._columns = None
+        self._shared = dict()
+
+    def __setitem__(self, name, signal_data):
+        self._items[name] = self._compact(signal_data, len(self._items))
+
+    def __getitem__(self, name):
+        return self._restore(self._items[name])
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def keys(self):
+        return self._items.keys()
+
+    def values(self):
+        return [self[name] for name in self._items]
+
+    def items(self):
+        return [(name, self[name]) for name in self._items]
+
+    def _compact(self, signal_data, number):
+        # 格式不同的结果原样保存
+        if not isinstance(signal_data, pd.DataFrame) or \
+                not isinstance(signal_data.index, pd.MultiIndex) or \
+                'signal' not in signal_data.columns or \
+                'quantile' not in signal_data.columns:
+            return signal_data
+        # 堆叠后只删除了行,index的levels仍是全部日期和股票
+        dates, symbols = signal_data.index.levels
+        if self._dates is None:
+            self._dates, self._symbols = dates, symbols
+            self._columns = list(signal_data.columns)
+        elif not (self._dates.equals(dates) and self._symbols.equals(symbols)) or \
+                list(signal_data.columns) != self._columns:
+            return signal_data
+        pos = dates.get_indexer(signal_data.index.get_level_values(0)) * len(symbols) + \
+            symbols.get_indexer(signal_data.index.get_level_values(1))
+        size = len(dates) * len(symbols)
+        for column in self._columns:
+            if column in ('signal', 'quantile'):
+                continue
+            values = signal_data[column].values
+            if column not in self._shared:
+                self._shared[column] = np.empty(size, dtype=values.dtype)
+            self._shared[column][pos] = values
+
+        signal = np.full(size, np.nan, dtype=self.dtype)
+        signal[pos] = signal_data['signal'].values
+        quantile = np.zeros(size, dtype=np.int16)
+        quantile[pos] = signal_data['quantile'].values
+        item = {"signal": signal, "quantile": quantile}
+        if self.folder is not None:
+            for key in item:
+                path = os.path.join(self.folder, "%d_%s.npy" % (number, key))
+                np.save(path, item[key])
+                item[key] = path
+        return item
+
+    def _restore(self, item):
+        if not isinstance(item, dict):
+            return item
+        if self.folder is not None:
+            item = {key: np.load(path, mmap_mode='r') for key, path in item.items()}
+        pos = np.flatnonzero(np.asarray(item["quantile"]) > 0)
+        n_symbols = len(self._symbols)
+        index = pd.MultiIndex.from_arrays([self._dates.values[pos // n_symbols],
+                                           self._symbols.values[pos % n_symbols]],
+                                          names=['trade_date', 'symbol'])
+        data = OrderedDict()
+        for column in self._columns:
+            if column == 'signal':
+                data[column] = np.asarray(item["signal"][pos], dtype=float)
+            elif column == 'quantile':
+                data[column] = np.asarray(item["quantile"][pos], dtype=int)
+            else:
+                data[column] = self._shared[column][pos]
+        return pd.DataFrame(data, index=index, columns=self._columns)
@@ -7,6 +7,7 @@ patch_all()
 
 import numpy as np
 import os
+import pandas as pd
 from pathlib import Path
 from jaqs.data import DataView
 from jaqs.data import RemoteDataService
@@ -256,9 +257,660 @@ def test_optimizer():
                                              ascending=False)  # 是否按优化目标升序排列(从小到大)
 
 
+def test_compute_return_spaces():
+    from jaqs_fxdayu.research.signaldigger.analysis import compute_return_spaces
+
+    rng = np.random.RandomState(0)
+    price = pd.DataFrame(rng.rand(60, 8) + 1)
+    price[rng.rand(60, 8) < 0.05] = np.nan
+    high = price * 1.05
+    low = price * 0.95
+    can_exit = pd.DataFrame(rng.rand(60, 8) > 0.3)
+    period = 5
+
+    upside, downside = compute_return_spaces(price, high, low, None, period)
+    expected = (high.rolling(period).max() - price.shift(period)) / price.shift(period)
+    assert np.allclose(upside.values, expected.values, equal_nan=True)
+    expected = (low.rolling(period).min() - price.shift(period)) / price.shift(period)
+    assert np.allclose(downside.values, expected.values, equal_nan=True)
+
+    upside, downside = compute_return_spaces(price, high, low, can_exit, period)
+    high_can_exit = high.where(can_exit).fillna(method="bfill")
+    up = (high.rolling(period).max() - price.shift(period)) / price.shift(period)
+    up_can_exit = (high_can_exit.rolling(period).max() - price.shift(period)) / price.shift(period)
+    expected = up.where(can_exit, np.fmax(up, up_can_exit).where(up.notnull() & up_can_exit.notnull(), 0))
+    assert np.allclose(upside.values, expected.values, equal_nan=True)
+
+
+def test_period_wise_ret_to_cum():
+    from jaqs_fxdayu.research.signaldigger import performance as fxdayu_pfm
+
+    def per_offset(values, period, compound):
+        # 第j个组合只持有t = j (mod period)的收益
+        values = np.nan_to_num(values)
+        portfolios = []
+        for j in range(min(len(values), period)):
+            held = np.where(np.arange(len(values)) % period == j, values, 0.0)
+            portfolios.append(np.cumprod(held + 1) - 1 if compound else np.cumsum(held))
+        return np.mean(portfolios, axis=0)
+
+    rng = np.random.RandomState(0)
+    ret = pd.DataFrame(rng.randn(23, 3) * 0.02)
+    ret.iloc[4, 1] = np.nan
+    for period in [3, 5, 30]:
+        for compound in [True, False]:
+            res = fxdayu_pfm.period_wise_ret_to_cum(ret, period, compound=compound)
+            for column in ret.columns:
+                expected = per_offset(ret[column].values, period, compound)
+                assert np.allclose(res[column].values, expected)
+            res = fxdayu_pfm.period_wise_ret_to_cum(ret[0], period, compound=compound)
+            assert isinstance(res, pd.Series) and res.index.equals(ret.index)
+            assert np.allclose(res.values, per_offset(ret[0].values, period, compound))
+
+
+def test_calc_quantile_mean_std_ts():
+    from jaqs_fxdayu.research.signaldigger import performance as fxdayu_pfm
+
+    rng = np.random.RandomState(0)
+    index = pd.MultiIndex.from_product([[20170103, 20170104, 20170105, 20170106], ['s%d' % i for i in range(6)]],
+                                       names=['trade_date', 'symbol'])
+    signal_data = pd.DataFrame({'return': rng.randn(len(index)), 'quantile': np.tile([1, 1, 2, 2, 3, 3], 4)},
+                               index=index)
+    # 部分日期缺少第3组或第2组只有一个样本
+    signal_data = signal_data.drop([(20170104, 's4'), (20170104, 's5'), (20170106, 's3')])
+    res = fxdayu_pfm.calc_quantile_return_mean_std(signal_data, time_series=True)
+    assert sorted(res.keys()) == [1, 2, 3]
+    for q in [1, 2, 3]:
+        assert list(res[q].columns) == ['mean', 'std', 'count']
+        assert list(res[q].index) == [20170103, 20170104, 20170105, 20170106]
+        expected = signal_data.loc[signal_data['quantile'] == q].groupby('trade_date')['return'].agg(
+            ['mean', 'std', 'count']).reindex(res[q].index).fillna(0)
+        assert np.allclose(res[q].values.astype(float), expected.values.astype(float))
+    assert (res[3].loc[20170104] == 0).all()
+    assert res[2].loc[20170106, 'std'] == 0
+    res = fxdayu_pfm.calc_quantile_mean_std_ts(signal_data, ['return'], quantiles=[1, 3])
+    assert list(res.keys()) == ['return'] and sorted(res['return'].keys()) == [1, 3]
+
+
+def test_analysis_engine():
+    from jaqs_fxdayu.research.signaldigger import analysis as ana
+
+    rng = np.random.RandomState(0)
+    dates = pd.bdate_range('2017-01-01', periods=30).strftime('%Y%m%d').astype(int)
+    index = pd.MultiIndex.from_product([dates, ['s%d' % i for i in range(20)]], names=['trade_date', 'symbol'])
+    signal_data = pd.DataFrame({'signal': np.round(rng.randn(len(index)), 1),
+                                'return': rng.randn(len(index)) * 0.02,
+                                'upside_ret': rng.rand(len(index)) * 0.05,
+                                'downside_ret': -rng.rand(len(index)) * 0.05,
+                                'quantile': rng.randint(1, 6, len(index))}, index=index)
+    signal_data.loc[rng.rand(len(index)) < 0.05, 'return'] = np.nan
+
+    res = ana.AnalysisEngine(signal_data, False, 5).analysis()
+    expected = {"ic": ana.ic_stats(signal_data),
+                "ret": ana.return_stats(signal_data, False, 5),
+                "space": ana.space_stats(signal_data, False)}
+    for key in expected:
+        assert list(res[key].columns) == list(expected[key].columns)
+        assert np.allclose(res[key].values.astype(float), expected[key].values.astype(float), equal_nan=True)
+
+    res = ana.analysis(signal_data, False, 5, target_types=["tmb_ret"])
+    assert list(res.keys()) == ["ret"]
+    assert np.allclose(res["ret"]["tmb_ret"].values, expected["ret"]["tmb_ret"].values)
+
+    engine = ana.AnalysisEngine(signal_data, False, 5)
+    engine.analysis()
+    engine.drop_row_cache()
+    window = engine.window(dates[5], dates[20])
+    res = window.analysis()
+    sliced = signal_data.loc[dates[5]:dates[20]]
+    expected = {"ic": ana.ic_stats(sliced),
+                "ret": ana.return_stats(sliced, False, 5),
+                "space": ana.space_stats(sliced, False)}
+    assert window.n_rows == len(sliced)
+    for key in expected:
+        assert np.allclose(res[key].values.astype(float), expected[key].values.astype(float), equal_nan=True)
+
+
+def test_walk_forward_optimizer():
+    from jaqs_fxdayu.research import Optimizer
+
+    rng = np.random.RandomState(0)
+    dates = pd.bdate_range('2017-01-01', periods=40).strftime('%Y%m%d').astype(int)
+    symbols = ['s%d' % i for i in range(20)]
+    price = pd.DataFrame(np.exp(np.cumsum(rng.randn(40, 20) * 0.02, axis=0)), index=dates, columns=symbols)
+    optimizer = Optimizer(price=price, period=2, n_quantiles=3, storage="full")
+    optimizer.all_signals = dict()
+    for i in range(3):
+        signal = pd.DataFrame(rng.randn(40, 20), index=dates, columns=symbols)
+        optimizer.all_signals["signal%d" % i] = optimizer.signal_creator.get_signal_data(signal)
+    windows = [([dates[0], dates[19]], [dates[20], dates[29]]), ([dates[10], dates[29]], [dates[30], dates[37]])]
+    result = optimizer.walk_forward_optimizer(windows, target_type="long_ret", target="Ann. IR")
+    for (in_sample_range, out_sample_range), item in zip(windows, result):
+        scores = {sig_name: optimizer.cal_perf(signal_data, in_sample_range)["ret"].loc["Ann. IR", "long_ret"]
+                  for sig_name, signal_data in optimizer.all_signals.items()}
+        assert item["signal_name"] == max(scores, key=scores.get)
+        expected = optimizer.cal_perf(optimizer.all_signals[item["signal_name"]], out_sample_range)
+        assert np.allclose(item["out_sample_perf"]["ret"].values.astype(float),
+                           expected["ret"].values.astype(float), equal_nan=True)
+    # 缓存的engine不保留逐行的中间结果
+    assert len(optimizer._engines) == 3
+    assert all(len(engine._row_cache) == 0 for _, engine in optimizer._engines.values())
+
+
+def test_optimizer_n_jobs():
+    from jaqs_fxdayu.research import Optimizer
+
+    rng = np.random.RandomState(0)
+    dates = pd.bdate_range('2017-01-01', periods=60).strftime('%Y%m%d').astype(int)
+    symbols = ['s%02d' % i for i in range(15)]
+    close = pd.DataFrame(np.exp(np.cumsum(rng.randn(60, 15) * 0.02, axis=0)), index=dates, columns=symbols)
+    volume = pd.DataFrame(rng.rand(60, 15), index=dates, columns=symbols)
+    dv = DataView()
+    dv.data_d = pd.concat({"close": close, "volume": volume}, axis=1).swaplevel(axis=1).sort_index(axis=1)
+    dv.data_d.columns.names = ["symbol", "field"]
+    dv.data_d.index.name = "trade_date"
+    dv.fields = ["close", "volume"]
+    dv.symbol = symbols
+    dv.start_date = dv.extended_start_date_d = int(dates[0])
+    dv.end_date = int(dates[-1])
+
+    res = dict()
+    for n_jobs in [1, 2]:
+        optimizer = Optimizer(dataview=dv, formula="Ts_Mean(close, LEN1) * volume / Delay(close, LEN2)",
+                              params={"LEN1": [2, 3, 5], "LEN2": [1, 4]}, name="signal",
+                              price=close, period=2, n_quantiles=3)
+        res[n_jobs] = optimizer.enumerate_optimizer(target_type="long_ret", target="Ann. IR",
+                                                    in_sample_range=[dates[5], dates[50]], n_jobs=n_jobs)
+        if n_jobs == 2:
+            # 多进程计算时不保存all_signals
+            assert optimizer.all_signals is None
+    assert [perf["signal_name"] for perf in res[1]] == [perf["signal_name"] for perf in res[2]]
+    for perf1, perf2 in zip(res[1], res[2]):
+        assert list(perf1.keys()) == list(perf2.keys())
+        for key in ["ic", "ret"]:
+            assert np.allclose(perf1[key].values.astype(float), perf2[key].values.astype(float), equal_nan=True)
+
+
+def test_formula_template():
+    from jaqs_fxdayu.data.py_expression_eval import Parser
+
+    rng = np.random.RandomState(0)
+    close = pd.DataFrame(rng.rand(50, 4) + 1)
+    volume = pd.DataFrame(rng.rand(50, 4))
+    formula = "(close - Delay(close, LEN1)) / Delay(close, LEN) * Sign(Delta(volume, 2))"
+
+    template = Parser().parse_template(formula, ["LEN", "LEN1"])
+    assert template.variables() == ["close", "volume"]
+    template.bind({"close": close, "volume": volume})
+    for len1 in [1, 3]:
+        for len2 in [2, 5]:
+            parser = Parser()
+            parser.parse(formula.replace("LEN1", str(len1)).replace("LEN", str(len2)))
+            expected = parser.evaluate({"close": close, "volume": volume})
+            res = template.evaluate({"LEN": len2, "LEN1": len1})
+            assert np.allclose(res.values, expected.values, equal_nan=True)
+    # 每个子公式只保留最近一个参数取值的结果
+    assert all(len(cache) <= 1 for cache in template._cache.values())
+    assert all(len(cache) <= 1 for cache in template._sweeps.values())
+
+
+def test_formula_template_mutating_functions():
+    from jaqs_fxdayu.data.py_expression_eval import Parser
+
+    rng = np.random.RandomState(0)
+    close = pd.DataFrame(rng.standard_t(2, (60, 5)) + 10)
+    formula = "Ts_Argmax(close, LEN) + Cutoff(close, 2)"
+    template = Parser().parse_template(formula, ["LEN"])
+    template.bind({"close": close.copy()})
+    for length in [3, 4, 5, 3]:
+        parser = Parser()
+        parser.parse(formula.replace("LEN", str(length)))
+        expected = parser.evaluate({"close": close.copy()})
+        assert np.allclose(template.evaluate({"LEN": length}).values, expected.values, equal_nan=True)
+
+
+def test_window_sweep():
+    from jaqs_fxdayu.data.window_sweep import WindowSweep
+
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(np.cumsum(rng.randn(100, 6), axis=0) + 10)
+    df[rng.rand(100, 6) < 0.05] = np.nan
+    sweep = WindowSweep(df)
+    for n in [1, 2, 5, 12, 100]:
+        rolling = df.rolling(n)
+        assert np.allclose(sweep.ts_mean(n).values, rolling.mean().values, equal_nan=True)
+        assert np.allclose(sweep.ts_sum(n).values, rolling.sum().values, equal_nan=True)
+        assert np.allclose(sweep.std_dev(n).values, rolling.std().values, equal_nan=True)
+        assert np.allclose(sweep.ts_max(n).values, rolling.max().values, equal_nan=True)
+        assert np.allclose(sweep.ts_min(n).values, rolling.min().values, equal_nan=True)
+        assert np.allclose(sweep.delta(n).values, df.diff(n).values, equal_nan=True)
+
+
+def test_window_sweep_inf():
+    from jaqs_fxdayu.data.window_sweep import WindowSweep
+    from jaqs_fxdayu.data.py_expression_eval import Parser
+
+    close = pd.DataFrame(np.random.RandomState(0).rand(20, 3) + 1)
+    close.iloc[5, 0] = np.inf
+    close.iloc[7, 1] = -np.inf
+    close.iloc[[7, 8], 2] = [np.inf, -np.inf]
+    sweep = WindowSweep(close)
+    for n in [1, 3, 5]:
+        rolling = close.rolling(n)
+        assert np.allclose(sweep.ts_mean(n).values, rolling.mean().values, equal_nan=True)
+        assert np.allclose(sweep.ts_sum(n).values, rolling.sum().values, equal_nan=True)
+        assert np.allclose(sweep.std_dev(n).values, rolling.std().values, equal_nan=True)
+        assert np.allclose(sweep.ts_max(n).values, rolling.max().values, equal_nan=True)
+        assert np.allclose(sweep.ts_min(n).values, rolling.min().values, equal_nan=True)
+        assert np.allclose(sweep.delta(n).values, close.diff(n).values, equal_nan=True)
+    # inf离开窗口后的结果不受影响
+    assert np.isfinite(sweep.ts_mean(3).values[8:12, 0]).all()
+    # 模板的扫描路径与内置函数Ts_Mean(rolling(n).mean())一致
+    template = Parser().parse_template("Ts_Mean(close, LEN)", ["LEN"])
+    template.bind({"close": close})
+    for n in [3, 5]:
+        assert np.allclose(template.evaluate({"LEN": n}).values, close.rolling(n).mean().values, equal_nan=True)
+
+
+def test_formula_template_future_data():
+    from jaqs_fxdayu.data.py_expression_eval import Parser
+
+    close = pd.DataFrame(np.random.RandomState(0).rand(20, 3) + 1)
+    for formula, expected in [("Delay(close, LEN)", close.shift(2)), ("Delta(close, LEN)", close.diff(2))]:
+        template = Parser().parse_template(formula, ["LEN"])
+        template.bind({"close": close})
+        assert np.allclose(template.evaluate({"LEN": 2}).values, expected.values, equal_nan=True)
+        try:
+            template.evaluate({"LEN": -2})
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("negative LEN should not use future data")
+
+
+def test_search_strategies():
+    from jaqs_fxdayu.research.signaldigger.search import strategies
+
+    space = {"LEN1": list(range(20)), "LEN2": list(range(20)), "LEN3": [1, 2]}
+    fractions = []
+
+    def evaluate(para_dict, fraction):
+        fractions.append(fraction)
+        return -(para_dict["LEN1"] - 7) ** 2 - (para_dict["LEN2"] - 12) ** 2 + para_dict["LEN3"]
+
+    for name, strategy in strategies.items():
+        del fractions[:]
+        searcher = strategy(budget=40, seed=0)
+        result = searcher.search(space, evaluate)
+        assert 0 < len(result) and searcher.n_evaluations == len(fractions) <= 40
+        params = [tuple(para_dict.values()) for para_dict, _ in result]
+        assert len(set(params)) == len(params)
+        assert all(fraction == 1.0 for fraction in fractions[-len(result):])
+    # budget小于轮数时仍在完整范围上评估
+    for budget in [1, 2, 3]:
+        del fractions[:]
+        searcher = strategies["halving"](budget=budget, seed=0)
+        result = searcher.search(space, evaluate)
+        assert len(result) > 0 and searcher.n_evaluations == len(fractions) <= budget and fractions[-1] == 1.0
+    # budget可以为numpy整数,不能为bool、浮点数或非正数
+    searcher = strategies["random"](budget=np.int64(len(space["LEN1"]) // 2), seed=0)
+    assert searcher.budget == 10 and type(searcher.budget) is int
+    for budget in [True, 2.0, 0]:
+        try:
+            strategies["random"](budget=budget)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("budget=%r should be rejected" % (budget,))
+    # 参数空间小于budget时评估全部组合
+    result = strategies["random"](budget=10, seed=0).search({"LEN1": [1, 2, 3]},
+                                                             lambda para_dict, fraction: para_dict["LEN1"])
+    assert sorted(para_dict["LEN1"] for para_dict, _ in result) == [1, 2, 3]
+
+
+def test_signal_store():
+    import shutil
+    import tempfile
+    from jaqs_fxdayu.research.signaldigger.signal_store import SignalStore
+
+    rng = np.random.RandomState(0)
+    index = pd.MultiIndex.from_product([[20170103, 20170104, 20170105], ["000001.SZ", "600000.SH"]],
+                                       names=['trade_date', 'symbol'])
+    signal_data = pd.DataFrame({"signal": rng.randn(6), "return": rng.randn(6), "quantile": [1, 2] * 3},
+                               index=index, columns=["signal", "return", "quantile"]).iloc[[0, 1, 3, 4, 5]]
+    folder = tempfile.mkdtemp()
+    for store in [SignalStore(), SignalStore(folder=folder)]:
+        store["a"] = signal_data
+        store["b"] = signal_data.iloc[1:]
+        assert list(store.keys()) == ["a", "b"]
+        for name, expected in [("a", signal_data), ("b", signal_data.iloc[1:])]:
+            res = store[name]
+            assert res.index.equals(expected.index)
+            assert np.allclose(res.values, expected.values)
+    store = SignalStore(dtype=np.float32)
+    store["a"] = signal_data
+    assert np.allclose(store["a"]["signal"], signal_data["signal"], atol=1e-6)
+    shutil.rmtree(folder)
+
+
+def test_result_journal():
+    import shutil
+    import socket
+    import subprocess
+    import sys
+    import tempfile
+    from jaqs_fxdayu.research.signaldigger.journal import ResultJournal
+
+    folder = tempfile.mkdtemp()
+    journal = ResultJournal(folder)
+    key = journal.key("formula", {"LEN1": 1, "LEN2": 2}, [20170101, 20171231])
+    assert key == journal.key("formula", {"LEN2": 2, "LEN1": 1}, [20170101, 20171231])
+    assert key != journal.key("formula", {"LEN1": 2, "LEN2": 1}, [20170101, 20171231])
+    assert journal.load(key) == (False, None)
+    assert journal.claim(key)
+    assert not ResultJournal(folder).claim(key)
+    # 持有者进程仍在运行时不因超时被接管
+    assert not ResultJournal(folder, stale_timeout=-1).claim(key)
+    # 其他主机的锁超时后可接管
+    with open(os.path.join(folder, key + ".lock"), "w") as f:
+        f.write("other-host 1")
+    assert not ResultJournal(folder).claim(key)
+    assert ResultJournal(folder, stale_timeout=-1).claim(key)
+    if os.name == "posix":
+        # 本机已退出的持有者的锁立即接管
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        with open(os.path.join(folder, key + ".lock"), "w") as f:
+            f.write("%s %d" % (socket.gethostname(), process.pid))
+        assert ResultJournal(folder).claim(key)
+    journal.save(key, {"ret": 1.0})
+    journal.release(key)
+    assert key in journal
+    assert ResultJournal(folder).load(key) == (True, {"ret": 1.0})
+    assert os.listdir(folder) == [key + ".pkl"]
+    shutil.rmtree(folder)
+
+
+def test_cross_section_regression():
+    from jaqs_fxdayu.research.signaldigger.multi_factor import _cross_section_regression
+
+    rng = np.random.RandomState(0)
+    y = rng.randn(30, 50)
+    factors = [rng.randn(30, 50) for _ in range(3)]
+    factors.append(factors[0] * 2)  # 共线因子取最小范数解
+    valid = rng.rand(30, 50) > 0.2
+    valid[3] = False
+    weights = rng.rand(30, 50) + 0.5
+    beta, count = _cross_section_regression(y, factors, valid, weights, chunk_size=1000)
+    assert np.isnan(beta[3]).all() and count[3] == 0
+    for i in [0, 10, 29]:
+        sw = np.sqrt(weights[i][valid[i]])
+        x = np.column_stack([f[i][valid[i]] for f in factors]) * sw[:, None]
+        expected = np.linalg.lstsq(x, y[i][valid[i]] * sw, rcond=None)[0]
+        assert np.allclose(beta[i], expected)
+
+
+def test_orthogonal_basis():
+    from jaqs_fxdayu.research.signaldigger.multi_factor import _orthogonal_basis
+
+    rng = np.random.RandomState(0)
+    x = rng.randn(4, 40, 3)
+    x[:, :, 1] += x[:, :, 0]
+    mask = np.ones((4, 40), dtype=bool)
+    mask[1, :5] = False
+    x[1, :5] = 0
+    x[2, :, 2] = x[2, :, 0]  # 共线
+    for method in ["schmidt", "symmetric"]:
+        q = _orthogonal_basis(x, mask, method)
+        assert np.isnan(q[2]).all() and np.isnan(q[1, :5]).all()
+        for d in [0, 1, 3]:
+            qd = q[d][mask[d]]
+            assert np.allclose(qd.T.dot(qd), np.eye(3))
+    q = _orthogonal_basis(x, mask, "schmidt")
+    assert np.allclose(np.abs(q[0, :, 0]), np.abs(x[0, :, 0]) / np.linalg.norm(x[0, :, 0]))
+    assert np.all(q[0, :, 0] * x[0, :, 0] >= 0)
+
+
+def test_rolling_window():
+    from sklearn.covariance import LedoitWolf
+    from jaqs_fxdayu.research.signaldigger.multi_factor import _RollingWindow
+
+    rng = np.random.RandomState(0)
+    ic_df = pd.DataFrame(rng.randn(40, 3) * 0.1 + 0.02, columns=list("abc"))
+    ic_df.iloc[5, 1] = np.nan
+    window = _RollingWindow(ic_df, 20)
+    mean, cov = window.cov("shrink")
+    assert np.isnan(mean[:25]).all() and np.isnan(cov[:25]).all()
+    for i in [25, 39]:
+        sample = ic_df.values[i - 19:i + 1]
+        assert np.allclose(mean[i], sample.mean(axis=0))
+        assert np.allclose(cov[i], LedoitWolf().fit(sample).covariance_)
+        assert np.allclose(window.cov("simple")[1][i], np.cov(sample.T))
+    assert np.allclose(window.std()[19], ic_df.iloc[:20].std().values)
+
+
+def test_max_IC_weight():
+    from sklearn.covariance import LedoitWolf
+    from jaqs_fxdayu.research.signaldigger import multi_factor
+
+    rng = np.random.RandomState(0)
+    factors_dict = {name: pd.DataFrame(rng.randn(6, 30)) for name in "abc"}
+    factors_dict["b"].iloc[2, :10] = np.nan
+    factors_dict["c"].iloc[4] = factors_dict["a"].iloc[4]  # 协方差奇异
+    ic_df = pd.DataFrame(rng.randn(6, 3) * 0.1, columns=list("abc"))
+    weight = multi_factor.max_IC_weight(ic_df, factors_dict, 0)
+    for i in [0, 2]:
+        sample = pd.concat([factors_dict[name].iloc[i] for name in "abc"], axis=1).dropna().values
+        expected = np.linalg.solve(LedoitWolf().fit(sample).covariance_, ic_df.iloc[i].values)
+        assert np.allclose(weight.iloc[i].values, expected / np.abs(expected).sum())
+    assert np.isfinite(multi_factor.max_IC_weight(ic_df, factors_dict, 0, "simple").values).all()
+
+
+def test_weighted_sum():
+    from jaqs_fxdayu.research.signaldigger.multi_factor import _weighted_sum
+
+    rng = np.random.RandomState(0)
+    factors_dict = {"a": pd.DataFrame(rng.randn(5, 4), columns=list("wxyz")),
+                    "b": pd.DataFrame(rng.randn(4, 3), columns=list("wxy"))}
+    factors_dict["a"].iloc[0, 0] = np.nan
+    weight = pd.DataFrame(rng.rand(5, 2), columns=["a", "b"])
+    res = _weighted_sum(factors_dict, weight)
+    expected = factors_dict["a"].mul(weight["a"], axis=0) + factors_dict["b"].mul(weight["b"], axis=0)
+    assert res.equals(expected)
+    assert _weighted_sum(factors_dict).equals(factors_dict["a"] + factors_dict["b"])
+
+    # 逐个读取因子,读取下一个因子时上一个已被释放
+    import weakref
+    loaded = []
+
+    def loader(name):
+        def load():
+            assert all(ref() is None for ref in loaded)
+            factor = factors_dict[name].copy()
+            loaded.append(weakref.ref(factor))
+            return factor
+        return load
+
+    res = _weighted_sum(((name, loader(name)) for name in ["a", "b"]), weight,
+                        index=expected.index, columns=expected.columns)
+    assert res.equals(expected) and len(loaded) == 2
+    # 未给定index/columns时取第一个因子的
+    assert _weighted_sum(iter([("b", factors_dict["b"]), ("a", factors_dict["a"])])).equals(
+        (factors_dict["a"] + factors_dict["b"]).reindex(index=factors_dict["b"].index, columns=list("wxy")))
+
+
+def test_segment_rank_ic():
+    from scipy.stats import spearmanr
+    from jaqs_fxdayu.research.signaldigger.multi_factor import _segment_rank_ic
+
+    rng = np.random.RandomState(0)
+    signal = rng.randn(4, 30).round(1)
+    ret = rng.randn(4, 30)
+    valid = rng.rand(4, 30) > 0.2
+    valid[3] = False
+    valid[3, 0] = True
+    group = rng.randint(2, size=(4, 30))
+    codes = np.arange(4)[:, None] * 2 + group
+    ic, count = _segment_rank_ic(signal, ret, valid, codes, 8)
+    for d in range(3):
+        for g in range(2):
+            sel = valid[d] & (group[d] == g)
+            assert count[d * 2 + g] == sel.sum()
+            assert np.isclose(ic[d * 2 + g], spearmanr(signal[d][sel], ret[d][sel])[0])
+    assert np.isnan(ic[6:]).all()
+    codes = np.repeat(np.arange(4)[:, None], 30, axis=1)
+    ic, count = _segment_rank_ic(signal, ret, valid, codes, 4)
+    assert np.isclose(ic[1], spearmanr(signal[1][valid[1]], ret[1][valid[1]])[0])
+
+
+def test_winsorize_mad():
+    from jaqs_fxdayu.research.signaldigger import process
+
+    rng = np.random.RandomState(0)
+    factor_df = pd.DataFrame(rng.standard_t(3, (6, 20)))
+    factor_df[rng.rand(6, 20) < 0.2] = np.nan
+    factor_df.iloc[1] = np.nan
+    factor_df.iloc[2, 1:] = np.nan
+    for row in [0, 3]:
+        se = factor_df.iloc[row].copy()
+        q = se.quantile([0.025, 0.975])
+        res = process.winsorize(factor_df.copy()).iloc[row]
+        assert res.equals(se.clip(q.iloc[0], q.iloc[1]))
+        median = se.median()
+        tmp = (se - median).abs().median()
+        assert process.mad(factor_df.copy(), n_jobs=2).iloc[row].equals(se.clip(median - 5 * tmp, median + 5 * tmp))
+    assert process.mad(factor_df.copy()).iloc[1].isnull().all()
+    assert process.winsorize(factor_df.copy()).iloc[2].equals(factor_df.iloc[2])
+
+
+def test_neutralize():
+    from jaqs_fxdayu.research.signaldigger import process
+
+    rng = np.random.RandomState(0)
+    factor_df = pd.DataFrame(rng.randn(3, 40))
+    factor_df.iloc[0, :5] = np.nan
+    group = pd.DataFrame(rng.choice(["a", "b", "c"], (3, 40)).astype(object))
+    group.iloc[1, :3] = "nan"
+    float_mv = pd.DataFrame(np.exp(rng.randn(3, 40) + 10))
+    res = process.neutralize(factor_df.copy(), group, float_mv)
+    style = process.standardize(process.mad(np.log(float_mv)))
+    for row in [0, 1]:
+        valid = factor_df.iloc[row].notnull() & (group.iloc[row] != "nan")
+        x = pd.concat([style.iloc[row][valid], pd.get_dummies(group.iloc[row][valid])], axis=1).values.astype(float)
+        y = factor_df.iloc[row][valid].values
+        expected = y - x.dot(np.linalg.lstsq(x, y, rcond=None)[0])
+        assert np.allclose(res.iloc[row][valid].values, expected)
+        assert res.iloc[row][~valid].isnull().all()
+
+
+def test_process_pipeline():
+    from jaqs_fxdayu.research.signaldigger import process
+
+    rng = np.random.RandomState(0)
+    factors_dict = {name: pd.DataFrame(rng.standard_t(3, (5, 30))) for name in "ab"}
+    factors_dict["a"].iloc[0, 0] = np.inf
+    group = pd.DataFrame(rng.choice(["x", "y"], (5, 30)))
+    float_mv = pd.DataFrame(np.exp(rng.randn(5, 30) + 10))
+    index_member = pd.DataFrame(rng.rand(5, 30) > 0.1)
+    pipeline = process.Pipeline(["mad", "neutralize", ("winsorize", {"alpha": 0.1}), "standardize"],
+                                index_member=index_member, group=group, float_mv=float_mv, n_jobs=2)
+    res = pipeline.transform_dict(factors_dict)
+    for name, factor_df in factors_dict.items():
+        expected = process.mad(factor_df.copy(), index_member)
+        expected = process.neutralize(expected, group, float_mv, index_member)
+        expected = process.winsorize(expected, 0.1, index_member)
+        expected = process.standardize(expected, index_member)
+        assert np.allclose(res[name].values, expected.values, equal_nan=True)
+    assert factors_dict["a"].iloc[0, 0] == np.inf
+
+
+def test_cross_section_processor():
+    from jaqs_fxdayu.research.signaldigger import process
+
+    rng = np.random.RandomState(0)
+    factor_df = pd.DataFrame(rng.standard_t(3, (4, 30)), index=[20180102, 20180103, 20180104, 20180105])
+    factor_df.iloc[1, :3] = np.nan
+    group = pd.DataFrame(rng.choice(["x", "y"], (4, 30)), index=factor_df.index)
+    index_member = pd.DataFrame(rng.rand(4, 30) > 0.1, index=factor_df.index)
+    expected = process.rank_standardize(process.neutralize(process.winsorize(factor_df.copy(), 0.05, index_member),
+                                                           group, index_member=index_member), index_member)
+    processor = process.CrossSectionProcessor(["winsorize", "neutralize", "rank_standardize"], keep_history=True)
+    for date in factor_df.index:
+        res = processor.update(date, factor_df.loc[date], index_member.loc[date], group.loc[date])
+        assert np.allclose(res.values, expected.loc[date].values, equal_nan=True)
+    assert np.allclose(processor.history.values, expected.values, equal_nan=True)
+
+
+def test_signal_monitor():
+    from jaqs_fxdayu.research.signaldigger import performance as pfm
+    from jaqs_fxdayu.research.signaldigger.monitor import SignalMonitor
+
+    rng = np.random.RandomState(0)
+    dates = np.arange(20180101, 20180141)
+    price = pd.DataFrame(np.exp(np.cumsum(rng.randn(40, 30) * 0.02, axis=0)), index=dates)
+    signal = pd.DataFrame(rng.randn(40, 30), index=dates) + price.pct_change(2).shift(-2).fillna(0) * 20
+    mask = pd.DataFrame(rng.rand(40, 30) < 0.1, index=dates)
+    sd = SignalDigger(output_format=None)
+    sd.process_signal_before_analysis(signal, price=price, mask=mask, period=2, n_quantiles=3, commission=0.001)
+    # 最后period天的收益尚不可知
+    signal_data = sd.signal_data.loc[sd.signal_data.index.get_level_values(0) <= dates[-3]]
+    expected_ic = pfm.calc_ic_stats_table(pfm.calc_signal_ic(signal_data))
+    expected_quantile = pfm.calc_quantile_return_mean_std(signal_data)
+
+    monitor = SignalMonitor(period=2, n_quantiles=3, commission=0.001)
+    for date in dates:
+        monitor.update(date, signal.loc[date], price.loc[date], mask.loc[date])
+    assert monitor.last_settled == dates[-3]
+    assert np.allclose(monitor.ic_stats().values, expected_ic.values.astype(float))
+    assert np.allclose(monitor.quantile_stats().values, expected_quantile.values)
+
+
+def test_horizon_profile():
+    from jaqs_fxdayu.research.signaldigger import performance as pfm
+
+    rng = np.random.RandomState(0)
+    dates = np.arange(20180101, 20180141)
+    price = pd.DataFrame(np.exp(np.cumsum(rng.randn(40, 30) * 0.02, axis=0)), index=dates)
+    signal = pd.DataFrame(rng.randn(40, 30), index=dates) + price.pct_change(2).shift(-2).fillna(0) * 20
+    can_exit = pd.DataFrame(rng.rand(40, 30) > 0.1, index=dates)
+    sd = SignalDigger(output_format=None)
+    profile = sd.calc_horizon_profile(signal, price, periods=[1, 2, 4], n_quantiles=3, can_exit=can_exit)
+    for period in [1, 2, 4]:
+        sd.process_signal_before_analysis(signal, price=price, period=period, n_quantiles=3, can_exit=can_exit)
+        signal_data = sd.signal_data.loc[sd.signal_data.index.get_level_values(0) <= dates[-period - 1]]
+        expected = pfm.calc_ic_stats_table(pfm.calc_signal_ic(signal_data))
+        assert np.allclose(profile.loc[period, expected.columns].values.astype(float), expected.values[0])
+
+
 if __name__ == "__main__":
     test_save_dataview()
     test_analyze_signal()
     test_DIY_signal()
     test_multi_factor()
     test_optimizer()
+    test_compute_return_spaces()
+    test_period_wise_ret_to_cum()
+    test_calc_quantile_mean_std_ts()
+    test_analysis_engine()
+    test_walk_forward_optimizer()
+    test_optimizer_n_jobs()
+    test_formula_template()
+    test_formula_template_mutating_functions()
+    test_window_sweep()
+    test_window_sweep_inf()
+    test_formula_template_future_data()
+    test_search_strategies()
+    test_signal_store()
+    test_result_journal()
+    test_cross_section_regression()
+    test_orthogonal_basis()
+    test_rolling_window()
+    test_max_IC_weight()
+    test_weighted_sum()
+    test_segment_rank_ic()
+    test_winsorize_mad()
+    test_neutralize()
+    test_process_pipeline()
+    test_cross_section_processor()
+    test_signal_monitor()
+    test_horizon_profile()